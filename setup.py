@@ -14,9 +14,14 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "beachboys-minecraft-manager=src.cli:execute"
+            "beachboys-minecraft-manager=src.cli:execute",
+            "beachboys-minecraft-benchmark=src.benchmark:execute"
         ]
     },
     zip_safe=False,
-    install_requires=["click", "discord"]
+    install_requires=["click", "discord"],
+    extras_require={
+        "sftp": ["paramiko"],
+        "test": ["pytest", "prometheus_client"]
+    }
 )
@@ -0,0 +1,197 @@
+import gzip
+import os
+import struct
+
+SECTOR_SIZE = 4096
+HEADER_SIZE = SECTOR_SIZE * 2
+CHUNKS_PER_REGION = 1024
+
+
+def is_region_file(path, size):
+    return str(path).endswith('.mca') and size >= HEADER_SIZE
+
+
+def read_region_header(f, size):
+    """
+    Reads the 8 KiB Anvil header. The first 4 KiB holds a location per chunk (3 byte sector offset,
+    1 byte sector count), the second 4 KiB holds the last time each chunk was saved
+    """
+
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError('Region file header is truncated')
+
+    locations = struct.unpack('>1024I', header[:SECTOR_SIZE])
+    timestamps = struct.unpack('>1024I', header[SECTOR_SIZE:])
+
+    chunks = []
+    for index in range(CHUNKS_PER_REGION):
+        location = locations[index]
+        if not location:
+            continue
+
+        offset, count = location >> 8, location & 0xFF
+        if offset < 2 or not count or (offset + count) * SECTOR_SIZE > size:
+            raise ValueError('Region file has an invalid location for chunk {}'.format(index))
+
+        chunks.append((index, offset, count, timestamps[index]))
+
+    return chunks
+
+
+def read_chunk(f, offset, count):
+    f.seek(offset * SECTOR_SIZE)
+    data = f.read(count * SECTOR_SIZE)
+
+    # Chunks start with a 4 byte length (which includes the compression type byte). Trim the
+    # sector padding when it's sane, otherwise keep the raw sectors so nothing is lost
+    if len(data) >= 5:
+        length = struct.unpack('>I', data[:4])[0]
+        if 0 < length <= len(data) - 4:
+            return data[:length + 4]
+
+    return data
+
+
+def read_chunk_prefix(f, offset):
+    # The length and compression type, which tell rewrites apart without reading the whole chunk
+    f.seek(offset * SECTOR_SIZE)
+    return f.read(5).hex()
+
+
+def write_region_file(path, size, chunks, read_chunk_data):
+    """
+    Rebuilds a region file from (index, offset, count, timestamp, key, ...) entries. Chunks are put back
+    at their original sectors, so the header stays valid and unused sectors are zero filled
+    """
+
+    locations = [0] * CHUNKS_PER_REGION
+    timestamps = [0] * CHUNKS_PER_REGION
+    for index, offset, count, timestamp, *_ in chunks:
+        locations[index] = (offset << 8) | count
+        timestamps[index] = timestamp
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('>1024I', *locations))
+        f.write(struct.pack('>1024I', *timestamps))
+
+        for _, offset, count, _, key, *_ in sorted(chunks, key=lambda i: i[1]):
+            data = read_chunk_data(key)
+            f.seek(offset * SECTOR_SIZE)
+            f.write(data[:count * SECTOR_SIZE])
+
+        # Region files are always a whole number of sectors
+        end = max([size] + [(offset + count) * SECTOR_SIZE for _, offset, count, *_ in chunks])
+        f.truncate(end)
+
+
+def read_nbt(f):
+    """
+    Reads an uncompressed NBT document (the root compound) into plain dicts and lists
+    """
+
+    def read(fmt):
+        size = struct.calcsize(fmt)
+        data = f.read(size)
+        if len(data) < size:
+            raise ValueError('NBT data is truncated')
+        return struct.unpack(fmt, data)[0]
+
+    def read_string():
+        return f.read(read('>H')).decode('utf-8', errors='replace')
+
+    def read_payload(tag_type):
+        if tag_type in NBT_NUMBERS:
+            return read(NBT_NUMBERS[tag_type])
+        if tag_type in NBT_ARRAYS:
+            return [read(NBT_ARRAYS[tag_type]) for _ in range(read('>i'))]
+        if tag_type == 8:
+            return read_string()
+        if tag_type == 9:
+            item_type = read('>b')
+            return [read_payload(item_type) for _ in range(read('>i'))]
+        if tag_type == 10:
+            compound = {}
+            while True:
+                item_type = read('>b')
+                if item_type == 0:
+                    return compound
+                name = read_string()
+                compound[name] = read_payload(item_type)
+
+        raise ValueError('Unknown NBT tag type: {}'.format(tag_type))
+
+    if read('>b') != 10:
+        raise ValueError('NBT data does not start with a compound')
+
+    read_string()
+    return read_payload(10)
+
+
+NBT_NUMBERS = {1: '>b', 2: '>h', 3: '>i', 4: '>q', 5: '>f', 6: '>d'}
+NBT_ARRAYS = {7: '>b', 11: '>i', 12: '>q'}
+
+
+def write_nbt(f, data, name=''):
+    """
+    Writes plain dicts and lists as an uncompressed NBT document. Python types map to the closest tag:
+    ints to Int (Long when they don't fit), floats to Double, bytes to Byte Array
+    """
+
+    def get_type(value):
+        if isinstance(value, dict):
+            return 10
+        if isinstance(value, list):
+            return 9
+        if isinstance(value, (bytes, bytearray)):
+            return 7
+        if isinstance(value, str):
+            return 8
+        if isinstance(value, float):
+            return 6
+        if isinstance(value, int):
+            return 3 if -2 ** 31 <= value < 2 ** 31 else 4
+
+        raise ValueError('Can\'t write {} as NBT'.format(type(value).__name__))
+
+    def write_string(value):
+        value = value.encode('utf-8')
+        f.write(struct.pack('>H', len(value)) + value)
+
+    def write_payload(tag_type, value):
+        if tag_type in NBT_NUMBERS:
+            f.write(struct.pack(NBT_NUMBERS[tag_type], value))
+        elif tag_type == 7:
+            f.write(struct.pack('>i', len(value)) + bytes(value))
+        elif tag_type == 8:
+            write_string(value)
+        elif tag_type == 9:
+            item_type = get_type(value[0]) if value else 0
+            f.write(struct.pack('>bi', item_type, len(value)))
+            for item in value:
+                write_payload(item_type, item)
+        elif tag_type == 10:
+            for key, item in value.items():
+                item_type = get_type(item)
+                f.write(struct.pack('>b', item_type))
+                write_string(key)
+                write_payload(item_type, item)
+            f.write(b'\x00')
+
+    f.write(struct.pack('>b', 10))
+    write_string(name)
+    write_payload(10, data)
+
+
+def read_level_spawn(level_dat_path):
+    # level.dat is gzipped NBT, with the world spawn in `Data.SpawnX` / `Data.SpawnZ`
+    with gzip.open(level_dat_path, 'rb') as f:
+        data = read_nbt(f).get('Data', {})
+
+    return data.get('SpawnX', 0), data.get('SpawnZ', 0)
+
+
+def get_region_coords(block_x, block_z):
+    # Each region file covers 32x32 chunks, or 512x512 blocks
+    return block_x >> 9, block_z >> 9
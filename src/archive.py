@@ -0,0 +1,170 @@
+import bisect
+import hashlib
+import os
+import tarfile
+import zlib
+from pathlib import Path
+from .store import read_manifest, write_manifest
+
+
+def get_index_path(archive_path):
+    return '{}.index'.format(archive_path)
+
+
+class ArchiveIndex:
+    """
+    Sidecar index for a snapshot archive. It maps each file to its offset in the uncompressed tar
+    stream, and each independently compressed gzip block to its offset in the archive, so single
+    files can be pulled out without decompressing everything in front of them
+    """
+
+    def __init__(self, blocks=None, members=None, hashes=None, size=None, checksum=None):
+        self.blocks = blocks or []
+        self.members = members or {}
+        self.hashes = hashes or {}
+        self.size = size
+        self.checksum = checksum
+
+    @classmethod
+    def load(cls, archive_path):
+        data = read_manifest(get_index_path(archive_path))
+        return cls(data['blocks'], data['members'], data.get('hashes'), data.get('size'), data.get('checksum'))
+
+    def save(self, archive_path):
+        write_manifest(get_index_path(archive_path), {
+            'version': 2,
+            'size': self.size,
+            'checksum': self.checksum,
+            'blocks': self.blocks,
+            'members': self.members,
+            'hashes': self.hashes
+        })
+
+    def add_member(self, name, tar_offset, tarinfo, digest=None):
+        # Regular file data ends at the current tar offset, padded to the next 512 byte record
+        padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.members[name] = [tar_offset - padded_size, tarinfo.size, tarinfo.mode, tarinfo.mtime]
+        if digest:
+            self.hashes[name] = digest
+
+    def find_members(self, path):
+        # Match a single file, or everything under a directory
+        path = path.strip('/')
+        prefix = '{}/'.format(path)
+        return sorted(i for i in self.members if i == path or i.startswith(prefix))
+
+    def read_member(self, archive_path, name, out_f):
+        offset, size, _, _ = self.members[name]
+        end = offset + size
+        starts = [i[0] for i in self.blocks]
+
+        with open(archive_path, 'rb') as f:
+            index = max(0, bisect.bisect_right(starts, offset) - 1)
+            while offset < end and index < len(self.blocks):
+                block_start, compressed_offset, compressed_size = self.blocks[index]
+                f.seek(compressed_offset)
+                data = zlib.decompress(f.read(compressed_size), 31)
+
+                chunk = data[offset - block_start:end - block_start]
+                out_f.write(chunk)
+                offset += len(chunk)
+                index += 1
+
+        if offset != end:
+            raise ValueError('Archive ended before the end of {}'.format(name))
+
+    def extract(self, archive_path, name, target_path):
+        _, _, mode, mtime = self.members[name]
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+        # Write next to the target and rename, so a failed read never leaves a half-written file
+        tmp_path = '{}.restore-tmp'.format(target_path)
+        with open(tmp_path, 'wb') as f:
+            self.read_member(archive_path, name, f)
+
+        os.chmod(tmp_path, mode)
+        os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, target_path)
+
+
+class HashingReader:
+    """
+    Wraps a file object and hashes everything read through it, so data can be checksummed by the
+    same read that consumes it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def verify_archive(archive_path, checksum=None, buffer_size=1048576):
+    """
+    Reads a snapshot archive from front to back in a single pass, checking the checksum of the archive
+    itself and of every file in it against the ones recorded when it was written. Returns a list of
+    problems, which is empty for an intact archive
+    """
+
+    problems = []
+    index = None
+    if os.path.exists(get_index_path(archive_path)):
+        try:
+            index = ArchiveIndex.load(archive_path)
+        except Exception as ex:
+            problems.append('unreadable index ({})'.format(str(ex) or type(ex).__name__))
+
+    checksum = checksum or (index.checksum if index else None)
+    if index and index.size is not None and os.path.getsize(archive_path) != index.size:
+        problems.append('size is {} bytes, but {} bytes were written'.format(
+            os.path.getsize(archive_path), index.size))
+
+    seen = set()
+    with open(archive_path, 'rb') as raw:
+        reader = HashingReader(raw)
+        try:
+            with tarfile.open(fileobj=reader, mode='r:gz') as tar:
+                for member in tar:
+                    parts = Path(member.name).parts[1:]
+                    if not parts or not member.isreg():
+                        continue
+
+                    name = os.path.join(*parts)
+                    seen.add(name)
+                    expected = index.hashes.get(name) if index else None
+
+                    f = tar.extractfile(member)
+                    digest = hashlib.sha256()
+                    while True:
+                        data = f.read(buffer_size)
+                        if not data:
+                            break
+                        digest.update(data)
+
+                    if expected and digest.hexdigest() != expected:
+                        problems.append('{} does not match its checksum'.format(name))
+
+            # Whatever follows the end of the tar stream is still part of the archive's checksum
+            while reader.read(buffer_size):
+                pass
+        except (tarfile.TarError, EOFError, OSError, zlib.error) as ex:
+            problems.append('unreadable archive ({})'.format(str(ex) or type(ex).__name__))
+            return problems
+
+    missing = [i for i in (index.hashes if index else []) if i not in seen]
+    if missing:
+        problems.append('{} file(s) missing, including {}'.format(len(missing), missing[0]))
+
+    if checksum and reader.hexdigest() != checksum:
+        problems.append('archive does not match its checksum')
+
+    return problems
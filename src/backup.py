@@ -1,21 +1,83 @@
+import asyncio
+import hashlib
 import os
+import re
 import shutil
+import stat
 import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from time import sleep
-from datetime import datetime
-from pathlib import Path
+from .anvil import is_region_file, read_region_header, read_chunk, read_chunk_prefix, write_region_file
+from .archive import ArchiveIndex, HashingReader, get_index_path, verify_archive
+from .catalog import BackupCatalog, RetentionPolicy, Snapshot
+from .compression import CODECS, CompressionPolicy, ParallelGzipWriter
+from .ignore import IgnoreRules
+from .metrics import MetricsRegistry
+from .utils import clone_file, swap_directories
+from .store import ChunkStore, read_manifest, write_manifest, get_manifest_digests
+from .throttle import BackupThrottle, lower_thread_priority
+
+
+class BackupMode:
+    FULL = 'full'
+    INCREMENTAL = 'incremental'
+    REGION = 'region'
+
+
+class BackupCancelled(Exception):
+    pass
+
 
 class BackupManager:
 
+    backup_extensions = {
+        BackupMode.FULL: '.tar.gz',
+        BackupMode.INCREMENTAL: '.manifest',
+        BackupMode.REGION: '.manifest'
+    }
+
+    # Files smaller than this are compressed with whichever codec the file before them used
+    min_codec_size = 65536
+
+    # gitignore style exclusion rules, read from the server directory
+    ignore_file = '.backupignore'
+
+    # Files the server rewrites even when nothing in the world changed
+    volatile_files = ['session.lock', 'level.dat', 'level.dat_old', 'usercache.json']
+    volatile_dirs = ['logs', 'crash-reports', 'cache']
+
     def __init__(self, server_path, backup_path, excluded_files=None, excluded_file_types=None,
-                 max_backups=10, cwd=None, manager=None):
+                 max_backups=10, cwd=None, manager=None, backup_mode=BackupMode.FULL, chunk_size=1048576,
+                 compression_workers=None, keep_daily=0, keep_weekly=0, keep_monthly=0, read_limit=0, cpu_limit=0,
+                 nice=10, io_priority='low', compression='default', compression_rules=None, compression_sampling=False):
         self.server_path = server_path
         self.backup_path = backup_path
         self.excluded_files = excluded_files or []
         self.excluded_file_types = excluded_file_types or []
         self.max_backups = max_backups if isinstance(max_backups, int) else int(max_backups)
         self.manager = manager
+        self.backup_mode = backup_mode or BackupMode.FULL
+        self.chunk_size = chunk_size if isinstance(chunk_size, int) else int(chunk_size)
+        self.compression_workers = int(compression_workers) if compression_workers else os.cpu_count()
+        self.retention = RetentionPolicy(self.max_backups, keep_daily, keep_weekly, keep_monthly)
+        self.compression_policy = CompressionPolicy(
+            compression or 'default', rules=[i for i in (compression_rules or []) if i], sample=compression_sampling)
+        self.codec_stats = {}
+        self.metrics = getattr(manager, 'metrics', None) or MetricsRegistry()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cancelled = threading.Event()
+
+        # Read bandwidth (bytes per second) and CPU (cores) budgets, plus the priority of compression threads
+        self.read_limit = float(read_limit or 0)
+        self.cpu_limit = float(cpu_limit or 0)
+        self.priority = (int(nice or 0), io_priority)
+        self.throttle = BackupThrottle()
+
+        if self.backup_mode not in self.backup_extensions:
+            raise ValueError('Unknown backup mode: {}'.format(self.backup_mode))
 
         if self.server_path.endswith('.jar'):
             self.server_path = Path(self.server_path).parent.absolute()
@@ -34,6 +96,11 @@ class BackupManager:
 
         self.create_backup_directory()
 
+        # Open the snapshot catalog, indexing any existing backups the first time around
+        self.catalog = BackupCatalog(self.backup_path)
+        if self.catalog.created:
+            self.reindex_catalog()
+
         # Cache the server file names
         self.server_files = self.get_server_files()
 
@@ -44,48 +111,219 @@ class BackupManager:
             return
 
         if (exists and not is_dir) or not exists:
-            os.mkdir(self.backup_path)
+            os.makedirs(self.backup_path)
+
+    def take_snapshot(self, source_dir=None, timestamp=None):
+        # Snapshots can be taken from a staged copy of the server (see `stage_snapshot`), named after when it was staged
+        source_dir = source_dir or self.server_path
 
-    def take_snapshot(self):
         # Make sure our directory exists
         self.create_backup_directory()
 
         # Cache the server file names
         self.cache_server_filenames()
 
-        # Copy JAR files to it
+        # Copy JAR files to it, keeping their modification times so an unchanged JAR isn't replicated again
         self.server_files = self.get_server_files()
         for i in self.server_files:
-            shutil.copyfile(i, os.path.join(self.backup_path, Path(i).name))
+            shutil.copy2(i, os.path.join(self.backup_path, Path(i).name))
 
         # Make the compressed backup
         self.manager.log('Taking snapshot of Minecraft Server...')
-        save_path = os.path.join(self.backup_path, self.get_filename())
-        self.make_tarfile(save_path, self.server_path)
+        save_path = os.path.join(self.backup_path, self.get_filename(timestamp))
+        self.throttle = BackupThrottle(self.read_limit, self.cpu_limit)
+        self.codec_stats = {}
+        start_time = time.monotonic()
+        try:
+            if self.backup_mode in [BackupMode.INCREMENTAL, BackupMode.REGION]:
+                file_count, checksum = self.make_manifest(save_path, source_dir)
+            else:
+                file_count, checksum = self.make_tarfile(save_path, source_dir)
+        except Exception as ex:
+            # Never leave a partial archive behind, where it could pass for a backup
+            for path in [save_path, get_index_path(save_path), '{}.tmp'.format(save_path)]:
+                if os.path.exists(path):
+                    os.unlink(path)
 
-        # Wait 1 second just to make sure the tar is fully written
-        sleep(1)
+            result = 'cancelled' if isinstance(ex, BackupCancelled) else 'failure'
+            self.metrics.counter('minecraft_backups_total', 'Snapshots taken, by result').inc(result=result)
+            raise
+        duration = time.monotonic() - start_time
 
         # Check to make sure the file exists
         if not os.path.exists(save_path):
             self.manager.log("Failed to create snapshot! File not found!")
+            self.metrics.counter('minecraft_backups_total', 'Snapshots taken, by result').inc(result='failure')
             return None
 
         # If it's successful, get the file and log
         size = os.path.getsize(save_path)
         self.manager.log('Successfully took snapshot of the Minecraft Server: {} bytes'.format(size))
+        self.record_snapshot_metrics(duration, size, file_count)
+        self.report_compression()
+        self.report_throttle(duration)
+
+        # Record it in the catalog
+        self.catalog.add(Snapshot(
+            save_path, self.get_timestamp_from_file(os.path.basename(save_path)), mode=self.backup_mode,
+            size=size, duration=duration, file_count=file_count, checksum=checksum))
 
         # If we have maxed out our backups, delete some, starting from the oldest
         self.delete_old_backups()
 
         return save_path
 
-    async def restore_last_snapshot(self, save_current=False):
+    def get_staging_dir(self):
+        # A hidden directory next to the server, so it's on the same filesystem (for hard links and reflinks).
+        # The copy inside has the server directory's name, so it archives exactly like the server itself
+        server_dir = str(self.server_path).rstrip('/')
+        parent, name = os.path.split(server_dir)
+        return os.path.join(parent, '.{}-snapshot'.format(name), name)
+
+    def stage_snapshot(self):
+        """
+        Makes a point-in-time copy of the server to take the snapshot from, so saving only has to be off
+        while it's made. Files unchanged since the last copy are hard linked from it, and the rest are
+        reflinked or copied inside the kernel where possible. The copy is kept for the next snapshot to link to
+        """
+
+        staging_dir = self.get_staging_dir()
+        new_dir = '{}.new'.format(staging_dir)
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.makedirs(new_dir)
+
+        self.cache_server_filenames()
+        self.server_files = self.get_server_files()
+
+        start_time = time.monotonic()
+        methods = {}
+        copied_bytes = 0
+        dirs = [('', self.server_path)]
+        try:
+            for rel_path, path, st in self.walk_server_files(self.server_path):
+                target = os.path.join(new_dir, rel_path)
+                if stat.S_ISDIR(st.st_mode):
+                    os.makedirs(target, exist_ok=True)
+                    dirs.append((rel_path, path))
+                    continue
+
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(path), target)
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                # Staged files are never written to, so an unchanged file can share the previous copy's inode
+                try:
+                    prev = os.lstat(os.path.join(staging_dir, rel_path))
+                    unchanged = stat.S_ISREG(prev.st_mode) and prev.st_size == st.st_size and \
+                        prev.st_mtime_ns == st.st_mtime_ns
+                except OSError:
+                    unchanged = False
+
+                if unchanged:
+                    os.link(os.path.join(staging_dir, rel_path), target)
+                    method = 'hardlink'
+                else:
+                    method = clone_file(path, target)
+                    shutil.copystat(path, target)
+                    copied_bytes += st.st_size
+
+                methods[method] = methods.get(method, 0) + 1
+
+            # Directory times last, as adding files changes them
+            for rel_path, path in reversed(dirs):
+                shutil.copystat(path, os.path.join(new_dir, rel_path))
+
+            # Swap the new copy in for the previous one
+            old_dir = '{}.old'.format(staging_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(staging_dir):
+                os.rename(staging_dir, old_dir)
+            os.rename(new_dir, staging_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(new_dir, ignore_errors=True)
+            raise
+
+        self.manager.log('Staged a copy of the server in {:.1f}s: {} ({} bytes copied)'.format(
+            time.monotonic() - start_time,
+            ', '.join('{} {}'.format(count, method) for method, count in sorted(methods.items())) or 'no files',
+            copied_bytes))
+
+        return staging_dir
+
+    def discard_staging(self):
+        # Removes the staged copy, along with the hidden directory holding it
+        shutil.rmtree(os.path.dirname(self.get_staging_dir()), ignore_errors=True)
+
+    def record_snapshot_metrics(self, duration, size, file_count):
+        labels = {'mode': self.backup_mode}
+        self.metrics.counter('minecraft_backups_total', 'Snapshots taken, by result').inc(result='success')
+        self.metrics.histogram('minecraft_backup_duration_seconds', 'Time spent taking a snapshot').observe(
+            duration, **labels)
+        self.metrics.gauge('minecraft_backup_size_bytes', 'Size of the last snapshot').set(size, **labels)
+        self.metrics.gauge('minecraft_backup_files', 'Files in the last snapshot').set(file_count, **labels)
+        self.metrics.counter('minecraft_backup_read_bytes_total', 'Bytes read into snapshots').inc(
+            self.bytes_in, **labels)
+        self.metrics.counter('minecraft_backup_written_bytes_total', 'Bytes written by snapshots').inc(
+            self.bytes_out, **labels)
+        self.metrics.gauge('minecraft_backup_compression_ratio', 'Bytes read per byte written by the last snapshot').set(
+            round(self.bytes_in / self.bytes_out, 3) if self.bytes_out else 0, **labels)
+        self.metrics.gauge('minecraft_backup_last_success_timestamp_seconds', 'When the last snapshot finished').set(
+            int(time.time()))
+
+    def add_codec_stats(self, level_stats, files):
+        # `level_stats` is input bytes, output bytes and seconds per level, `files` is files per codec
+        codecs = {level: codec for codec, level in CODECS.items()}
+        for level, (bytes_in, bytes_out, seconds) in level_stats.items():
+            stats = self.codec_stats.setdefault(codecs.get(level, str(level)), [0, 0, 0, 0])
+            stats[1] += bytes_in
+            stats[2] += bytes_out
+            stats[3] += seconds
+
+        for codec, count in files.items():
+            self.codec_stats.setdefault(codec, [0, 0, 0, 0])[0] += count
+
+    def report_compression(self):
+        if not self.codec_stats:
+            return
+
+        codec_bytes = self.metrics.counter('minecraft_backup_codec_bytes_total', 'Bytes compressed by snapshots, by codec')
+        codec_seconds = self.metrics.counter(
+            'minecraft_backup_codec_seconds_total', 'Time snapshots spent compressing, by codec')
+
+        parts = []
+        for codec, (files, bytes_in, bytes_out, seconds) in sorted(self.codec_stats.items()):
+            codec_bytes.inc(bytes_in, codec=codec, stage='in')
+            codec_bytes.inc(bytes_out, codec=codec, stage='out')
+            codec_seconds.inc(seconds, codec=codec)
+            parts.append('{}: {} file(s), {:.1f} MB -> {:.1f} MB ({:.2f}x) in {:.1f}s{}'.format(
+                codec, files, bytes_in / 1048576, bytes_out / 1048576, bytes_in / bytes_out if bytes_out else 0,
+                seconds, ' ({:.1f} MB/s)'.format(bytes_in / seconds / 1048576) if seconds else ''))
+
+        self.manager.log('Compression by codec | {}'.format(' | '.join(parts)))
+
+    def report_throttle(self, duration):
+        if not self.throttle.enabled:
+            return
+
+        throttled = self.metrics.counter('minecraft_backup_throttle_seconds_total', 'Time snapshots spent waiting on budgets')
+        throttled.inc(self.throttle.read_wait, budget='read')
+        throttled.inc(self.throttle.cpu_wait, budget='cpu')
+
+        waited = self.throttle.read_wait + self.throttle.cpu_wait
+        self.manager.log('Throttling added {:.1f}s to the {:.1f}s snapshot ({:.1f}s on the read budget, {:.1f}s on the '
+                         'CPU budget). Unthrottled it would have taken about {:.1f}s'.format(
+                             waited, duration, self.throttle.read_wait, self.throttle.cpu_wait, duration - waited))
+
+    async def restore_last_snapshot(self, save_current=False, staged=False):
         # Make sure we have at least one backup
         latest = self.get_most_recent_backup()
         if not latest:
             self.manager.log('Please take a snapshot before trying to restore to one...', level='warn')
-            return
+            return None
 
         # Get the server JAR files
         server_dir = self.manager.get_jar_dir()
@@ -93,82 +331,626 @@ class BackupManager:
 
         # If we want to save our current state
         if save_current:
-            await self.manager.command_handler('backup-now')
+            await self.manager.handle_command('backup-now')
 
-        # Stop the server
-        await self.manager.stop_server()
+        # Unpacking is blocking disk work, so keep it off of the event loop
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        staging_dir = None
+        if staged:
+            # Unpack while the server is still up, on the low priority backup threads, so the server only
+            # has to be down for the swap itself
+            staging_dir = await loop.run_in_executor(
+                getattr(self.manager, 'backup_executor', None), self.prepare_restore, latest, server_dir)
+            self.manager.log('Snapshot staged in {:.1f}s, stopping the server to swap it in...'.format(
+                time.monotonic() - start_time))
 
-        # Delete the old server files
-        if os.path.exists(server_dir):
-            shutil.rmtree(server_dir)
+        try:
+            # Stop the server
+            await self.manager.stop_server()
+            stopped_at = time.monotonic()
 
-        # Re-make the directory
-        if not os.path.exists(server_dir):
-            os.mkdir(server_dir)
+            if not staging_dir:
+                staging_dir = await loop.run_in_executor(None, self.prepare_restore, latest, server_dir)
+            await loop.run_in_executor(None, self.swap_in_restore, staging_dir, server_dir)
+        except Exception:
+            if staging_dir:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
 
-        # Unzip the latest snapshot
-        latest_unzipped = latest.replace('.tar.gz', '')
-        with tarfile.open(latest, "r:gz") as tar:
-            tar.extractall(latest_unzipped)
+        self.metrics.histogram('minecraft_restore_duration_seconds', 'Time spent restoring snapshots').observe(
+            time.monotonic() - start_time, kind='snapshot')
 
-        # Copy latest snapshot to the directory
-        shutil.copytree(
-            os.path.join(latest_unzipped, Path(server_dir).name), server_dir, dirs_exist_ok=True)
+        # When the server went down, so the caller can tell how long players were kept out
+        return stopped_at
 
-        # Copy the server JARs back over
-        for i in self.server_files:
-            shutil.copyfile(os.path.join(self.backup_path, Path(i).name), i)
+    def restore_snapshot(self, snapshot, server_dir):
+        start_time = time.monotonic()
+        staging_dir = self.prepare_restore(snapshot, server_dir)
+
+        # Swap the restored files in for the live ones. Nothing is going to start the server here, so the old
+        # ones aren't kept around
+        try:
+            self.swap_in_restore(staging_dir, server_dir)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
 
-        # Cleanup the unzipped files
-        shutil.rmtree(latest_unzipped)
+        self.discard_old_server(server_dir)
 
-    def _file_filter(self, tarinfo):
-        # Skip over excluded files
-        if tarinfo.name in self.excluded_files:
-            return None
+        self.metrics.histogram('minecraft_restore_duration_seconds', 'Time spent restoring snapshots').observe(
+            time.monotonic() - start_time, kind='snapshot')
 
-        # Skip over cache files. These will be redownloaded
-        if '/cache/' in tarinfo.name:
-            return None
+    def prepare_restore(self, snapshot, server_dir):
+        # Unpack the snapshot next to the live server, so the live files stay untouched until it's ready
+        staging_dir = self.extract_snapshot(snapshot, server_dir)
+
+        try:
+            # Never swap in files that don't match what was backed up
+            problems = self.verify_restored_files(snapshot, staging_dir)
+            if problems:
+                raise ValueError('{} file(s) unpacked from {} do not match it: {}'.format(
+                    len(problems), snapshot, '; '.join(problems[:5])))
+
+            # Copy the server JARs back over
+            for i in self.server_files:
+                shutil.copyfile(os.path.join(self.backup_path, Path(i).name), os.path.join(staging_dir, Path(i).name))
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        return staging_dir
+
+    def restore_files(self, snapshot, path, target_dir=None):
+        target_dir = target_dir or self.manager.get_jar_dir()
+
+        # Incremental snapshots already know where every file's chunks are
+        if self.is_manifest(snapshot):
+            return self.restore_manifest(snapshot, target_dir, path=path)
+
+        # Archives with an index can seek straight to the requested files
+        if os.path.exists(get_index_path(snapshot)):
+            index = ArchiveIndex.load(snapshot)
+            names = index.find_members(path)
+            for name in names:
+                index.extract(snapshot, name, os.path.join(target_dir, name))
+
+            return len(names)
+
+        # Older archives have no index, so the whole archive has to be read
+        self.manager.log('{} has no index, reading the whole archive...'.format(snapshot), level='warn')
+        path = path.strip('/')
+        count = 0
+        with tarfile.open(snapshot, "r:gz") as tar:
+            for member in tar:
+                name = os.path.join(*Path(member.name).parts[1:]) if len(Path(member.name).parts) > 1 else ''
+                if not member.isreg() or not (name == path or name.startswith('{}/'.format(path))):
+                    continue
+
+                member.name = name
+                tar.extract(member, target_dir)
+                count += 1
+
+        return count
+
+    def find_backup(self, name=None):
+        if not name or name == 'latest':
+            return self.get_most_recent_backup()
+
+        # Snapshots can be referred to by timestamp, or by filename
+        if name.isdigit():
+            snapshot = self.catalog.get(int(name))
+            return snapshot.path if snapshot else None
+
+        path = os.path.join(self.backup_path, os.path.basename(name))
+        return path if os.path.exists(path) else None
+
+    def extract_snapshot(self, snapshot, server_dir):
+        staging_dir = '{}.restore-{}'.format(server_dir, self.current_time())
+        os.mkdir(staging_dir)
+
+        try:
+            if self.is_manifest(snapshot):
+                # Incremental snapshots are rebuilt straight from the chunk store
+                self.restore_manifest(snapshot, staging_dir)
+            else:
+                self.extract_tarfile(snapshot, staging_dir)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        return staging_dir
+
+    def extract_tarfile(self, snapshot, target_dir):
+        # Read the archive front to back in a single pass, dropping the top-level server directory from each
+        # member. (The "r|gz" stream mode can't be used, as it stops after the first of our parallel gzip members)
+        count = 0
+        with tarfile.open(snapshot, "r:gz") as tar:
+            for member in tar:
+                parts = Path(member.name).parts[1:]
+                if not parts:
+                    continue
+                if member.name.startswith('/') or '..' in parts:
+                    raise ValueError('Refusing to extract unsafe path from snapshot: {}'.format(member.name))
+
+                member.name = os.path.join(*parts)
+                tar.extract(member, target_dir)
+                count += 1
+
+        self.manager.log('Extracted {} file(s) from {}'.format(count, snapshot), level='debug')
+
+    def swap_server_directory(self, staging_dir, server_dir):
+        # If the backups live inside the server directory, carry them over to the restored one
+        backup_dir = os.path.abspath(self.backup_path).rstrip('/')
+        nested_backups = backup_dir.startswith('{}/'.format(str(server_dir).rstrip('/')))
+        if nested_backups:
+            restored_backup_dir = os.path.join(staging_dir, os.path.relpath(backup_dir, server_dir))
+            if os.path.exists(restored_backup_dir):
+                shutil.rmtree(restored_backup_dir)
+            os.makedirs(os.path.dirname(restored_backup_dir), exist_ok=True)
+            os.rename(backup_dir, restored_backup_dir)
+
+        try:
+            swap_directories(staging_dir, server_dir)
+        except Exception:
+            if nested_backups:
+                os.rename(restored_backup_dir, backup_dir)
+            raise
+
+    def swap_in_restore(self, staging_dir, server_dir):
+        # The old server files are kept next to the restored ones until the restored server has started, so a
+        # restore that doesn't work out can be swapped back
+        self.discard_old_server(server_dir)
+        self.swap_server_directory(staging_dir, server_dir)
+        os.rename(staging_dir, self.get_old_server_dir(server_dir))
+
+    def roll_back_restore(self, server_dir):
+        # Put the server files from before the restore back, and drop the restored ones
+        old_dir = self.get_old_server_dir(server_dir)
+        self.swap_server_directory(old_dir, server_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def discard_old_server(self, server_dir):
+        shutil.rmtree(self.get_old_server_dir(server_dir), ignore_errors=True)
+
+    def get_old_server_dir(self, server_dir):
+        return '{}.old'.format(str(server_dir).rstrip('/'))
+
+    def verify_restored_files(self, snapshot, target_dir):
+        """
+        Checks unpacked files against the hashes recorded when the snapshot was taken. Returns a list of
+        problems, which is empty when everything matches (or for older archives, which recorded no hashes)
+        """
+
+        problems = []
+        if self.is_manifest(snapshot):
+            store = self.get_chunk_store()
+            expected = {i['path']: i for i in read_manifest(snapshot).get('files', []) if 'link' not in i}
+        elif os.path.exists(get_index_path(snapshot)):
+            store = None
+            expected = ArchiveIndex.load(snapshot).hashes
+        else:
+            return problems
+
+        for name, item in expected.items():
+            path = os.path.join(target_dir, name)
+            try:
+                if store is None:
+                    digest = hashlib.sha256()
+                    with open(path, 'rb') as f:
+                        for data in iter(lambda: f.read(1048576), b''):
+                            digest.update(data)
+                    matches = digest.hexdigest() == item
+                elif 'region' in item:
+                    # Region files are checked chunk by chunk, the same way they were stored
+                    with open(path, 'rb') as f:
+                        matches = all(hashlib.sha256(read_chunk(f, i[1], i[2])).hexdigest() == i[4]
+                                      for i in item['region'])
+                else:
+                    matches = [hashlib.sha256(i).hexdigest() for i in store.read_chunks(path)] == item['chunks']
+            except OSError:
+                problems.append('{} is missing'.format(name))
+                continue
+
+            if not matches:
+                problems.append('{} is corrupt'.format(name))
+
+        return problems
+
+    def get_ignore_rules(self, source_dir):
+        root_name = os.path.basename(source_dir)
+
+        # Cache directories are redownloaded, and server JARs are kept separately
+        patterns = ['cache/'] + [re.sub(r'([*?\[\\])', r'\\\1', Path(i).name) for i in self.server_files or []]
+        patterns += ['*{}'.format(i) for i in self.excluded_file_types]
+
+        # Excluded files used to be matched against archive names, which start with the server directory's name
+        patterns += [i[len(root_name) + 1:] if i.startswith(root_name + '/') else i for i in self.excluded_files]
+
+        return IgnoreRules(patterns).read(os.path.join(source_dir, self.ignore_file))
+
+    def make_tarfile(self, output_filename, source_dir):
+        self.archived_files = 0
+        root_name = os.path.basename(source_dir)
+        index = ArchiveIndex()
+        policy = self.compression_policy
+        codec = policy.codec
+        files = {}
+
+        # Compression threads get the same lowered priority as the backup worker
+        with open(output_filename, 'wb') as f, ParallelGzipWriter(
+                f, workers=self.compression_workers, level=CODECS[codec], initializer=lower_thread_priority,
+                initargs=self.priority) as gz:
+            with tarfile.open(fileobj=gz, mode='w|') as tar:
+                tar.add(source_dir, arcname=root_name, recursive=False)
+
+                for rel_path, path, _ in self.walk_server_files(source_dir):
+                    tarinfo = tar.gettarinfo(path, arcname=os.path.join(root_name, rel_path))
+                    if not tarinfo.isreg():
+                        tar.addfile(tarinfo)
+                        continue
+
+                    # Switching codecs ends a gzip block, so small files just go along with the current codec,
+                    # unless that's `store` and they'd compress
+                    if tarinfo.size >= self.min_codec_size:
+                        file_codec = policy.get_codec(rel_path, path, tarinfo.size)
+                    else:
+                        file_codec = codec if codec != 'store' else policy.get_codec(rel_path)
+
+                    if file_codec != codec:
+                        gz.set_level(CODECS[file_codec], tar.offset)
+                        codec = file_codec
+                    files[codec] = files.get(codec, 0) + 1
+                    self.archived_files += 1
 
-        # Skip over server JARs
-        skip_files = [Path(i).name for i in (self.server_files or [])]
-        if Path(tarinfo.name).name in skip_files:
+                    # Hash each file as it's read into the archive, so verifying it later costs no extra reads now
+                    with self.throttle.open(path) as member:
+                        member = HashingReader(member)
+                        tar.addfile(tarinfo, member)
+
+                    # Record where the file's data landed in the tar stream
+                    index.add_member(rel_path, tar.offset, tarinfo, member.hexdigest())
+
+        index.blocks = gz.blocks
+        index.size = gz.bytes_out
+        index.checksum = gz.checksum.hexdigest()
+        index.save(output_filename)
+        self.bytes_in, self.bytes_out = gz.bytes_in, gz.bytes_out
+        self.add_codec_stats(gz.level_stats, files)
+
+        self.manager.log('Compressed {} bytes to {} bytes using {} worker(s)'.format(
+            gz.bytes_in, gz.bytes_out, gz.workers), level='debug')
+
+        return self.archived_files, gz.checksum.hexdigest()
+
+    def get_chunk_store(self):
+        return ChunkStore(os.path.join(self.backup_path, 'store'), chunk_size=self.chunk_size)
+
+    def has_changes_since(self, timestamp):
+        # Stops at the first changed file, so an active world answers almost immediately
+        for rel_path, _, st in self.walk_server_files(self.server_path):
+            parts = Path(rel_path).parts
+            if parts[0] in self.volatile_dirs or parts[-1] in self.volatile_files or stat.S_ISDIR(st.st_mode):
+                continue
+
+            if st.st_mtime >= timestamp:
+                return True
+
+        return False
+
+    def get_last_snapshot_time(self):
+        newest = self.catalog.newest()
+        return newest.timestamp if newest else None
+
+    def cancel(self):
+        # Stops a running snapshot or staging copy at the next file (from any thread)
+        self.cancelled.set()
+
+    def walk_server_files(self, source_dir):
+        # The rules are compiled once per walk, and excluded directories are never descended into
+        rules = self.get_ignore_rules(source_dir)
+        backup_dir = os.path.abspath(self.backup_path).rstrip('/')
+
+        for dir_path, dir_names, file_names in os.walk(source_dir):
+            rel_dir = os.path.relpath(dir_path, source_dir)
+            rel_dir = '' if rel_dir == '.' else rel_dir + os.sep
+
+            # Never back up the backup directory itself, if it lives inside the server
+            dir_names[:] = sorted(
+                i for i in dir_names if not rules.is_excluded(rel_dir + i, is_dir=True) and
+                os.path.abspath(os.path.join(dir_path, i)) != backup_dir)
+
+            for name in dir_names:
+                yield rel_dir + name, os.path.join(dir_path, name), os.lstat(os.path.join(dir_path, name))
+
+            for name in sorted(file_names):
+                if self.cancelled.is_set():
+                    raise BackupCancelled()
+
+                if not rules.is_excluded(rel_dir + name):
+                    yield rel_dir + name, os.path.join(dir_path, name), os.lstat(os.path.join(dir_path, name))
+
+    def make_manifest(self, output_filename, source_dir):
+        store = self.get_chunk_store()
+
+        # Index the previous snapshot so unchanged files can be skipped without reading them
+        previous = self.get_previous_manifest()
+        previous_files = {i['path']: i for i in previous.get('files', [])} if previous else {}
+
+        manifest = {
+            'version': 1,
+            'timestamp': self.get_timestamp_from_file(os.path.basename(output_filename)),
+            'root': os.path.basename(source_dir),
+            'chunk_size': store.chunk_size,
+            'dirs': [],
+            'files': []
+        }
+
+        reused_files = 0
+        new_chunks = 0
+        new_bytes = 0
+        files = {}
+        for rel_path, path, st in self.walk_server_files(source_dir):
+            if stat.S_ISDIR(st.st_mode):
+                manifest['dirs'].append({'path': rel_path, 'mode': stat.S_IMODE(st.st_mode)})
+                continue
+
+            item = {
+                'path': rel_path,
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'mode': stat.S_IMODE(st.st_mode)
+            }
+
+            if stat.S_ISLNK(st.st_mode):
+                item['link'] = os.readlink(path)
+                manifest['files'].append(item)
+                continue
+
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            prev = previous_files.get(rel_path)
+            if prev and 'link' not in prev and prev['size'] == st.st_size and prev['mtime_ns'] == st.st_mtime_ns:
+                for key in ['chunks', 'region']:
+                    if key in prev:
+                        item[key] = prev[key]
+                reused_files += 1
+            else:
+                codec = self.compression_policy.get_codec(rel_path, path, st.st_size)
+                files[codec] = files.get(codec, 0) + 1
+
+                if self.backup_mode == BackupMode.REGION and is_region_file(path, st.st_size):
+                    try:
+                        item['region'], chunks, written = self.store_region_chunks(
+                            store, path, st.st_size, st.st_mtime_ns, prev, CODECS[codec])
+                    except ValueError as ex:
+                        self.manager.log('Unable to read region file, {} ({}). Storing it as a regular file...'.format(
+                            rel_path, str(ex)), level='warn')
+                        item['chunks'], chunks, written = self.store_file_chunks(store, path, CODECS[codec])
+                else:
+                    item['chunks'], chunks, written = self.store_file_chunks(store, path, CODECS[codec])
+
+                new_chunks += chunks
+                new_bytes += written
+
+            manifest['files'].append(item)
+
+        write_manifest(output_filename, manifest)
+        self.add_codec_stats(store.level_stats, files)
+        self.bytes_in = sum(i['size'] for i in manifest['files'] if 'link' not in i)
+        self.bytes_out = new_bytes + os.path.getsize(output_filename)
+        self.manager.log('Snapshot manifest written: {} file(s), {} unchanged, {} new chunk(s) ({} bytes)'.format(
+            len(manifest['files']), reused_files, new_chunks, new_bytes))
+
+        with open(output_filename, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        return len(manifest['files']), checksum
+
+    def store_file_chunks(self, store, path, level=None):
+        digests = []
+        new_chunks = 0
+        new_bytes = 0
+        for data in store.read_chunks(path, opener=self.throttle.open):
+            digest, written = store.put(data, level)
+            digests.append(digest)
+            if written:
+                new_chunks += 1
+                new_bytes += written
+
+        return digests, new_chunks, new_bytes
+
+    def store_region_chunks(self, store, path, size, mtime_ns, prev, level=None):
+        """
+        Stores a region file chunk by chunk. A chunk whose location, save timestamp, length and compression
+        type match the previous snapshot hasn't been touched and isn't read again. Save timestamps are in
+        seconds, so a chunk saved in the same second the file was read could still be rewritten without
+        them changing: its entry gets no prefix, and it's read again (and deduplicated) next time
+        """
+
+        previous_chunks = {i[0]: i for i in (prev or {}).get('region', [])}
+        mtime = mtime_ns // 1000000000
+
+        entries = []
+        new_chunks = 0
+        new_bytes = 0
+        with self.throttle.open(path) as f:
+            for index, offset, count, timestamp in read_region_header(f, size):
+                prefix = read_chunk_prefix(f, offset)
+                previous = previous_chunks.get(index)
+                if previous and previous[1:4] == [offset, count, timestamp] and previous[5:] == [prefix]:
+                    entries.append(previous)
+                    continue
+
+                digest, written = store.put(read_chunk(f, offset, count), level)
+                entries.append([index, offset, count, timestamp, digest, prefix if timestamp < mtime else None])
+                if written:
+                    new_chunks += 1
+                    new_bytes += written
+
+        return entries, new_chunks, new_bytes
+
+    def get_previous_manifest(self):
+        latest = self.get_most_recent_backup(mode=BackupMode.INCREMENTAL)
+        if not latest:
             return None
 
-        # Skip over specific file types
-        if any(tarinfo.name.endswith(i) for i in self.excluded_file_types):
+        try:
+            return read_manifest(latest)
+        except Exception:
+            self.manager.log('Unable to read previous manifest, {}. Reading all files...'.format(latest), level='warn')
             return None
 
-        return tarinfo
+    def restore_manifest(self, manifest_path, target_dir, path=None):
+        store = self.get_chunk_store()
+        manifest = read_manifest(manifest_path)
+        dirs = manifest.get('dirs', [])
+        files = manifest.get('files', [])
 
-    def make_tarfile(self, output_filename, source_dir):
-        with tarfile.open(output_filename, "w:gz") as tar:
-            tar.add(source_dir, arcname=os.path.basename(source_dir), filter=self._file_filter)
+        # Optionally only restore a single file, or everything under a directory
+        if path:
+            path = path.strip('/')
+            prefix = '{}/'.format(path)
+            dirs = [i for i in dirs if i['path'] == path or i['path'].startswith(prefix)]
+            files = [i for i in files if i['path'] == path or i['path'].startswith(prefix)]
+
+        for item in dirs:
+            os.makedirs(os.path.join(target_dir, item['path']), exist_ok=True)
+
+        for item in files:
+            file_path = os.path.join(target_dir, item['path'])
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            # Write next to the target and rename, so a failed restore never leaves a half-written file
+            tmp_path = '{}.restore-tmp'.format(file_path)
+            if 'link' in item:
+                os.symlink(item['link'], tmp_path)
+                os.replace(tmp_path, file_path)
+                continue
+
+            if 'region' in item:
+                write_region_file(tmp_path, item['size'], item['region'], store.get)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    for digest in item['chunks']:
+                        f.write(store.get(digest))
+
+            os.chmod(tmp_path, item['mode'])
+            os.utime(tmp_path, ns=(item['mtime_ns'], item['mtime_ns']))
+            os.replace(tmp_path, file_path)
+
+        # Directory modes are applied last so read-only directories don't block the files inside them
+        for item in dirs:
+            os.chmod(os.path.join(target_dir, item['path']), item['mode'])
+
+        return len(files)
+
+    def collect_garbage(self):
+        store_path = os.path.join(self.backup_path, 'store')
+        if not os.path.isdir(store_path):
+            return
+
+        referenced = set()
+        for snapshot in self.catalog.list():
+            if not self.is_manifest(snapshot.path) or not os.path.exists(snapshot.path):
+                continue
+
+            referenced.update(get_manifest_digests(read_manifest(snapshot.path)))
+
+        removed = self.get_chunk_store().collect_garbage(referenced)
+        if removed:
+            self.manager.log('Removed {} unreferenced chunk(s) from the backup store'.format(removed))
+
+    def verify_backups(self, workers=None):
+        """
+        Checks every snapshot in the catalog, spread over one thread per core (decompression and hashing
+        both release the GIL). Returns a list of `(snapshot, problems)`, with no problems for intact ones
+        """
+
+        # Biggest first, so one large archive doesn't end up running on its own at the end
+        snapshots = sorted(self.catalog.list(), key=lambda i: i.size or 0, reverse=True)
+        workers = max(1, int(workers or os.cpu_count() or 1))
+        store = self.get_chunk_store() if any(self.is_manifest(i.path) for i in snapshots) else None
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify', initializer=lower_thread_priority,
+                                initargs=self.priority) as executor:
+            results = list(zip(snapshots, executor.map(lambda i: self.verify_snapshot(i, store), snapshots)))
+
+            # Chunks are shared between incremental snapshots, so each one is only checked once
+            referenced = {}
+            for snapshot, (problems, digests) in results:
+                for digest in digests:
+                    referenced.setdefault(digest, []).append(snapshot.path)
+
+            bad_chunks = []
+            if store:
+                bad_chunks = [i for i, ok in zip(referenced, executor.map(store.verify, referenced)) if not ok]
+
+        problems_by_path = {snapshot.path: problems for snapshot, (problems, _) in results}
+        for digest in bad_chunks:
+            for path in referenced[digest]:
+                problems_by_path[path].append('chunk {} is missing or corrupt'.format(digest[:12]))
+
+        return [(snapshot, problems_by_path[snapshot.path]) for snapshot, _ in results]
+
+    def verify_snapshot(self, snapshot, store=None):
+        if not os.path.exists(snapshot.path):
+            return ['file is missing'], []
+
+        if not self.is_manifest(snapshot.path):
+            return verify_archive(snapshot.path, snapshot.checksum), []
+
+        # Incremental snapshots are checked here, and the chunks they point at by the caller
+        problems = []
+        if snapshot.checksum:
+            with open(snapshot.path, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != snapshot.checksum:
+                    problems.append('manifest does not match its checksum')
+
+        try:
+            return problems, get_manifest_digests(read_manifest(snapshot.path))
+        except Exception as ex:
+            return problems + ['unreadable manifest ({})'.format(str(ex) or type(ex).__name__)], []
+
+    def get_snapshot_files(self, file_path):
+        # Every file a snapshot needs, relative to the backup directory: the server JARs restores copy back, then
+        # its data. The snapshot itself comes last, so a copy of it is never without what it points at
+        files = [Path(i).name for i in self.server_files
+                 if os.path.exists(os.path.join(self.backup_path, Path(i).name))]
+        if self.is_manifest(file_path):
+            store = self.get_chunk_store()
+            files += [os.path.relpath(store.get_object_path(i), self.backup_path).replace(os.sep, '/')
+                      for i in sorted(get_manifest_digests(read_manifest(file_path)))]
+        elif os.path.exists(get_index_path(file_path)):
+            files.append(os.path.basename(get_index_path(file_path)))
+
+        return files + [os.path.basename(file_path)]
 
     def delete_old_backups(self):
-        backup_count = self.get_backup_count()
-        old_backups = 0 if (
-                backup_count == self.max_backups or backup_count < self.max_backups
-            ) else backup_count - self.max_backups
+        expired = self.retention.get_expired(self.catalog.list())
         success = 0
 
-        if old_backups == 0:
+        if not expired:
             return
 
-        self.manager.log('Deleting {} old backup(s)...'.format(old_backups))
-        for _ in range(old_backups):
-            oldest = self.get_oldest_backup()
-
+        self.manager.log('Deleting {} old backup(s) (keeping {})...'.format(len(expired), self.retention.describe()))
+        for snapshot in expired:
             try:
-                os.unlink(oldest)
+                for path in [snapshot.path, get_index_path(snapshot.path)]:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                self.catalog.remove(snapshot.path)
                 success += 1
             except:
                 pass
 
         self.manager.log('Successfully deleted {} old backup(s)...'.format(success))
 
-    def get_backup_count(self):
+        # Drop any chunks that only the deleted snapshots referenced
+        self.collect_garbage()
+
+    def reindex_catalog(self):
         count = 0
         for entry in os.scandir(self.backup_path):
             # Skip over any non-backup files
@@ -180,28 +962,22 @@ class BackupManager:
             if ts is None:
                 continue
 
+            mode = BackupMode.INCREMENTAL if self.is_manifest(entry.name) else BackupMode.FULL
+            self.catalog.add(Snapshot(entry.path, ts, mode=mode, size=entry.stat().st_size))
             count += 1
 
-        return count
+        if count:
+            self.manager.log('Indexed {} existing backup(s) into the backup catalog'.format(count))
 
-    def get_oldest_backup(self):
-        oldest = self.current_time()
-        oldest_backup = None
-        for entry in os.scandir(self.backup_path):
-            # Skip over any non-backup files
-            if not self.is_backup_file(entry):
-                continue
+    def list_backups(self):
+        return self.catalog.list()
 
-            # Pull out the timestamp
-            ts = self.get_timestamp_from_file(entry.name)
-            if ts is None:
-                continue
-
-            if ts < oldest:
-                oldest = ts
-                oldest_backup = entry.path
+    def get_backup_count(self):
+        return self.catalog.count()
 
-        return oldest_backup
+    def get_oldest_backup(self):
+        oldest = self.catalog.oldest()
+        return oldest.path if oldest else None
 
     def get_server_files(self, root_path=None):
         server_files = []
@@ -214,27 +990,16 @@ class BackupManager:
 
         return server_files
 
-    def get_most_recent_backup(self):
-        newest = 0
-        newest_backup = None
-        for entry in os.scandir(self.backup_path):
-            # Skip over any non-backup files
-            if not self.is_backup_file(entry):
-                continue
-
-            # Pull out the timestamp
-            ts = self.get_timestamp_from_file(entry.name)
-            if ts is None:
-                continue
-
-            if ts > newest:
-                newest = ts
-                newest_backup = entry.path
-
-        return newest_backup
+    def get_most_recent_backup(self, mode=None):
+        # Optionally only look at backups of one kind
+        newest = self.catalog.newest(extension=self.backup_extensions[mode] if mode else None)
+        return newest.path if newest else None
 
     def get_timestamp_from_file(self, filename):
-        parts = filename.replace('.tar.gz', '').split('-')
+        for ext in self.backup_extensions.values():
+            filename = filename.replace(ext, '')
+
+        parts = filename.split('-')
         ts = parts[2]
 
         try:
@@ -249,12 +1014,16 @@ class BackupManager:
     def is_backup_file(self, file_item):
         return (
             file_item.name.startswith('minecraft-backup-') and
-            file_item.name.endswith('.tar.gz') and
+            any(file_item.name.endswith(i) for i in self.backup_extensions.values()) and
             file_item.is_file()
         )
 
-    def get_filename(self):
-        return 'minecraft-backup-{}.tar.gz'.format(self.current_time())
+    def is_manifest(self, filename):
+        return str(filename).endswith(self.backup_extensions[BackupMode.INCREMENTAL])
+
+    def get_filename(self, timestamp=None):
+        return 'minecraft-backup-{}{}'.format(timestamp or self.current_time(), self.backup_extensions[self.backup_mode])
 
     def current_time(self):
-        return int(datetime.utcnow().timestamp())
\ No newline at end of file
+        # Real epoch seconds, comparable with file times whatever the host's time zone
+        return int(time.time())
\ No newline at end of file
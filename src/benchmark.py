@@ -0,0 +1,515 @@
+import asyncio
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+from datetime import datetime
+import click
+from .anvil import SECTOR_SIZE, CHUNKS_PER_REGION, read_region_header, write_nbt, write_region_file
+from .backup import BackupManager, BackupMode
+from .catalog import Snapshot
+
+MB = 1048576
+
+
+class SyntheticWorld:
+    """
+    Generates a server directory that looks like a real one to the backup code: Anvil region files full
+    of zlib compressed chunks, player data, logs, and server and plugin jars (which, like real jars, don't
+    compress). It can also generate a web map's tile tree, excluded by a `.backupignore`. The same seed
+    always generates the same world
+    """
+
+    def __init__(self, root, regions=16, chunks_per_region=512, players=50, log_files=10, log_size=1 * MB,
+                 plugins=5, plugin_size=2 * MB, tiles=0, seed=0):
+        self.root = root
+        self.regions = regions
+        self.chunks_per_region = min(CHUNKS_PER_REGION, chunks_per_region)
+        self.players = players
+        self.log_files = log_files
+        self.log_size = log_size
+        self.plugins = plugins
+        self.plugin_size = plugin_size
+        self.tiles = tiles
+        self.random = random.Random(seed)
+        self.log_lines = None
+
+        # Chunk sections are built from a shared pool, so chunks compress about as well as real ones do
+        palette = bytes(range(16))
+        self.sections = [
+            bytes(self.random.choices(palette, weights=[60, 12, 8, 6, 4, 2, 2, 1, 1, 1, 1, 1, 1, 1, 1, 1], k=4096))
+            for _ in range(64)]
+
+    @property
+    def jar_path(self):
+        return os.path.join(self.root, 'server.jar')
+
+    def generate(self):
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+        region_dir = os.path.join(self.root, 'world', 'region')
+        os.makedirs(region_dir)
+
+        self.write_random_file(self.jar_path, self.plugin_size)
+        for i in range(self.plugins):
+            self.write_random_file(os.path.join(self.root, 'plugins', 'plugin-{}.jar'.format(i)), self.plugin_size)
+
+        with open(os.path.join(self.root, 'server.properties'), 'w') as f:
+            f.write('level-name=world\nmotd=Benchmark\nview-distance=10\n')
+
+        with gzip.open(os.path.join(self.root, 'world', 'level.dat'), 'wb') as f:
+            write_nbt(f, {'Data': {'LevelName': 'world', 'SpawnX': 0, 'SpawnY': 64, 'SpawnZ': 0,
+                                   'Time': self.random.randrange(10 ** 7)}})
+
+        # Regions spiral out from spawn, like an explored world
+        side = max(1, int(self.regions ** 0.5 + 0.999))
+        for i in range(self.regions):
+            x, z = i % side - side // 2, i // side - side // 2
+            self.write_region(os.path.join(region_dir, 'r.{}.{}.mca'.format(x, z)))
+
+        for _ in range(self.players):
+            self.write_player(str(uuid.UUID(int=self.random.getrandbits(128))))
+
+        log_dir = os.path.join(self.root, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        for i in range(self.log_files):
+            with gzip.open(os.path.join(log_dir, '2021-01-{:02d}-1.log.gz'.format(i % 28 + 1)), 'wt') as f:
+                f.write(self.make_log(self.log_size))
+        with open(os.path.join(log_dir, 'latest.log'), 'w') as f:
+            f.write(self.make_log(self.log_size))
+
+        if self.tiles:
+            self.write_tiles(os.path.join(self.root, 'plugins', 'dynmap', 'web', 'tiles'))
+            with open(os.path.join(self.root, '.backupignore'), 'w') as f:
+                f.write('# Rendered map tiles can be rendered again\nplugins/dynmap/web/tiles/\n')
+
+        return self
+
+    def write_tiles(self, tile_dir):
+        # Lots of tiny files, 256 to a directory, like dynmap's (or BlueMap's) rendered tiles
+        for i in range(self.tiles):
+            path = os.path.join(tile_dir, 'world', 'flat', '{}_{}'.format(i // 4096, i // 256 % 16))
+            if i % 256 == 0:
+                os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, '{}.png'.format(i % 256)), 'wb') as f:
+                f.write(self.random.randbytes(64))
+
+    def make_chunk(self):
+        # A length, the compression type (2, zlib), and the compressed chunk
+        sections = [self.random.choice(self.sections) for _ in range(self.random.randint(4, 12))]
+        data = zlib.compress(self.random.randbytes(512) + b''.join(sections), 6)
+        return struct.pack('>IB', len(data) + 1, 2) + data
+
+    def write_region(self, path):
+        chunks = []
+        offset = 2
+        indexes = sorted(self.random.sample(range(CHUNKS_PER_REGION), self.chunks_per_region))
+        saved_at = int(time.time()) - 3600  # Saved a while ago, like a world that's been played on
+        for index in indexes:
+            data = self.make_chunk()
+            count = -(-len(data) // SECTOR_SIZE)
+            chunks.append((index, offset, count, saved_at, data))
+            offset += count
+
+        write_region_file(path, 0, chunks, lambda data: data)
+
+    def write_player(self, player_id):
+        player_dir = os.path.join(self.root, 'world', 'playerdata')
+        os.makedirs(player_dir, exist_ok=True)
+        with gzip.open(os.path.join(player_dir, '{}.dat'.format(player_id)), 'wb') as f:
+            write_nbt(f, {
+                'Pos': [self.random.uniform(-5000, 5000), 64.0, self.random.uniform(-5000, 5000)],
+                'Health': 20.0,
+                'XpLevel': self.random.randrange(100),
+                'Inventory': [{'Slot': i, 'id': 'minecraft:stone', 'Count': self.random.randrange(1, 64)}
+                              for i in range(self.random.randrange(36))]
+            })
+
+        stats_dir = os.path.join(self.root, 'world', 'stats')
+        os.makedirs(stats_dir, exist_ok=True)
+        with open(os.path.join(stats_dir, '{}.json'.format(player_id)), 'w') as f:
+            json.dump({'stats': {'minecraft:custom': {'minecraft:play_time': self.random.randrange(10 ** 7)}}}, f)
+
+    def make_log(self, size):
+        # Lines are drawn from a pool, which is plenty for how well logs compress
+        if not self.log_lines:
+            self.log_lines = ['[{:02d}:{:02d}:{:02d}] [Server thread/INFO]: Player{} moved to {} {} {}\n'.format(
+                self.random.randrange(24), self.random.randrange(60), self.random.randrange(60),
+                self.random.randrange(self.players or 1), self.random.randrange(-5000, 5000), 64,
+                self.random.randrange(-5000, 5000)) for _ in range(1000)]
+
+        average = sum(len(i) for i in self.log_lines) / len(self.log_lines)
+        return ''.join(self.random.choices(self.log_lines, k=int(size / average) + 1))
+
+    def write_random_file(self, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(self.random.randbytes(size))
+
+    def mutate(self, fraction=0.05):
+        # Play for a while: rewrite some chunks the way the server does (in place when they still fit,
+        # otherwise at the end of the file), and append to the log
+        region_dir = os.path.join(self.root, 'world', 'region')
+        changed = 0
+        for name in sorted(os.listdir(region_dir)):
+            path = os.path.join(region_dir, name)
+            with open(path, 'r+b') as f:
+                chunks = read_region_header(f, os.path.getsize(path))
+                end = max(offset + count for _, offset, count, _ in chunks)
+                for index, offset, count, _ in chunks:
+                    if self.random.random() >= fraction:
+                        continue
+
+                    data = self.make_chunk()
+                    needed = -(-len(data) // SECTOR_SIZE)
+                    if needed > count:
+                        offset, end = end, end + needed
+
+                    f.seek(offset * SECTOR_SIZE)
+                    f.write(data + b'\x00' * (needed * SECTOR_SIZE - len(data)))
+                    f.seek(index * 4)
+                    f.write(struct.pack('>I', (offset << 8) | needed))
+                    f.seek(SECTOR_SIZE + index * 4)
+                    f.write(struct.pack('>I', int(time.time())))
+                    changed += 1
+
+        with open(os.path.join(self.root, 'logs', 'latest.log'), 'a') as f:
+            f.write(self.make_log(self.log_size // 10))
+
+        return changed
+
+
+class BenchmarkManager:
+    # Stands in for MinecraftManager, with no server to run
+
+    def __init__(self, jar_path, verbose=False):
+        self.jar_path = jar_path
+        self.verbose = verbose
+
+    def log(self, msg, level='info', with_traceback=False):
+        if self.verbose:
+            print('[{}] {}'.format(level, msg))
+
+    def get_jar_dir(self):
+        return os.path.dirname(os.path.abspath(self.jar_path))
+
+    async def stop_server(self, *args, **kwargs):
+        pass
+
+    async def handle_command(self, command):
+        pass
+
+
+def reset_peak_rss():
+    # Linux can reset the peak RSS of a process, so each benchmark gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # The lifetime peak, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def get_io_written():
+    # Bytes this process actually sent to storage, where the kernel reports it
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def get_dir_size(path):
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                total += os.lstat(os.path.join(dir_path, name)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+def measure(name, func, bytes_processed=None, **details):
+    """
+    Runs one benchmark, returning how long it took, its peak RSS and how much it wrote. `bytes_processed`
+    can be a number or a function of the result, for the throughput
+    """
+
+    reset_peak_rss()
+    io_before = get_io_written()
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    io_after = get_io_written()
+
+    processed = bytes_processed(result) if callable(bytes_processed) else bytes_processed
+    entry = dict({
+        'name': name,
+        'duration': round(duration, 4),
+        'peak_rss': get_peak_rss(),
+        'io_write_bytes': io_after - io_before if io_before is not None and io_after is not None else None,
+        'bytes_processed': processed,
+        'throughput_mb_s': round(processed / duration / MB, 2) if processed and duration else None
+    }, **details)
+
+    return entry, result
+
+
+class BackupBenchmark:
+    """
+    Times staging copies and snapshots (first and incremental), restores, retention pruning and exclusion
+    filtering against a synthetic world
+    """
+
+    def __init__(self, work_dir, world_options=None, modes=None, compression_workers=None, compression='default',
+                 excluded_files=None, excluded_file_types=None, prune_snapshots=500, verbose=False):
+        self.work_dir = work_dir
+        self.world_options = world_options or {}
+        self.modes = modes or [BackupMode.FULL, BackupMode.INCREMENTAL, BackupMode.REGION]
+        self.compression_workers = compression_workers
+        self.compression = compression
+        self.excluded_files = excluded_files or []
+        self.excluded_file_types = excluded_file_types or []
+        self.prune_snapshots = prune_snapshots
+        self.verbose = verbose
+        self.server_dir = os.path.join(work_dir, 'server')
+        self.results = []
+
+    def log(self, msg):
+        print(msg)
+
+    def get_backup_manager(self, backup_dir, mode=BackupMode.FULL, **kwargs):
+        manager = BenchmarkManager(os.path.join(self.server_dir, 'server.jar'), verbose=self.verbose)
+        return BackupManager(
+            manager.jar_path, backup_dir, manager=manager, backup_mode=mode,
+            compression_workers=self.compression_workers, compression=self.compression,
+            excluded_files=self.excluded_files,
+            excluded_file_types=self.excluded_file_types, **kwargs)
+
+    def run(self):
+        world = self.generate_world()
+        for mode in self.modes:
+            self.run_snapshots(mode)
+
+        self.run_pruning()
+        self.run_exclusions()
+
+        return {
+            'timestamp': int(time.time()),
+            'date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'compression': self.compression,
+            'world': world,
+            'results': self.results
+        }
+
+    def generate_world(self):
+        self.log('Generating synthetic world...')
+        world = SyntheticWorld(self.server_dir, **self.world_options)
+        entry, _ = measure('generate', world.generate)
+
+        files = sum(len(i[2]) for i in os.walk(self.server_dir))
+        size = get_dir_size(self.server_dir)
+        self.log('- {} file(s), {:.1f} MB in {:.1f}s'.format(files, size / MB, entry['duration']))
+        return dict(self.world_options, files=files, size=size)
+
+    def run_snapshots(self, mode):
+        backup_dir = os.path.join(self.work_dir, 'backups-{}'.format(mode))
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        os.makedirs(backup_dir)
+
+        # The first snapshot reads everything, the second only what changed in between
+        for label in ['snapshot', 'snapshot-incremental']:
+            if label == 'snapshot-incremental':
+                changed = SyntheticWorld(self.server_dir, seed=len(self.results)).mutate()
+                time.sleep(1)  # Snapshots are named by the second
+            else:
+                changed = None
+
+            backup = self.get_backup_manager(backup_dir, mode)
+            timestamp = backup.current_time()
+            entry, staging_dir = measure('stage' if label == 'snapshot' else 'stage-incremental',
+                                         backup.stage_snapshot, get_dir_size(self.server_dir), mode=mode)
+            self.add_result(entry)
+
+            # Archived from the staged copy, like a staged backup
+            size_before = get_dir_size(backup_dir)
+            entry, _ = measure(label, lambda: backup.take_snapshot(staging_dir, timestamp), lambda _: backup.bytes_in,
+                               mode=mode, changed_chunks=changed)
+            entry['bytes_written'] = get_dir_size(backup_dir) - size_before
+            self.add_result(entry)
+
+        backup = self.get_backup_manager(backup_dir, mode)
+        server_size = get_dir_size(self.server_dir)
+        entry, _ = measure('restore', lambda: asyncio.run(backup.restore_last_snapshot()), server_size, mode=mode)
+        entry['bytes_written'] = get_dir_size(self.server_dir)
+        self.add_result(entry)
+        backup.discard_old_server(self.server_dir)
+
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        backup.discard_staging()
+
+    def run_pruning(self):
+        # Lots of small placeholder backups, an hour apart, pruned with a typical GFS policy
+        backup_dir = os.path.join(self.work_dir, 'backups-prune')
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        os.makedirs(backup_dir)
+
+        backup = self.get_backup_manager(backup_dir, max_backups=10, keep_daily=7, keep_weekly=4, keep_monthly=6)
+        now = int(time.time())
+        for i in range(self.prune_snapshots):
+            path = os.path.join(backup_dir, 'minecraft-backup-{}.tar.gz'.format(now - i * 3600))
+            with open(path, 'wb') as f:
+                f.write(b'\x00' * 1024)
+            backup.catalog.add(Snapshot(path, now - i * 3600, mode=BackupMode.FULL, size=1024))
+
+        entry, _ = measure('prune', backup.delete_old_backups, snapshots=self.prune_snapshots)
+        entry['deleted'] = self.prune_snapshots - backup.get_backup_count()
+        self.add_result(entry)
+
+        shutil.rmtree(backup_dir, ignore_errors=True)
+
+    def run_exclusions(self):
+        backup_dir = os.path.join(self.work_dir, 'backups-walk')
+        backup = self.get_backup_manager(backup_dir)
+        entry, walked = measure('exclusion-filter', lambda: list(backup.walk_server_files(self.server_dir)),
+                                excluded_files=self.excluded_files, excluded_file_types=self.excluded_file_types)
+
+        total = sum(len(i[1]) + len(i[2]) for i in os.walk(self.server_dir))
+        entry['entries'] = total
+        entry['included'] = len(walked)
+        entry['entries_per_second'] = round(total / entry['duration']) if entry['duration'] else None
+        self.add_result(entry)
+
+        shutil.rmtree(backup_dir, ignore_errors=True)
+
+    def add_result(self, entry):
+        self.results.append(entry)
+        self.log('- {:<22} {:<12} {:>8.3f}s {:>10} {:>10} peak RSS'.format(
+            entry['name'], entry.get('mode') or '', entry['duration'],
+            '{} MB/s'.format(entry['throughput_mb_s']) if entry.get('throughput_mb_s') else '',
+            '{:.0f} MB'.format(entry['peak_rss'] / MB)))
+
+
+def compare_results(previous, current):
+    # Lines like `snapshot (full): 2.100s -> 1.500s (-28.6%)`
+    before = {(i['name'], i.get('mode')): i for i in previous.get('results', [])}
+    lines = []
+    for entry in current.get('results', []):
+        key = (entry['name'], entry.get('mode'))
+        if key not in before:
+            continue
+
+        old, new = before[key]['duration'], entry['duration']
+        lines.append('{}{}: {:.3f}s -> {:.3f}s ({:+.1%}), peak RSS {:.0f} MB -> {:.0f} MB'.format(
+            entry['name'], ' ({})'.format(entry['mode']) if entry.get('mode') else '', old, new,
+            (new - old) / old if old else 0, before[key]['peak_rss'] / MB, entry['peak_rss'] / MB))
+
+    return lines
+
+
+@click.command()
+@click.option('--work-dir', type=click.Path(), help='Where to generate the world and backups (Default: a temp directory)')
+@click.option('--output', type=click.Path(), default='benchmark-results.json', help='Where to save the results, as JSON')
+@click.option('--compare', type=click.Path(exists=True), help='Results of an earlier run to compare against')
+@click.option('--modes', type=str, default='full,incremental,region', help='Comma-separated backup modes to benchmark')
+@click.option('--regions', type=int, default=16, help='How many region files to generate')
+@click.option('--chunks-per-region', type=int, default=512, help='How many chunks to generate in each region file')
+@click.option('--players', type=int, default=50, help='How many players to generate data for')
+@click.option('--log-files', type=int, default=10, help='How many rotated log files to generate')
+@click.option('--log-size', type=float, default=1, help='The size of each log file (in MB)')
+@click.option('--plugins', type=int, default=5, help='How many plugin jars to generate')
+@click.option('--plugin-size', type=float, default=2, help='The size of each jar (in MB)')
+@click.option('--tiles', type=int, default=0, help='How many map tiles to generate (excluded by a .backupignore)')
+@click.option('--seed', type=int, default=0, help='Seed for the world generator')
+@click.option('--compression-workers', type=int, help='How many threads to compress backup archives with')
+@click.option('--compression', type=click.Choice(['store', 'fast', 'default', 'dense']), default='default',
+              help='The codec for files that aren\'t already compressed')
+@click.option('--excluded-files', type=str, help='Comma-separated list of files to exclude')
+@click.option('--excluded-file-types', type=str, default='log,gz', help='Comma-separated list of file types to exclude')
+@click.option('--prune-snapshots', type=int, default=500, help='How many backups to prune')
+@click.option('--keep', is_flag=True, help='Keep the generated world and backups')
+@click.option('--verbose', is_flag=True, help='Show the backup manager\'s log output')
+def execute_command(work_dir, output, compare, modes, regions, chunks_per_region, players, log_files, log_size,
+                    plugins, plugin_size, tiles, seed, compression_workers, compression, excluded_files,
+                    excluded_file_types, prune_snapshots, keep, verbose):
+    """
+    Benchmarks snapshots, restores, pruning and exclusion filtering against a synthetic world
+    """
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix='minecraft-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    benchmark = BackupBenchmark(
+        work_dir,
+        world_options={
+            'regions': regions,
+            'chunks_per_region': chunks_per_region,
+            'players': players,
+            'log_files': log_files,
+            'log_size': int(log_size * MB),
+            'plugins': plugins,
+            'plugin_size': int(plugin_size * MB),
+            'tiles': tiles,
+            'seed': seed
+        },
+        modes=[i for i in modes.split(',') if i],
+        compression_workers=compression_workers,
+        compression=compression,
+        excluded_files=[os.path.join('server', i) for i in (excluded_files or '').split(',') if i],
+        excluded_file_types=(excluded_file_types or '').split(','),
+        prune_snapshots=prune_snapshots,
+        verbose=verbose)
+
+    try:
+        results = benchmark.run()
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to {}'.format(output))
+
+    if compare:
+        with open(compare, 'r') as f:
+            previous = json.load(f)
+
+        print('Compared to {} ({}):'.format(compare, previous.get('date', '?')))
+        for line in compare_results(previous, results):
+            print('- {}'.format(line))
+
+
+def execute():
+    execute_command()
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+
+class Snapshot:
+
+    def __init__(self, path, timestamp, mode=None, size=None, duration=None, file_count=None, checksum=None):
+        self.path = path
+        self.timestamp = timestamp
+        self.mode = mode
+        self.size = size
+        self.duration = duration
+        self.file_count = file_count
+        self.checksum = checksum
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+
+class BackupCatalog:
+    """
+    SQLite index of every snapshot in the backup directory, so listing, pruning and finding the latest
+    snapshot don't have to scan the directory and parse filenames
+    """
+
+    filename = 'catalog.db'
+
+    def __init__(self, backup_path):
+        self.backup_path = backup_path
+        self.db_path = os.path.join(backup_path, self.filename)
+        self.created = not os.path.exists(self.db_path)
+
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                'name TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, mode TEXT, size INTEGER, '
+                'duration REAL, file_count INTEGER, checksum TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS snapshots_timestamp ON snapshots (timestamp)')
+
+    def connect(self):
+        # A connection per call keeps the catalog safe to use from the backup worker threads
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def add(self, snapshot):
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (snapshot.name, snapshot.timestamp, snapshot.mode, snapshot.size, snapshot.duration,
+                 snapshot.file_count, snapshot.checksum))
+
+    def remove(self, path):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM snapshots WHERE name = ?', (os.path.basename(path),))
+
+    def count(self):
+        with closing(self.connect()) as conn:
+            return conn.execute('SELECT COUNT(*) FROM snapshots').fetchone()[0]
+
+    def get(self, timestamp):
+        return self._first('WHERE timestamp = ?', (timestamp,))
+
+    def oldest(self):
+        return self._first('ORDER BY timestamp ASC')
+
+    def newest(self, extension=None):
+        if extension:
+            return self._first("WHERE name LIKE ? ORDER BY timestamp DESC", ('%{}'.format(extension),))
+
+        return self._first('ORDER BY timestamp DESC')
+
+    def list(self):
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                'SELECT name, timestamp, mode, size, duration, file_count, checksum '
+                'FROM snapshots ORDER BY timestamp DESC').fetchall()
+
+        return [self._to_snapshot(i) for i in rows]
+
+    def _first(self, query, params=()):
+        # Drop any rows for snapshots that were deleted behind our back
+        while True:
+            with closing(self.connect()) as conn:
+                row = conn.execute(
+                    'SELECT name, timestamp, mode, size, duration, file_count, checksum '
+                    'FROM snapshots {} LIMIT 1'.format(query), params).fetchone()
+
+            if not row:
+                return None
+
+            snapshot = self._to_snapshot(row)
+            if os.path.exists(snapshot.path):
+                return snapshot
+
+            self.remove(snapshot.path)
+
+    def _to_snapshot(self, row):
+        return Snapshot(os.path.join(self.backup_path, row[0]), *row[1:])
+
+
+class RetentionPolicy:
+    """
+    Grandfather-father-son retention. The newest `keep_last` snapshots are always kept, plus the newest
+    snapshot of each of the last `keep_daily` days, `keep_weekly` weeks and `keep_monthly` months
+    """
+
+    def __init__(self, keep_last=10, keep_daily=0, keep_weekly=0, keep_monthly=0):
+        self.keep_last = int(keep_last or 0)
+        self.keep_daily = int(keep_daily or 0)
+        self.keep_weekly = int(keep_weekly or 0)
+        self.keep_monthly = int(keep_monthly or 0)
+
+    def describe(self):
+        return 'last {}, daily {}, weekly {}, monthly {}'.format(
+            self.keep_last, self.keep_daily, self.keep_weekly, self.keep_monthly)
+
+    def get_expired(self, snapshots):
+        snapshots = sorted(snapshots, key=lambda i: i.timestamp, reverse=True)
+        keep = set(i.path for i in snapshots[:self.keep_last])
+
+        buckets = [
+            (self.keep_daily, '%Y-%m-%d'),
+            (self.keep_weekly, '%G-%V'),
+            (self.keep_monthly, '%Y-%m')
+        ]
+        for limit, bucket_format in buckets:
+            seen = set()
+            for snapshot in snapshots:
+                if len(seen) >= limit:
+                    break
+
+                bucket = datetime.utcfromtimestamp(snapshot.timestamp).strftime(bucket_format)
+                if bucket in seen:
+                    continue
+
+                seen.add(bucket)
+                keep.add(snapshot.path)
+
+        return [i for i in snapshots if i.path not in keep]
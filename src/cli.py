@@ -1,18 +1,20 @@
 
-import asyncio
 import atexit
+import sys
 import click
-from .manager import MinecraftManager
+from .manager import MinecraftManager, ManagerState
+from .supervisor import ServerSupervisor
 
 manager = None
 
 def close_process():
-    if manager:
+    if manager and manager.state != ManagerState.QUITING:
         manager.log('Force close or crash detected! Cleaning up child processes...', level='warn')
-        asyncio.run(manager.stop_server(quit=True))
+        manager.terminate_server()
 
 
 @click.command()
+@click.option('--config', type=click.Path(exists=True), help='Run every server defined in this JSON config file')
 @click.option('--server-path', type=click.Path(exists=True), help='The path to your minecraft server executable (jar)')
 @click.option('--log-path', type=click.Path(exists=False), help='The path for your default log file')
 @click.option('--backup-dir', type=click.Path(exists=True), help='The directory you want backups saved in')
@@ -20,15 +22,84 @@ def close_process():
 @click.option('--excluded-file-types', type=str, help='Comma-separated list of file types to exclude')
 @click.option('--backup-frequency', type=int, help='A number representing how often you want backups to run (in seconds)')
 @click.option('--min-java-memory', type=str, help='The minimum amount of memory that the JVM should use')
-@click.option('--max-java-memory', type=str, help='The maximum amount of memory that the JVM can use')
+@click.option('--max-java-memory', type=str, help='The maximum amount of memory that the JVM can use, or `auto` to size it from the host\'s RAM')
+@click.option('--java-path', type=str, help='The Java executable to run the server with')
+@click.option('--jvm-profile', type=click.Choice(['default', 'aikar', 'zgc']), help='The set of JVM/GC flags to launch the server with (Default: default)')
+@click.option('--gc-logging/--no-gc-logging', default=False, help='Write a GC log (logs/gc.log) and report GC pause times from it. Needs Java 9 or newer')
+@click.option('--gc-report-interval', type=float, help='How often to log a GC summary (in seconds, 0 to disable)')
+@click.option('--startup-timeout', type=float, help='How long to wait for the server to be ready after starting it (in seconds)')
+@click.option('--stop-timeout', type=float, help='How long to wait for the server to stop before terminating it (in seconds)')
+@click.option('--prewarm-spawn', is_flag=True, help='Read the spawn area\'s region files into memory before starting the server')
+@click.option('--prewarm-radius', type=int, help='How many region files around spawn to pre-warm, in each direction')
+@click.option('--staged-backups/--no-staged-backups', default=False,
+              help='Copy the server before backing it up, so saving is only off while the copy is made. The copy is kept between backups and, unless the filesystem supports reflinks, takes as much disk space as the server')
+@click.option('--staged-restore/--no-staged-restore', default=True,
+              help='Unpack the snapshot while the server is still running, and only stop it to swap the files in')
 @click.option('--discord-api-token', type=str, help='Discord Bot API Token')
-def execute_command(server_path, log_path, backup_dir, excluded_files, excluded_file_types,
-                   backup_frequency, min_java_memory, max_java_memory, discord_api_token):
+@click.option('--discord-console-channel', type=int, help='The ID of a Discord channel to stream the server console to')
+@click.option('--discord-status-channel', type=int, help='The ID of a Discord channel to keep a pinned status message in')
+@click.option('--discord-console-interval', type=float, help='How often to send console output to Discord (in seconds)')
+@click.option('--discord-status-interval', type=float, help='How often to update the Discord status message (in seconds)')
+@click.option('--backup-mode', type=click.Choice(['full', 'incremental', 'region']),
+              help='Full archives, incremental snapshots backed by a deduplicated chunk store, '
+                   'or incremental snapshots that only store changed region chunks')
+@click.option('--compression-workers', type=int, help='How many threads to compress backup archives with')
+@click.option('--compression', type=click.Choice(['store', 'fast', 'default', 'dense']),
+              help='How hard to compress files that aren\'t already compressed')
+@click.option('--compression-rules', type=str,
+              help='Comma-separated list of `<path or .extension>=<codec>` rules, overriding the codec picked for files')
+@click.option('--compression-sampling', is_flag=True,
+              help='Sample files of unknown types, and store the ones that look incompressible without compressing them')
+@click.option('--replicate-to', type=str,
+              help='Comma-separated list of places to copy backups to (file://<path>, sftp://<user>@<host>/<path> or s3://<bucket>/<prefix>)')
+@click.option('--replication-workers', type=int, help='How many parts of a backup to upload at once')
+@click.option('--replication-bandwidth', type=float, help='Cap how fast backups are uploaded (in MB/s)')
+@click.option('--s3-endpoint', type=str, help='The URL of an S3 compatible store, if not AWS (e.g. http://127.0.0.1:9000)')
+@click.option('--s3-region', type=str, help='The region of the S3 bucket')
+@click.option('--sftp-key-file', type=click.Path(exists=True), help='The private key to log in to SFTP servers with')
+@click.option('--save-timeout', type=float, help='How long to wait for the server to save the world before a backup (in seconds)')
+@click.option('--max-backups', type=int, help='How many of the most recent backups to always keep')
+@click.option('--keep-daily', type=int, help='How many days to keep the last backup of')
+@click.option('--keep-weekly', type=int, help='How many weeks to keep the last backup of')
+@click.option('--keep-monthly', type=int, help='How many months to keep the last backup of')
+@click.option('--log-queue-size', type=int, help='How many log lines can be waiting to be written before console output is dropped')
+@click.option('--backup-nice', type=int, help='How much to lower the CPU priority of backup threads (0-19)')
+@click.option('--backup-io-priority', type=click.Choice(['normal', 'low', 'idle']), help='The disk priority of backup threads')
+@click.option('--backup-read-limit', type=float, help='Cap how fast backups read the world (in MB/s)')
+@click.option('--backup-cpu-limit', type=float, help='Cap how much CPU backups use (in cores)')
+@click.option('--metrics-port', type=int, help='Serve Prometheus metrics on this local port')
+@click.option('--align-backups/--no-align-backups', default=True,
+              help='Run backups on wall-clock marks (e.g. 00:00, 06:00, ...) instead of counting from startup')
+@click.option('--skip-idle-backups/--no-skip-idle-backups', default=True,
+              help='Skip scheduled backups when nobody played and no world files changed')
+@click.option('--min-backup-tps', type=float, help='Defer scheduled backups while the server TPS is below this (0 to disable)')
+@click.option('--backup-defer-delay', type=float, help='How long to put off a backup while the server is struggling (in seconds)')
+@click.option('--max-backup-deferral', type=float, help='The longest a backup can be put off before it runs anyway (in seconds)')
+def execute_command(config, server_path, log_path, backup_dir, excluded_files, excluded_file_types,
+                   backup_frequency, min_java_memory, max_java_memory, java_path, jvm_profile, gc_logging,
+                   gc_report_interval, startup_timeout, stop_timeout, prewarm_spawn, prewarm_radius,
+                   staged_backups, staged_restore, discord_api_token, discord_console_channel,
+                   discord_status_channel, discord_console_interval, discord_status_interval, backup_mode,
+                   compression_workers, compression, compression_rules, compression_sampling,
+                   replicate_to, replication_workers, replication_bandwidth, s3_endpoint, s3_region, sftp_key_file,
+                   save_timeout,
+                   max_backups, keep_daily, keep_weekly, keep_monthly,
+                   log_queue_size, backup_nice, backup_io_priority, backup_read_limit, backup_cpu_limit,
+                   metrics_port, align_backups, skip_idle_backups, min_backup_tps, backup_defer_delay,
+                   max_backup_deferral):
     """
     Handler for the execute command
     """
 
     global manager
+
+    # Several servers, run from a config file
+    if config:
+        manager = ServerSupervisor.from_file(config)
+        atexit.register(close_process)
+        manager.start()
+        sys.exit(manager.exit_code)
+
     manager = MinecraftManager(server_path, **{
         'log_path': log_path,
         'backup_dir': backup_dir,
@@ -37,7 +108,48 @@ def execute_command(server_path, log_path, backup_dir, excluded_files, excluded_
         'backup_frequency': backup_frequency,
         'min_java_memory': min_java_memory,
         'max_java_memory': max_java_memory,
-        'discord_api_token': discord_api_token
+        'java_path': java_path,
+        'jvm_profile': jvm_profile,
+        'gc_logging': gc_logging,
+        'gc_report_interval': gc_report_interval,
+        'startup_timeout': startup_timeout,
+        'stop_timeout': stop_timeout,
+        'prewarm_spawn': prewarm_spawn,
+        'prewarm_radius': prewarm_radius,
+        'staged_backups': staged_backups,
+        'staged_restore': staged_restore,
+        'discord_api_token': discord_api_token,
+        'discord_console_channel': discord_console_channel,
+        'discord_status_channel': discord_status_channel,
+        'discord_console_interval': discord_console_interval,
+        'discord_status_interval': discord_status_interval,
+        'backup_mode': backup_mode,
+        'compression_workers': compression_workers,
+        'compression': compression,
+        'compression_rules': (compression_rules or '').split(','),
+        'compression_sampling': compression_sampling,
+        'replicate_to': (replicate_to or '').split(','),
+        'replication_workers': replication_workers,
+        'replication_bandwidth': replication_bandwidth,
+        's3_endpoint': s3_endpoint,
+        's3_region': s3_region,
+        'sftp_key_file': sftp_key_file,
+        'save_timeout': save_timeout,
+        'max_backups': max_backups,
+        'keep_daily': keep_daily,
+        'keep_weekly': keep_weekly,
+        'keep_monthly': keep_monthly,
+        'log_queue_size': log_queue_size,
+        'backup_nice': backup_nice,
+        'backup_io_priority': backup_io_priority,
+        'backup_read_limit': backup_read_limit,
+        'backup_cpu_limit': backup_cpu_limit,
+        'metrics_port': metrics_port,
+        'align_backups': align_backups,
+        'skip_idle_backups': skip_idle_backups,
+        'min_backup_tps': min_backup_tps,
+        'backup_defer_delay': backup_defer_delay,
+        'max_backup_deferral': max_backup_deferral
     })
 
     # Register a handler for when the process is exited
@@ -45,6 +157,7 @@ def execute_command(server_path, log_path, backup_dir, excluded_files, excluded_
 
     # Start the manager
     manager.start()
+    sys.exit(manager.exit_code)
 
 
 def execute():
@@ -0,0 +1,199 @@
+import hashlib
+import math
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Codecs are gzip compression levels, so every archive is still a plain .tar.gz. `store` wraps data
+# in gzip without compressing it, which costs little more than copying it
+CODECS = {
+    'store': 0,
+    'fast': 1,
+    'default': 6,
+    'dense': 9
+}
+
+# File types that are already compressed: region files and external chunks (zlib), gzipped NBT (.dat),
+# jars and other archives, images and sounds
+INCOMPRESSIBLE_TYPES = [
+    '.mca', '.mcr', '.mcc', '.dat', '.dat_old', '.jar', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.7z',
+    '.png', '.jpg', '.jpeg', '.ogg', '.mp3'
+]
+
+
+def compress_block(data, level):
+    # Every block becomes its own gzip member. Concatenated members are still a valid
+    # gzip file, so standard tools (and tarfile) read the result like any other .tar.gz
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    data = compressor.compress(data) + compressor.flush()
+    return data, time.perf_counter() - start
+
+
+def get_entropy(data):
+    # Shannon entropy in bits per byte: about 8 for compressed or encrypted data, 4-5 for text
+    if not data:
+        return 0
+
+    entropy = 0
+    for count in (data.count(bytes([i])) for i in range(256)):
+        if count:
+            p = count / len(data)
+            entropy -= p * math.log2(p)
+
+    return entropy
+
+
+class CompressionPolicy:
+    """
+    Picks a codec for each file: `store` for file types that are already compressed, the configured codec
+    for everything else. Rules (`<path or .extension>=<codec>`) override both, and unknown file types can
+    optionally be sampled, storing the ones that look incompressible
+    """
+
+    def __init__(self, codec='default', rules=None, sample=False, sample_size=65536, entropy_threshold=7.5):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: {}. Use one of: {}'.format(codec, ', '.join(CODECS)))
+
+        self.codec = codec
+        self.rules = []
+        self.sample = sample
+        self.sample_size = sample_size
+        self.entropy_threshold = entropy_threshold
+
+        for rule in rules or []:
+            pattern, _, rule_codec = rule.strip().rpartition('=')
+            if not pattern or rule_codec not in CODECS:
+                raise ValueError('Invalid compression rule: `{}`. Use `<path or .extension>=<{}>`'.format(
+                    rule, '|'.join(CODECS)))
+
+            self.rules.append((pattern.strip().strip('/'), rule_codec))
+
+    def get_codec(self, rel_path, path=None, size=0):
+        for pattern, codec in self.rules:
+            if pattern.startswith('.') and rel_path.endswith(pattern):
+                return codec
+            if rel_path == pattern or rel_path.startswith('{}/'.format(pattern)):
+                return codec
+
+        if any(rel_path.endswith(i) for i in INCOMPRESSIBLE_TYPES):
+            return 'store'
+
+        # Only sample files big enough for it to matter. The page cache keeps the read for the archive
+        if self.sample and path and size >= 4096 and self.codec != 'store':
+            try:
+                with open(path, 'rb') as f:
+                    if get_entropy(f.read(self.sample_size)) >= self.entropy_threshold:
+                        return 'store'
+            except OSError:
+                pass
+
+        return self.codec
+
+
+class ParallelGzipWriter:
+    """
+    File-like object that gzips everything written to it on multiple threads. The input is
+    split into fixed size blocks which are compressed concurrently (zlib releases the GIL)
+    and written out in order
+    """
+
+    def __init__(self, fileobj, workers=None, block_size=1048576, level=6, initializer=None, initargs=()):
+        self.fileobj = fileobj
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.block_size = block_size
+        self.level = level
+        self.level_changes = deque()
+        self.level_stats = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, initializer=initializer, initargs=initargs)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks = []
+        self.submitted = 0
+        self.checksum = hashlib.sha256()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_level(self, level, offset=None):
+        # Compress everything from `offset` on (in the uncompressed stream, now by default) at `level`.
+        # Blocks are cut at the change, so every block has a single level
+        self.level_changes.append((self.bytes_in if offset is None else offset, level))
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+
+        while True:
+            size = self._next_block_size()
+            if len(self.buffer) < size:
+                break
+
+            self._submit(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            while self.buffer:
+                size = min(len(self.buffer), self._next_block_size())
+                self._submit(bytes(self.buffer[:size]))
+                del self.buffer[:size]
+
+            while self.pending:
+                self._write_next()
+
+            self.fileobj.flush()
+        finally:
+            self.executor.shutdown()
+            self.closed = True
+
+    def _next_block_size(self):
+        # Apply the level changes that have been reached, and end the block at the next one
+        while self.level_changes and self.level_changes[0][0] <= self.submitted:
+            self.level = self.level_changes.popleft()[1]
+
+        if self.level_changes:
+            return min(self.block_size, self.level_changes[0][0] - self.submitted)
+
+        return self.block_size
+
+    def _submit(self, block):
+        self.pending.append((self.submitted, len(block), self.level,
+                             self.executor.submit(compress_block, block, self.level)))
+        self.submitted += len(block)
+
+        # Only keep a couple of blocks in flight per worker so memory use stays bounded
+        while len(self.pending) > self.workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        offset, size, level, future = self.pending.popleft()
+        data, duration = future.result()
+
+        # Input bytes, output bytes and compression time, per level
+        stats = self.level_stats.setdefault(level, [0, 0, 0])
+        stats[0] += size
+        stats[1] += len(data)
+        stats[2] += duration
+
+        # Remember where each block starts, in both the input and the output, so it can be found again
+        self.blocks.append([offset, self.bytes_out, len(data)])
+        self.fileobj.write(data)
+        self.checksum.update(data)
+        self.bytes_out += len(data)
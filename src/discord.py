@@ -1,85 +1,301 @@
+import asyncio
+import re
+import typing
+from collections import deque
+from datetime import datetime
 from discord.ext import commands
-
-client = commands.Bot(command_prefix='!server ')
+from .events import ConsoleLine
 
 ops = ['zach#3244', 'gigawhattt#1102', 'rockncole#2771']
 
+# Discord rejects messages longer than this
+MAX_MESSAGE_SIZE = 2000
+
+
+class ConsoleRelay:
+    """
+    Streams console lines to a Discord channel. Lines are collected and sent every `interval` seconds as
+    a few code block messages, each as full as Discord allows, so a log storm costs a handful of
+    messages instead of one per line. If lines come in faster than they can be sent, the oldest are
+    dropped (and counted) rather than queued forever
+    """
+
+    # Player IPs show up in login lines (`[/1.2.3.4:56789] logged in`)
+    address_pattern = re.compile(r'/\d{1,3}(?:\.\d{1,3}){3}:\d+')
+
+    def __init__(self, send, interval=2.0, messages_per_flush=2, max_lines=1000, log=None):
+        self.send = send
+        self.interval = interval
+        self.messages_per_flush = messages_per_flush
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.log = log or (lambda msg, level='info': None)
+
+    def add(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+
+        # Nothing in a line can end the code block early
+        line = self.address_pattern.sub('/<ip hidden>', line).replace('```', '`\u200b``')
+        self.lines.append(line[:MAX_MESSAGE_SIZE - 100])
+
+    def get_messages(self):
+        messages = []
+
+        # The notice leads the first message without taking a line's place in the full queue
+        notice = None
+        if self.dropped:
+            notice = '... {} line(s) skipped to keep up'.format(self.dropped)
+            self.dropped = 0
+
+        while (self.lines or notice) and len(messages) < self.messages_per_flush:
+            batch = [notice] if notice else []
+            size = len('```\n```') + (len(notice) + 1 if notice else 0)
+            notice = None
+            while self.lines and size + len(self.lines[0]) + 1 <= MAX_MESSAGE_SIZE:
+                line = self.lines.popleft()
+                batch.append(line)
+                size += len(line) + 1
+
+            messages.append('```\n{}\n```'.format('\n'.join(batch)))
+
+        return messages
+
+    async def flush(self):
+        for message in self.get_messages():
+            try:
+                await self.send(message)
+            except Exception as ex:
+                self.log('Unable to relay console output to Discord: {}'.format(str(ex)), level='warn')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
 class DiscordManager:
 
-    def __init__(self, api_token, manager):
+    def __init__(self, api_token, manager, console_channel=None, status_channel=None, console_interval=2.0,
+                 status_interval=15.0, client=None):
         self.token = api_token
         self.manager = manager
+        self.client = client or commands.Bot(command_prefix='!server ')
+        self.console_channel = int(console_channel) if console_channel else None
+        self.status_channel = int(status_channel) if status_channel else None
+        self.console_interval = float(console_interval or 2)
+        self.status_interval = float(status_interval or 15)
+        self.console_relay = None
+        self.status_message = None
+        self.status_content = None
+        self.unsubscribe = []
+        self.tasks = []
 
     def get_client(self):
-        return client
+        return self.client
 
-    def start(self):
-        self.run_client()
+    async def start(self):
+        self.register_commands()
+        await self.client.start(self.token)
 
     async def stop(self):
-        if client:
-            await client.close()
+        # One last status update and console flush, so the channels show the servers stopped
+        for task in self.tasks:
+            task.cancel()
+        for unsubscribe in self.unsubscribe:
+            unsubscribe()
+
+        try:
+            if self.console_relay:
+                await self.console_relay.flush()
+            if self.status_message:
+                await self.update_status()
+        except Exception:
+            self.manager.log('Unable to update Discord before quitting', level='warn', with_traceback=True)
+
+        if self.client:
+            await self.client.close()
+
+    def get_instances(self):
+        # A supervisor's servers, or just the one
+        return list(getattr(self.manager, 'instances', {}).values()) or [self.manager]
+
+    def get_instance_names(self):
+        if not hasattr(self.manager, 'instances'):
+            return [self.manager.name] if self.manager.name else []
+
+        return list(self.manager.instances) + ['all']
+
+    async def start_channels(self):
+        if self.console_channel and not self.console_relay:
+            channel = self.client.get_channel(self.console_channel)
+            if channel is None:
+                self.manager.log('Discord console channel {} not found'.format(self.console_channel), level='warn')
+            else:
+                self.console_relay = ConsoleRelay(channel.send, interval=self.console_interval, log=self.manager.log)
+                for instance in self.get_instances():
+                    self.unsubscribe.append(instance.events.subscribe(ConsoleLine, self.get_console_handler(instance)))
+                self.tasks.append(asyncio.create_task(self.console_relay.run()))
+
+        if self.status_channel and not self.status_message:
+            channel = self.client.get_channel(self.status_channel)
+            if channel is None:
+                self.manager.log('Discord status channel {} not found'.format(self.status_channel), level='warn')
+            else:
+                self.status_message = await self.get_status_message(channel)
+                self.tasks.append(asyncio.create_task(self.run_status_updates()))
+
+    def get_console_handler(self, instance):
+        if instance is self.manager or not instance.name:
+            return lambda e: self.console_relay.add(e.line)
+
+        return lambda e: self.console_relay.add('[{}] {}'.format(instance.name, e.line))
+
+    async def get_status_message(self, channel):
+        # Keep editing the message pinned last time, so restarts don't leave a trail of status messages
+        for message in await channel.pins():
+            if message.author == self.client.user and message.content.startswith('**Server Status**'):
+                self.status_content = message.content
+                return message
+
+        message = await channel.send(self.get_status_text())
+        self.status_content = message.content
+        await message.pin()
+        return message
+
+    async def run_status_updates(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            try:
+                await self.update_status()
+            except Exception as ex:
+                self.manager.log('Unable to update the Discord status message: {}'.format(str(ex)), level='warn')
+
+    async def update_status(self):
+        # Only edit when something changed, which also keeps edits well within the rate limits
+        content = self.get_status_text()
+        if content != self.status_content:
+            await self.status_message.edit(content=content)
+            self.status_content = content
+
+    def get_status_text(self):
+        lines = ['**Server Status**']
+        for instance in self.get_instances():
+            running = instance.minecraft_running()
+            parts = ['running' if running else 'stopped']
+            if running:
+                parts.append('{} player(s) online'.format(len(instance.players)))
+                if instance.last_tps:
+                    parts.append('TPS {}'.format(instance.last_tps[1].tps_1m))
+
+            parts.append('last backup: {}'.format(
+                datetime.utcfromtimestamp(instance.last_backup_time).strftime('%Y-%m-%d %H:%M UTC')
+                if instance.last_backup_time else 'none'))
+            lines.append('{}{}'.format('**{}**: '.format(instance.name) if instance.name else '', ' | '.join(parts)))
+
+        return '\n'.join(lines)
+
+    def register_commands(self):
+        client = self.client
+        names = self.get_instance_names
+
+        class ServerName(commands.Converter):
+            # Lets the server be left out of commands whose other arguments come after it
+            async def convert(self, ctx, argument):
+                if argument not in names():
+                    raise commands.BadArgument('Unknown server, "{}"'.format(argument))
+                return argument
 
-    def run_client(self):
         @client.event
         async def on_ready():
             self.manager.log('Discord bot client is ready')
+            await self.start_channels()
 
         @client.command(name='ping')
         async def ping(ctx):
             await ctx.send('Bing Bong')
             
         @client.command(name='start')
-        async def start_cmd(ctx):
+        async def start_cmd(ctx, instance=None):
             await ctx.send('I\'m starting up the Minecraft server now...')
-            ret = await self.command_handler(ctx, 'start')
+            ret = await self.command_handler(ctx, 'start', instance)
             if ret:
-                await ctx.send('I\'ve successfully started the Minecraft Server for you')
+                await ctx.send('I\'ve successfully started the Minecraft Server for you. It\'s ready for players')
 
         @client.command(name='stop')
-        async def stop_cmd(ctx):
+        async def stop_cmd(ctx, instance=None):
             await ctx.send('Alright, shutting down the Minecraft Server...')
-            ret = await self.command_handler(ctx, 'stop')
+            ret = await self.command_handler(ctx, 'stop', instance)
             if ret:
                 await ctx.send('I\'ve successfully shut down the Minecraft Server for you')
 
         @client.command(name='restart')
-        async def restart_cmd(ctx):
+        async def restart_cmd(ctx, instance=None):
             await ctx.send('Nothin\' liked a good ole switch off and on!')
-            ret = await self.command_handler(ctx, 'stop')
+            ret = await self.command_handler(ctx, 'restart', instance)
             if ret:
-                await ctx.send('I\'ve successfully restarted the Minecraft Server for you')
+                await ctx.send('I\'ve successfully restarted the Minecraft Server for you. It\'s ready for players')
 
         @client.command(name='backup')
-        async def backup_cmd(ctx):
+        async def backup_cmd(ctx, instance=None):
             await ctx.send('Be right back, taking a snapshot of your Minecraft Server...')
-            ret = await self.command_handler(ctx, 'backup-now')
+            ret = await self.command_handler(ctx, 'backup-now', instance)
             if ret:
                 await ctx.send('I\'ve successfully taken a new backup of your Minecraft Server')
 
         @client.command(name='restore')
-        async def restore_cmd(ctx):
+        async def restore_cmd(ctx, instance=None):
             await ctx.send('Restore coming right up! I\'m reverting back to last the snapshot...')
-            ret = await self.command_handler(ctx, 'restore')
+            ret = await self.command_handler(ctx, 'restore', instance)
             if ret:
                 await ctx.send('I\'ve successfully reverted to the last backup of your Minecraft Server')
 
+        @client.command(name='restore-file')
+        async def restore_file_cmd(ctx, instance: typing.Optional[ServerName], snapshot, *, path):
+            await ctx.send('Pulling `{}` out of backup `{}`...'.format(path, snapshot))
+            ret = await self.command_handler(ctx, 'restore-file {} {}'.format(snapshot, path), instance)
+            if ret:
+                await ctx.send('I\'ve restored `{}` for you'.format(path))
+
+        @client.command(name='restore-region')
+        async def restore_region_cmd(ctx, instance: typing.Optional[ServerName], snapshot, world, x: int, z: int):
+            await ctx.send('Pulling region ({}, {}) of `{}` out of backup `{}`...'.format(x, z, world, snapshot))
+            ret = await self.command_handler(ctx, 'restore-region {} {} {} {}'.format(snapshot, world, x, z),
+                                             instance)
+            if ret:
+                await ctx.send('I\'ve restored region ({}, {}) for you'.format(x, z))
+
+        # Run any command on one of the servers, when the manager runs several of them
+        @client.command(name='on')
+        async def on_cmd(ctx, instance, *, command):
+            ret = await self.command_handler(ctx, command, instance)
+            if ret:
+                await ctx.send('Sent `{}` to {}'.format(command, instance))
+
         @client.event
         async def on_message(message):
             # Do not remove this
             await client.process_commands(message)
-        
-        client.run(self.token)
 
-    async def command_handler(self, ctx, command):
+    async def command_handler(self, ctx, command, instance=None):
         user_id = '{}#{}'.format(ctx.author.name, ctx.author.discriminator)
         ret = False
         if user_id not in ops:
             await ctx.send('Woah there! Only admins can execute that command. You\'re just a filthy peasant!')
             return ret
 
+        if instance and instance not in self.get_instance_names():
+            names = self.get_instance_names()
+            await ctx.send('I don\'t know a server called `{}`. {}'.format(instance, 'Try one of: {}'.format(
+                ', '.join(names)) if names else 'There\'s only one server, so leave the name out'))
+            return ret
+
+        # A lone manager has nothing to route on, so naming its own server is the same as naming none
+        if not hasattr(self.manager, 'instances'):
+            instance = None
+
         try:
-            await self.manager.command_handler(command)
+            await self.manager.command_handler('{} {}'.format(instance, command) if instance else command)
             ret = True
         except Exception as ex:
             await ctx.send('Wahhh! I run into a boo boo: {}'.format(
@@ -0,0 +1,104 @@
+import asyncio
+import re
+from collections import defaultdict, namedtuple
+
+# Every line the server prints
+ConsoleLine = namedtuple('ConsoleLine', ['line'])
+
+# Events parsed out of the server log
+PlayerJoined = namedtuple('PlayerJoined', ['player'])
+PlayerLeft = namedtuple('PlayerLeft', ['player'])
+ServerReady = namedtuple('ServerReady', ['startup_time'])
+ServerLagging = namedtuple('ServerLagging', ['behind_ms', 'behind_ticks'])
+ServerStopping = namedtuple('ServerStopping', [])
+WorldSaved = namedtuple('WorldSaved', [])
+TpsReport = namedtuple('TpsReport', ['tps_1m', 'tps_5m', 'tps_15m'])
+PlayerCount = namedtuple('PlayerCount', ['online', 'max'])
+
+
+def to_float(value):
+    return float(value.lstrip('*').replace(',', '.'))
+
+
+class LogParser:
+    """
+    Turns server log lines into typed events. Every known vanilla/Paper message is folded into one
+    precompiled alternation, so each line is matched once no matter how many patterns there are
+    """
+
+    # `[12:00:00] [Server thread/INFO]: ` (vanilla) or `[12:00:00 INFO]: ` (Paper)
+    line_prefix = re.compile(r'\[[^\]]*\](?: \[[^\]]*\])?: ')
+    color_codes = re.compile(r'\x1b\[[0-9;]*m|§.')
+
+    patterns = [
+        ('PlayerJoined', r'(?P<join_player>\w{1,16}) joined the game$'),
+        ('PlayerLeft', r'(?P<left_player>\w{1,16}) left the game$'),
+        ('ServerReady', r'Done \((?P<startup_time>[\d.,]+)s\)! For help'),
+        ('ServerLagging', r"Can't keep up! Is the server overloaded\? Running (?P<behind_ms>\d+)ms or "
+                          r"(?P<behind_ticks>\d+) ticks behind"),
+        ('ServerStopping', r'Stopping (?:the )?server'),
+        ('WorldSaved', r'Saved the game'),
+        ('TpsReport', r'TPS from last 1m, 5m, 15m: (?P<tps_1m>\*?[\d.]+), (?P<tps_5m>\*?[\d.]+), '
+                      r'(?P<tps_15m>\*?[\d.]+)'),
+        ('PlayerCount', r'There are (?P<online>\d+) (?:of a max of|out of maximum) (?P<max>\d+) players online')
+    ]
+
+    builders = {
+        'PlayerJoined': lambda m: PlayerJoined(m.group('join_player')),
+        'PlayerLeft': lambda m: PlayerLeft(m.group('left_player')),
+        'ServerReady': lambda m: ServerReady(to_float(m.group('startup_time'))),
+        'ServerLagging': lambda m: ServerLagging(int(m.group('behind_ms')), int(m.group('behind_ticks'))),
+        'ServerStopping': lambda m: ServerStopping(),
+        'WorldSaved': lambda m: WorldSaved(),
+        'TpsReport': lambda m: TpsReport(
+            to_float(m.group('tps_1m')), to_float(m.group('tps_5m')), to_float(m.group('tps_15m'))),
+        'PlayerCount': lambda m: PlayerCount(int(m.group('online')), int(m.group('max')))
+    }
+
+    def __init__(self):
+        self.pattern = re.compile('|'.join('(?P<{}>{})'.format(name, i) for name, i in self.patterns))
+
+    def parse(self, line):
+        if '\x1b' in line or '§' in line:
+            line = self.color_codes.sub('', line)
+
+        # Skip past the timestamp/thread prefix, so chat messages can't pass for server messages
+        prefix = self.line_prefix.match(line)
+        match = self.pattern.match(line, prefix.end() if prefix else 0)
+        if not match:
+            return None
+
+        return self.builders[match.lastgroup](match)
+
+
+class EventBus:
+    """
+    In-process publish/subscribe for server events. Callbacks can be plain functions or coroutine
+    functions (which are scheduled on the running loop)
+    """
+
+    def __init__(self, on_error=None):
+        self.subscribers = defaultdict(list)
+        self.on_error = on_error
+
+    def subscribe(self, event_type, callback):
+        self.subscribers[event_type].append(callback)
+        return lambda: self.unsubscribe(event_type, callback)
+
+    def subscribe_all(self, callback):
+        return self.subscribe(None, callback)
+
+    def unsubscribe(self, event_type, callback):
+        if callback in self.subscribers[event_type]:
+            self.subscribers[event_type].remove(callback)
+
+    def publish(self, event):
+        callbacks = self.subscribers.get(type(event), []) + self.subscribers.get(None, [])
+        for callback in callbacks:
+            try:
+                result = callback(event)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as ex:
+                if self.on_error:
+                    self.on_error(event, ex)
@@ -0,0 +1,120 @@
+import os
+import re
+
+
+def translate_pattern(pattern):
+    # Turns a gitignore style glob into a regex matching paths relative to the root (`world/region/r.0.0.mca`)
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = []
+    i = 0
+
+    while i < len(pattern):
+        char = pattern[i]
+        at_segment_start = i == 0 or pattern[i - 1] == '/'
+
+        if pattern.startswith('**', i) and at_segment_start and (i + 2 == len(pattern) or pattern[i + 2] == '/'):
+            # `**/` is any number of directories, and a trailing `/**` is everything inside
+            parts.append('.*' if i + 2 == len(pattern) else '(?:.*/)?')
+            i += 3
+            continue
+
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end]
+            body = '^' + body[1:] if body.startswith('!') else body
+            parts.append('[{}]'.format(body.replace('\\', '\\\\')))
+            i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+
+        i += 1
+
+    # Patterns without a slash match a name at any depth
+    return ('' if anchored else '(?:.*/)?') + ''.join(parts)
+
+
+class IgnoreRule:
+
+    def __init__(self, pattern, negate=False, dir_only=False):
+        self.pattern = pattern
+        self.negate = negate
+        self.dir_only = dir_only
+        self.regex = translate_pattern(pattern)
+
+
+class IgnoreRules:
+    """
+    Exclusion rules with .gitignore semantics: `*.log`, `/world/stats/`, `plugins/dynmap/web/tiles/`,
+    `!important.log`, ... The last rule that matches a path decides. Every rule is compiled into one regex
+    (one for files and one for directories), so checking a path is a single match no matter how many
+    rules there are
+    """
+
+    def __init__(self, patterns=None):
+        self.rules = []
+        self.file_regex = None
+        self.dir_regex = None
+        self.compiled = False
+
+        for pattern in patterns or []:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = pattern.rstrip('\n\r')
+        if not pattern.endswith('\\ '):
+            pattern = pattern.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return
+
+        negate = pattern.startswith('!')
+        if negate or pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if pattern:
+            self.rules.append(IgnoreRule(pattern, negate, dir_only))
+            self.compiled = False
+
+    def read(self, path):
+        # A missing ignore file is the same as an empty one
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.add(line)
+        except FileNotFoundError:
+            pass
+
+        return self
+
+    def compile(self):
+        # The newest rule comes first, so the alternative that matches is the one that decides
+        def build(rules):
+            if not rules:
+                return None
+
+            return re.compile('|'.join('(?P<r{}>{})'.format(index, rule.regex) for index, rule in reversed(rules)))
+
+        rules = list(enumerate(self.rules))
+        self.file_regex = build([i for i in rules if not i[1].dir_only])
+        self.dir_regex = build(rules)
+        self.compiled = True
+
+    def is_excluded(self, rel_path, is_dir=False):
+        if not self.compiled:
+            self.compile()
+
+        regex = self.dir_regex if is_dir else self.file_regex
+        if regex is None:
+            return False
+
+        match = regex.fullmatch(rel_path if os.sep == '/' else rel_path.replace(os.sep, '/'))
+        return bool(match) and not self.rules[int(match.lastgroup[1:])].negate
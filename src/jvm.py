@@ -0,0 +1,238 @@
+import math
+import os
+import re
+import subprocess
+
+MEMORY_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# Aikar's G1 flags (https://docs.papermc.io/paper/aikars-flags), with the larger young generation
+# settings he recommends for heaps over 12 GB
+AIKAR_FLAGS = [
+    '-XX:+UseG1GC', '-XX:+ParallelRefProcEnabled', '-XX:MaxGCPauseMillis=200', '-XX:+UnlockExperimentalVMOptions',
+    '-XX:+DisableExplicitGC', '-XX:+AlwaysPreTouch', '-XX:G1HeapWastePercent=5', '-XX:G1MixedGCCountTarget=4',
+    '-XX:G1MixedGCLiveThresholdPercent=90', '-XX:G1RSetUpdatingPauseTimePercent=5', '-XX:SurvivorRatio=32',
+    '-XX:+PerfDisableSharedMem', '-XX:MaxTenuringThreshold=1', '-Dusing.aikars.flags=https://mcflags.emc.gs',
+    '-Daikars.new.flags=true'
+]
+AIKAR_SMALL_HEAP_FLAGS = [
+    '-XX:G1NewSizePercent=30', '-XX:G1MaxNewSizePercent=40', '-XX:G1HeapRegionSize=8M', '-XX:G1ReservePercent=20',
+    '-XX:InitiatingHeapOccupancyPercent=15'
+]
+AIKAR_LARGE_HEAP_FLAGS = [
+    '-XX:G1NewSizePercent=40', '-XX:G1MaxNewSizePercent=50', '-XX:G1HeapRegionSize=16M', '-XX:G1ReservePercent=15',
+    '-XX:InitiatingHeapOccupancyPercent=20'
+]
+
+PROFILES = ['default', 'aikar', 'zgc']
+
+
+def parse_memory(value):
+    # `2G`, `512M`, `1048576` (bytes) -> bytes
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in MEMORY_UNITS:
+        return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+
+    return int(value)
+
+
+def format_memory(size):
+    # Whole megabytes, which every JVM understands
+    return '{}M'.format(max(1, size // MEMORY_UNITS['M']))
+
+
+def get_host_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_java_version(java_path='java'):
+    # `java -version` prints `1.8.0_292` for Java 8 and `17.0.2` from 9 on, to stderr
+    try:
+        output = subprocess.run([java_path, '-version'], capture_output=True, text=True, timeout=30).stderr
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+    if not match:
+        return None
+
+    major = int(match.group(1))
+    return int(match.group(2) or 0) if major == 1 else major
+
+
+def get_auto_heap_size(host_memory, share=1.0):
+    # Leave room for the OS, the JVM's own off-heap memory and everything else on the box (a quarter of
+    # the RAM, but at least 1.5 GB), then split what's left between the servers sharing the host
+    reserved = max(int(1.5 * MEMORY_UNITS['G']), host_memory // 4)
+    return max(512 * MEMORY_UNITS['M'], int((host_memory - reserved) * share))
+
+
+class JvmOptions:
+    """
+    Builds the JVM arguments for a server: heap sizes (fixed or sized from the host's RAM), the GC
+    flags of a launch profile, and unified GC logging for the GC log analyzer
+    """
+
+    def __init__(self, profile='default', min_memory='2G', max_memory='2G', gc_log_path=None, heap_share=1.0):
+        if profile not in PROFILES:
+            raise ValueError('Unknown JVM profile: {}. Use one of: {}'.format(profile, ', '.join(PROFILES)))
+
+        self.profile = profile
+        self.gc_log_path = gc_log_path
+        self.min_heap, self.max_heap = self.get_heap_sizes(min_memory, max_memory, heap_share)
+
+    def get_heap_sizes(self, min_memory, max_memory, heap_share):
+        if str(max_memory).lower() == 'auto':
+            host_memory = get_host_memory()
+            if not host_memory:
+                raise ValueError('Unable to read the host\'s memory size. Set `max_java_memory` instead of `auto`')
+
+            max_heap = get_auto_heap_size(host_memory, heap_share)
+        else:
+            max_heap = parse_memory(max_memory)
+
+        # Committing the whole heap up front avoids resizing pauses, which is what auto sizing does
+        if 'auto' in [str(min_memory).lower(), str(max_memory).lower()]:
+            min_heap = max_heap
+        else:
+            min_heap = min(parse_memory(min_memory), max_heap)
+
+        return min_heap, max_heap
+
+    def get_args(self):
+        args = ['-Xms{}'.format(format_memory(self.min_heap)), '-Xmx{}'.format(format_memory(self.max_heap))]
+
+        if self.profile == 'aikar':
+            large_heap = self.max_heap > 12 * MEMORY_UNITS['G']
+            args += AIKAR_FLAGS + (AIKAR_LARGE_HEAP_FLAGS if large_heap else AIKAR_SMALL_HEAP_FLAGS)
+        elif self.profile == 'zgc':
+            args += ['-XX:+UseZGC', '-XX:+AlwaysPreTouch', '-XX:+DisableExplicitGC', '-XX:+PerfDisableSharedMem']
+
+        if self.gc_log_path:
+            args.append('-Xlog:gc*:file={}:time,uptime,level,tags:filecount=5,filesize=20M'.format(self.gc_log_path))
+
+        return args
+
+    def describe(self):
+        return '{} profile, {} - {} heap'.format(
+            self.profile, format_memory(self.min_heap), format_memory(self.max_heap))
+
+
+class GcLogAnalyzer:
+    """
+    Follows a unified JVM GC log (`-Xlog:gc*`) and keeps the pauses it reports, for pause time
+    percentiles, GC overhead and the allocation rate
+    """
+
+    # `[...][12.345s][info][gc          ] GC(12) Pause Young (Normal) (G1 Evacuation Pause) 512M->128M(2048M) 12.345ms`
+    # ZGC pauses have no heap sizes: `[...][gc,phases   ] GC(3) Pause Mark Start 0.012ms`
+    pause_pattern = re.compile(
+        r'\[(?P<uptime>[\d.]+)s\].*?GC\((?P<id>\d+)\) (?P<kind>Pause .*?)'
+        r'(?: (?P<before>\d+)(?P<before_unit>[KMG])->(?P<after>\d+)(?P<after_unit>[KMG])\(\d+[KMG]\))?'
+        r' (?P<duration>[\d.]+)ms\s*$')
+
+    def __init__(self, log_path, max_pauses=10000):
+        self.log_path = log_path
+        self.max_pauses = max_pauses
+        self.offset = 0
+        self.pauses = []
+        self.collections = []
+        self.first_uptime = None
+        self.last_uptime = None
+
+    def reset(self):
+        self.offset = 0
+        self.pauses = []
+        self.collections = []
+        self.first_uptime = None
+        self.last_uptime = None
+
+    def update(self):
+        # Only read what's been added since the last update
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+        if size < self.offset:
+            # The JVM restarted (or rotated the log), so start over
+            self.reset()
+
+        count = 0
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                # Leave a partly written line for next time
+                if not line.endswith(b'\n'):
+                    break
+
+                self.offset += len(line)
+                count += self.parse_line(line.decode('utf-8', errors='replace'))
+
+        self.pauses = self.pauses[-self.max_pauses:]
+        self.collections = self.collections[-self.max_pauses:]
+        return count
+
+    def parse_line(self, line):
+        if 'Pause' not in line:
+            return 0
+
+        match = self.pause_pattern.search(line)
+        if not match:
+            return 0
+
+        uptime = float(match.group('uptime'))
+        self.first_uptime = uptime if self.first_uptime is None else self.first_uptime
+        self.last_uptime = uptime
+        self.pauses.append(float(match.group('duration')))
+
+        if match.group('before'):
+            self.collections.append((
+                uptime,
+                int(match.group('before')) * MEMORY_UNITS[match.group('before_unit')],
+                int(match.group('after')) * MEMORY_UNITS[match.group('after_unit')]))
+
+        return 1
+
+    def get_allocation_rate(self):
+        # Whatever the heap grew by between one collection and the next was allocated by the server
+        if len(self.collections) < 2:
+            return None
+
+        allocated = sum(max(0, cur[1] - prev[2]) for prev, cur in zip(self.collections, self.collections[1:]))
+        elapsed = self.collections[-1][0] - self.collections[0][0]
+        return allocated / elapsed if elapsed > 0 else None
+
+    def report(self):
+        if not self.pauses:
+            return None
+
+        pauses = sorted(self.pauses)
+        elapsed = (self.last_uptime or 0) - (self.first_uptime or 0)
+        return {
+            'pauses': len(pauses),
+            'p50': percentile(pauses, 0.50),
+            'p95': percentile(pauses, 0.95),
+            'p99': percentile(pauses, 0.99),
+            'max': pauses[-1],
+            'overhead': sum(pauses) / 1000 / elapsed if elapsed > 0 else None,
+            'allocation_rate': self.get_allocation_rate()
+        }
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def describe_gc_report(report):
+    if not report:
+        return 'no GC pauses logged yet'
+
+    return '{} pauses | p50 {:.1f}ms | p95 {:.1f}ms | p99 {:.1f}ms | max {:.1f}ms | {} in GC | allocating {}'.format(
+        report['pauses'], report['p50'], report['p95'], report['p99'], report['max'],
+        '{:.2%}'.format(report['overhead']) if report['overhead'] is not None else '?',
+        '{:.1f} MB/s'.format(report['allocation_rate'] / MEMORY_UNITS['M'])
+        if report['allocation_rate'] is not None else '?')
@@ -0,0 +1,155 @@
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+from logging import handlers
+
+
+def compress_rotated_log(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def gzip_namer(name):
+    return '{}.gz'.format(name)
+
+
+class DroppingQueueHandler(handlers.QueueHandler):
+    """
+    Queue handler that never blocks the caller on a full queue for chatty records (server console output
+    is logged at DEBUG). Warnings and errors apply a little backpressure instead, so they're rarely lost
+    """
+
+    def __init__(self, log_queue, block_timeout=1.0):
+        super().__init__(log_queue)
+        self.setFormatter(logging.Formatter('%(message)s'))
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def take_dropped(self):
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+
+        return dropped
+
+
+class BatchLogWriter:
+    """
+    Background thread that drains the log queue and writes records in batches, with a single write and
+    flush per handler per batch instead of one per line
+    """
+
+    def __init__(self, log_queue, handler_list, queue_handler, batch_size=512):
+        self.queue = log_queue
+        self.handlers = handler_list
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopping = True
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+        for handler in self.handlers:
+            handler.close()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = None in batch
+            batch = [i for i in batch if i is not None]
+
+            # Let the log know when we couldn't keep up
+            dropped = self.queue_handler.take_dropped()
+            if dropped:
+                batch.append(logging.makeLogRecord({
+                    'name': 'minecraft-manager', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Logging fell behind, dropped {} console line(s)'.format(dropped)}))
+
+            for handler in self.handlers:
+                self.write_batch(handler, batch)
+
+            if done or (self.stopping and self.queue.empty()):
+                break
+
+    def write_batch(self, handler, batch):
+        with handler.lock:
+            try:
+                for record in batch:
+                    if record.levelno < handler.level or not handler.filter(record):
+                        continue
+
+                    if isinstance(handler, handlers.RotatingFileHandler) and handler.shouldRollover(record):
+                        handler.doRollover()
+
+                    if handler.stream is None:
+                        handler.stream = handler._open()
+
+                    handler.stream.write(handler.format(record) + handler.terminator)
+
+                handler.flush()
+            except Exception:
+                if batch:
+                    handler.handleError(batch[-1])
+
+
+class LogPipeline:
+
+    def __init__(self, log_path, queue_size=10000, max_bytes=104857600, backup_count=5,
+                 log_format='[%(asctime)s] [%(levelname)s]: %(message)s'):
+        formatter = logging.Formatter(log_format)
+
+        # Rotated logs are gzipped by the writer thread
+        file_handler = handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+        file_handler.namer = gzip_namer
+        file_handler.rotator = compress_rotated_log
+
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        for handler in [file_handler, stdout_handler]:
+            handler.setFormatter(formatter)
+
+        self.queue = queue.Queue(maxsize=int(queue_size))
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.writer = BatchLogWriter(self.queue, [file_handler, stdout_handler], self.queue_handler)
+
+    def start(self):
+        self.writer.start()
+
+        # Flush whatever is still queued when the process exits
+        atexit.register(self.stop)
+        return self.queue_handler
+
+    def stop(self):
+        self.writer.stop()
@@ -1,17 +1,27 @@
 import asyncio
+import json
 import os
-import subprocess
-from datetime import datetime
-from threading import Timer
+import signal
+from datetime import datetime, timedelta
 import logging
-from logging import handlers
 from pathlib import Path
 import sys
+import time
 import traceback
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from .utils import get_with_default
-from .backup import BackupManager
+from .backup import BackupCancelled, BackupManager, BackupMode
+from .compression import CompressionPolicy
+from .storage import Replicator, create_storage
 from .discord import DiscordManager
+from .anvil import get_region_coords, read_level_spawn
+from .jvm import JvmOptions, GcLogAnalyzer, describe_gc_report, get_java_version
+from .log import LogPipeline
+from .metrics import MetricsRegistry, MetricsServer
+from .scheduler import CommandScheduler, Priority
+from .throttle import lower_thread_priority
+from .events import EventBus, LogParser, ConsoleLine, PlayerJoined, PlayerLeft, ServerLagging, ServerReady, \
+    TpsReport, WorldSaved
 
 
 class ManagerState:
@@ -21,6 +31,53 @@ class ManagerState:
     QUITING = 3
 
 
+async def listen_for_commands(manager):
+    # Reads commands from the stdin of this process and hands them to `manager.command_handler`
+    manager.log('Listening for input commands...', level='debug')
+
+    try:
+        reader = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (ValueError, OSError) as ex:
+        manager.log('Unable to listen for input commands: {}'.format(str(ex)), level='warn')
+        return
+
+    try:
+        while manager.state != ManagerState.QUITING:
+            line = await reader.readline()
+            if not line:
+                break
+
+            line = line.decode('utf-8', errors='replace').rstrip()
+            if not line:
+                continue
+
+            # Don't wait for the command, so `status` or `stop` can still be typed while a backup runs. The loop
+            # only keeps weak references to tasks, so they're held here until they finish
+            task = asyncio.create_task(run_command(manager, line))
+            manager.command_tasks.add(task)
+            task.add_done_callback(manager.command_tasks.discard)
+    finally:
+        # Hand stdin back to the terminal the way we found it
+        try:
+            os.set_blocking(sys.stdin.fileno(), True)
+        except (ValueError, OSError):
+            pass
+
+    manager.log('Stopped listening for input commands', level='debug')
+
+
+async def run_command(manager, line):
+    try:
+        await manager.command_handler(line)
+    except asyncio.CancelledError:
+        manager.log('Cancelled command, "{}"'.format(line), level='debug')
+    except Exception as ex:
+        manager.log('Failed to handle command, "{}"! Error: {}'.format(line, str(ex)),
+                    level='error', with_traceback=True)
+
+
 class MinecraftManager:
 
     required_fields = [
@@ -28,7 +85,30 @@ class MinecraftManager:
         'min_java_memory', 'max_java_memory'
     ]
 
+    # Commands handled by the manager itself (anything else is forwarded to the server)
+    manager_commands = [
+        'start', 'restart', 'stop', 'quit', 'exit', 'backup', 'backup-now', 'cancel-backup-timer', 'cancel-backup',
+        'cancel-backup-schedule', 'start-backup', 'start-backup-timer', 'restore', 'restore-last', 'restore-file',
+        'restore-region', 'list-backups', 'backups', 'verify-backups', 'verify', 'stats', 'status', 'help'
+    ]
+
+    # Commands that change the server's state take turns through the command scheduler. Starting and stopping
+    # keep their order among themselves, and all of them go ahead of routine backups
+    command_priorities = {
+        'start': Priority.URGENT, 'stop': Priority.URGENT, 'restart': Priority.URGENT, 'restore': Priority.URGENT,
+        'restore-last': Priority.URGENT, 'restore-file': Priority.NORMAL, 'restore-region': Priority.NORMAL,
+        'backup': Priority.ROUTINE, 'backup-now': Priority.ROUTINE, 'verify-backups': Priority.ROUTINE,
+        'verify': Priority.ROUTINE
+    }
+    command_aliases = {'backup-now': 'backup', 'restore-last': 'restore', 'verify': 'verify-backups'}
+
+    # Asking for one of these while one is already waiting just waits for that one
+    coalesced_commands = ['backup', 'verify-backups']
+
     def __init__(self, server_path, **kwargs):
+        # Set when this is one of several servers run by a ServerSupervisor
+        self.name = kwargs.get('name')
+        self.supervisor = kwargs.get('supervisor')
         self.state = ManagerState.INACTIVE
         self.current_dir = os.getcwd()
         self.server_path = server_path
@@ -41,12 +121,117 @@ class MinecraftManager:
         self.min_java_memory = get_with_default(kwargs, 'min_java_memory', default='2G')
         self.max_java_memory = get_with_default(kwargs, 'max_java_memory', default='2G')
         self.discord_api_token = kwargs.get('discord_api_token')
+        self.discord_console_channel = kwargs.get('discord_console_channel')
+        self.discord_status_channel = kwargs.get('discord_status_channel')
+        self.discord_console_interval = get_with_default(kwargs, 'discord_console_interval', default=2)
+        self.discord_status_interval = get_with_default(kwargs, 'discord_status_interval', default=15)
+        self.backup_mode = get_with_default(kwargs, 'backup_mode', default=BackupMode.FULL)
+        self.compression_workers = get_with_default(kwargs, 'compression_workers', default=os.cpu_count())
+        self.compression = get_with_default(kwargs, 'compression', default='default')
+        self.compression_rules = [i for i in get_with_default(kwargs, 'compression_rules', default=[]) if i]
+        self.compression_sampling = bool(kwargs.get('compression_sampling'))
+        self.save_timeout = get_with_default(kwargs, 'save_timeout', default=60)
+        self.max_backups = get_with_default(kwargs, 'max_backups', default=10)
+        self.keep_daily = get_with_default(kwargs, 'keep_daily', default=0)
+        self.keep_weekly = get_with_default(kwargs, 'keep_weekly', default=0)
+        self.keep_monthly = get_with_default(kwargs, 'keep_monthly', default=0)
+        self.log_queue_size = get_with_default(kwargs, 'log_queue_size', default=10000)
+        self.metrics_port = kwargs.get('metrics_port')
+        self.align_backups = kwargs.get('align_backups') is not False
+        self.skip_idle_backups = kwargs.get('skip_idle_backups') is not False
+        self.min_backup_tps = kwargs.get('min_backup_tps')
+        self.min_backup_tps = 18 if self.min_backup_tps is None else self.min_backup_tps
+        self.backup_defer_delay = get_with_default(kwargs, 'backup_defer_delay', default=300)
+        self.max_backup_deferral = get_with_default(kwargs, 'max_backup_deferral', default=3600)
+        self.backup_nice = kwargs.get('backup_nice')
+        self.backup_nice = 10 if self.backup_nice is None else self.backup_nice
+        self.backup_io_priority = get_with_default(kwargs, 'backup_io_priority', default='low')
+        self.backup_read_limit = get_with_default(kwargs, 'backup_read_limit', default=0)  # MB/s
+        self.backup_cpu_limit = get_with_default(kwargs, 'backup_cpu_limit', default=0)  # Cores
+        self.backup_offset = get_with_default(kwargs, 'backup_offset', default=0)
+        self.java_path = get_with_default(kwargs, 'java_path', default='java')
+        self.jvm_profile = get_with_default(kwargs, 'jvm_profile', default='default')
+        self.heap_share = get_with_default(kwargs, 'heap_share', default=1.0)
+        self.gc_logging = bool(kwargs.get('gc_logging'))
+        self.gc_report_interval = get_with_default(kwargs, 'gc_report_interval', default=3600)
+        self.startup_timeout = get_with_default(kwargs, 'startup_timeout', default=600)
+        self.stop_timeout = get_with_default(kwargs, 'stop_timeout', default=120)
+        self.prewarm_spawn = bool(kwargs.get('prewarm_spawn'))
+        self.prewarm_radius = get_with_default(kwargs, 'prewarm_radius', default=1)
+        self.staged_restore = kwargs.get('staged_restore') is not False
+        self.staged_backups = bool(kwargs.get('staged_backups'))
+        self.replicate_to = [i for i in get_with_default(kwargs, 'replicate_to', default=[]) if i]
+        self.replication_workers = get_with_default(kwargs, 'replication_workers', default=4)
+        self.replication_bandwidth = get_with_default(kwargs, 'replication_bandwidth', default=0)  # MB/s
+        self.s3_endpoint = kwargs.get('s3_endpoint')
+        self.s3_region = kwargs.get('s3_region')
+        self.sftp_key_file = kwargs.get('sftp_key_file')
+        self.replication_backends = []
+        self.replicator = None
+        self.save_complete = None
+        self.server_ready = None
+        self.tps_reported = None
+        self.quit_event = None
+        self.quit_requested = None
+        self.backup_slot = None
+        self.scheduler = None
+        self.running_backup = None
+        self.command_tasks = set()
+        self.exit_code = 0
         self.process = None
+        self.listen_task = None
+        self.backup_timer = None
+        self.gc_task = None
         self.discord = None
+        self.discord_task = None
+        self.players = set()
+        self.players_seen = False
+        self.last_lag = None
+        self.last_tps = None
+        self.tps_supported = None
+        self.next_backup_time = None
+        self.last_backup_time = None
+        self.backup_deferred_since = None
+        self.server_started_at = None
+        self.last_prewarm = None
+        self.log_parser = LogParser()
+        self.metrics = MetricsRegistry({'instance': self.name} if self.name else None)
+        self.metrics_server = None
+        self.started_at = time.monotonic()
+        self.stats_checkpoint = (self.started_at, 0)
+        self.events = EventBus(on_error=self.on_event_error)
+        self.subscribe_events()
 
         self.validate_config()
         self.configure_logging()
 
+        # Unified GC logging (`-Xlog`) only exists from Java 9 on, and Java 8 refuses to start with it
+        if self.gc_logging:
+            java_version = get_java_version(self.java_path)
+            if java_version is not None and java_version < 9:
+                self.log('GC logging needs Java 9 or newer, but {} is Java {}. Starting without it'.format(
+                    self.java_path, java_version), level='warn')
+                self.gc_logging = False
+
+        # Unified GC logging goes to the server's logs directory, where the analyzer follows it
+        gc_log_path = os.path.join(self.get_jar_dir(), 'logs', 'gc.log') if self.gc_logging else None
+        self.jvm_options = JvmOptions(self.jvm_profile, self.min_java_memory, self.max_java_memory,
+                                      gc_log_path=gc_log_path, heap_share=self.heap_share)
+        self.gc_analyzer = GcLogAnalyzer(gc_log_path) if gc_log_path else None
+
+        # How long every start took, kept next to the server's own logs
+        self.startup_history_path = os.path.join(self.get_jar_dir(), 'logs', 'startup-history.jsonl')
+        self.startup_history = self.load_startup_history()
+
+        # Snapshots run on their own thread, with lowered CPU and I/O priority so the server's ticks come first.
+        # Supervised servers share the supervisor's pool instead
+        if self.supervisor:
+            self.backup_executor = self.supervisor.backup_executor
+        else:
+            self.backup_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='backup', initializer=lower_thread_priority,
+                initargs=(self.backup_nice, self.backup_io_priority))
+
     def validate_config(self):
         for key in self.required_fields:
             if hasattr(self, key) and not getattr(self, key):
@@ -58,21 +243,82 @@ class MinecraftManager:
         except:
             raise ValueError('Parameter, `backup_frequency` is not a valid integer!')
 
+        try:
+            self.save_timeout = float(self.save_timeout)
+        except:
+            raise ValueError('Parameter, `save_timeout` is not a valid number!')
+
+        try:
+            self.min_backup_tps = float(self.min_backup_tps)
+            self.backup_offset = float(self.backup_offset)
+            self.backup_defer_delay = float(self.backup_defer_delay)
+            self.max_backup_deferral = float(self.max_backup_deferral)
+        except:
+            raise ValueError('Parameters, `min_backup_tps`, `backup_offset`, `backup_defer_delay` and '
+                             '`max_backup_deferral` must be numbers!')
+
+        try:
+            self.heap_share = float(self.heap_share)
+            self.gc_report_interval = float(self.gc_report_interval)
+            self.startup_timeout = float(self.startup_timeout)
+            self.stop_timeout = float(self.stop_timeout)
+            self.prewarm_radius = int(self.prewarm_radius)
+        except:
+            raise ValueError('Parameters, `heap_share`, `gc_report_interval`, `startup_timeout`, `stop_timeout` and '
+                             '`prewarm_radius` must be numbers!')
+
+        try:
+            self.backup_nice = int(self.backup_nice)
+            self.backup_read_limit = float(self.backup_read_limit)
+            self.backup_cpu_limit = float(self.backup_cpu_limit)
+        except:
+            raise ValueError('Parameters, `backup_nice`, `backup_read_limit` and `backup_cpu_limit` must be numbers!')
+
+        if self.backup_io_priority not in ['normal', 'low', 'idle']:
+            raise ValueError('Parameter, `backup_io_priority` must be one of normal, low or idle!')
+
+        # Raises for unknown codecs and malformed rules
+        CompressionPolicy(self.compression, self.compression_rules)
+
+        try:
+            self.replication_workers = int(self.replication_workers)
+            self.replication_bandwidth = float(self.replication_bandwidth)
+        except:
+            raise ValueError('Parameters, `replication_workers` and `replication_bandwidth` must be numbers!')
+
+        # Raises for unknown targets, missing credentials and missing optional dependencies
+        self.replication_backends = [
+            create_storage(i, s3_endpoint=self.s3_endpoint, s3_region=self.s3_region,
+                           sftp_key_file=self.sftp_key_file) for i in self.replicate_to]
+
+        try:
+            if self.metrics_port:
+                self.metrics_port = int(self.metrics_port)
+        except:
+            raise ValueError('Parameter, `metrics_port` is not a valid integer!')
+
     def configure_logging(self):
-        # Max size is 100 MB
-        file_handler = handlers.RotatingFileHandler(self.log_path, maxBytes=104857600, backupCount=5)
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        handler_list = [file_handler, stdout_handler]
+        # The supervisor owns the log pipeline when running several servers
+        if self.supervisor:
+            self.logger = logging.getLogger('minecraft-manager.{}'.format(self.name))
+            return
+
+        # Records are queued and written in batches by a background thread, so nothing that logs (especially
+        # the server output listener) ever waits on the disk. Log files rotate at 100 MB and are gzipped
+        self.log_pipeline = LogPipeline(self.log_path, queue_size=self.log_queue_size)
 
         logging.basicConfig(
-            level=logging.DEBUG, 
-            format='[%(asctime)s] [%(levelname)s]: %(message)s',
-            handlers=handler_list
+            level=logging.DEBUG,
+            handlers=[self.log_pipeline.start()]
         )
 
         self.logger = logging.getLogger('minecraft-manager')
+        logging.getLogger('asyncio').setLevel(logging.WARNING)
 
     def log(self, msg, level='info', with_traceback=False):
+        if self.name:
+            msg = '[{}] {}'.format(self.name, msg)
+
         if not self.logger:
             print('[{}] {}'.format(level, msg))
             if with_traceback:
@@ -83,51 +329,168 @@ class MinecraftManager:
             if with_traceback:
                 self.logger.debug(traceback.format_exc())
 
+    def subscribe_events(self):
+        self.events.subscribe(WorldSaved, lambda e: self.save_complete and self.save_complete.set())
+        self.events.subscribe(PlayerJoined, lambda e: self.players.add(e.player))
+        self.events.subscribe(PlayerJoined, lambda e: setattr(self, 'players_seen', True))
+        self.events.subscribe(TpsReport, self.on_tps_report)
+        self.events.subscribe(PlayerLeft, lambda e: self.players.discard(e.player))
+        self.events.subscribe(ServerLagging, self.on_server_lagging)
+        self.events.subscribe(ServerReady, self.on_server_ready)
+        self.events.subscribe(TpsReport, lambda e: self.metrics.gauge('minecraft_tps', 'Ticks per second').set(
+            e.tps_1m, window='1m'))
+
+        # Player count only changes on these, so keep the gauge current here instead of polling
+        players = self.metrics.gauge('minecraft_players_online', 'Players currently online')
+        self.events.subscribe(PlayerJoined, lambda e: players.set(len(self.players)))
+        self.events.subscribe(PlayerLeft, lambda e: players.set(len(self.players)))
+
+    def on_server_lagging(self, event):
+        self.last_lag = (datetime.utcnow(), event)
+        self.metrics.counter('minecraft_lag_warnings_total', '"Can\'t keep up!" warnings from the server').inc()
+        self.metrics.counter('minecraft_lag_behind_ms_total', 'Milliseconds the server reported falling behind').inc(
+            event.behind_ms)
+
+    def on_server_ready(self, event):
+        if self.server_ready:
+            self.server_ready.set()
+
+        if self.server_started_at is None:
+            return
+
+        duration = time.monotonic() - self.server_started_at
+        self.server_started_at = None
+        self.log('Minecraft server is ready! Started in {:.1f}s (the server reported {:.1f}s)'.format(
+            duration, event.startup_time))
+        self.metrics.histogram('minecraft_startup_duration_seconds', 'Time from launch until the server is ready').observe(
+            duration, prewarmed='yes' if self.last_prewarm else 'no')
+        self.record_startup(duration, event.startup_time)
+
+    def on_tps_report(self, event):
+        self.last_tps = (datetime.utcnow(), event)
+        if self.tps_reported:
+            self.tps_reported.set()
+
+    def on_event_error(self, event, ex):
+        self.log('Event subscriber failed to handle {}! Error: {}'.format(type(event).__name__, str(ex)),
+                 level='error', with_traceback=True)
+
     def start(self):
+        asyncio.run(self.run())
+
+    def create_loop_state(self):
+        # asyncio primitives have to be made on the loop that uses them
+        self.save_complete = asyncio.Event()
+        self.server_ready = asyncio.Event()
+        self.tps_reported = asyncio.Event()
+        self.quit_event = asyncio.Event()
+        self.quit_requested = asyncio.Event()
+        self.backup_slot = self.supervisor.backup_slot if self.supervisor else asyncio.Semaphore(1)
+        self.scheduler = CommandScheduler(log=self.log, metrics=self.metrics)
+
+    async def run(self):
+        self.create_loop_state()
+
         self.log('Starting Minecraft Manager...')
         self.log('Type `help` for a list of commands')
         self.log(' -> Using server executable: {}'.format(self.server_path), level='debug')
+        self.log(' -> JVM: {}'.format(self.jvm_options.describe()), level='debug')
         self.log(' -> Backing up every {} minutes to {}'.format(
             self.backup_frequency / 60, self.backup_dir), level='debug')
+        self.log(' -> Backup mode: {}'.format(self.backup_mode), level='debug')
+        self.log(' -> Compression: {}, compressed file types stored as-is{}{}'.format(
+            self.compression, ', {} rule(s)'.format(len(self.compression_rules)) if self.compression_rules else '',
+            ', sampling unknown file types' if self.compression_sampling else ''), level='debug')
+        if self.replication_backends:
+            self.log(' -> Replicating backups to: {}'.format(
+                ', '.join(i.describe() for i in self.replication_backends)), level='debug')
         self.log(' -> Excluding files: {}'.format(', '.join(self.excluded_files)), level='debug')
         self.log(' -> Excluding file types: {}'.format(', '.join(self.excluded_file_types)), level='debug')
         self.log(' -> Logging to file: {}'.format(self.log_path), level='debug')
 
-        # Listen for commands to the stdin of the parent process
-        self.read_thread = Thread(target=self.run_async_thread, args=(self.listen_for_stdin,))
-        self.read_thread.start()
+        # Serve metrics locally, if asked to
+        if self.metrics_port:
+            self.metrics_server = MetricsServer([self.metrics], port=self.metrics_port)
+            try:
+                await self.metrics_server.start()
+                self.log(' -> Serving metrics at: http://127.0.0.1:{}/metrics'.format(self.metrics_port), level='debug')
+            except OSError as ex:
+                self.log('Unable to serve metrics on port {}: {}'.format(self.metrics_port, str(ex)), level='warn')
+                self.metrics_server = None
 
-        # Start the server
-        self.start_server()
+        # Listen for commands to the stdin of the parent process
+        stdin_task = asyncio.create_task(self.listen_for_stdin())
 
-        # Start the backup timer
-        self.start_backup_timer()
+        # Start the server and the backup timer
+        await self.start_instance()
 
         # Start Discord Bot
         if self.discord_api_token:
-            self.discord = DiscordManager(self.discord_api_token, self)
-            self.discord.start()
+            self.discord = DiscordManager(
+                self.discord_api_token, self, console_channel=self.discord_console_channel,
+                status_channel=self.discord_status_channel, console_interval=self.discord_console_interval,
+                status_interval=self.discord_status_interval)
+            self.discord_task = asyncio.create_task(self.discord.start())
+
+        # Everything runs as tasks on this loop until someone asks us to quit
+        await self.quit_event.wait()
+
+        for task in [stdin_task, self.discord_task, self.backup_timer, self.gc_task] + list(self.command_tasks):
+            if task and not task.done() and task is not asyncio.current_task():
+                task.cancel()
+
+        if self.metrics_server:
+            await self.metrics_server.stop()
 
-    def run_async_thread(self, func):
-        asyncio.run(func())
+        self.backup_executor.shutdown(wait=False)
 
-    def start_server(self):
+    async def start_instance(self):
+        backup = self.get_backup_manager()
+        self.last_backup_time = backup.get_last_snapshot_time()
+
+        if self.replication_backends and not self.replicator:
+            self.replicator = Replicator(
+                self.replication_backends, backup.backup_path, workers=self.replication_workers,
+                bandwidth=self.replication_bandwidth * 1048576, priority=(self.backup_nice, self.backup_io_priority),
+                log=self.log, metrics=self.metrics)
+            self.replicator.resume()
+
+        await self.start_server()
+        self.start_backup_timer()
+
+        if self.gc_analyzer and self.gc_report_interval:
+            self.gc_task = asyncio.create_task(self.run_gc_reporter())
+
+    async def start_server(self):
         self.log('Starting Minecraft Server...')
 
-        # "CD" into the server directory
-        os.chdir(self.get_jar_dir())
+        # The JVM won't create the GC log's directory itself, and a new JVM means a new GC log
+        if self.gc_analyzer:
+            os.makedirs(os.path.dirname(self.gc_analyzer.log_path), exist_ok=True)
+            self.gc_analyzer.reset()
+
+        # Pull the spawn area into the page cache first, so the server doesn't wait on the disk for it
+        self.last_prewarm = None
+        if self.prewarm_spawn:
+            self.last_prewarm = await asyncio.get_running_loop().run_in_executor(None, self.prewarm_world)
 
-        # Start the process
-        self.process = subprocess.Popen(
-            self.get_command_parts(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.server_ready.clear()
+        self.server_started_at = time.monotonic()
+
+        # Start the process in the server directory. This doesn't change our own working directory, since
+        # other servers may be running from this process too
+        self.process = await asyncio.create_subprocess_exec(
+            *self.get_command_parts(), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=1048576, cwd=self.get_jar_dir())
         self.state = ManagerState.RUNNING
+        self.metrics.gauge('minecraft_server_up', 'Whether the server process is running').set(1)
+        self.metrics.counter('minecraft_server_starts_total', 'Times the server was started').inc()
 
         # Listen for commands to the stdout of the child process
-        self.listen_thread = Thread(target=self.run_async_thread, args=(self.listen_for_stdout,))
-        self.listen_thread.start()
+        self.listen_task = asyncio.create_task(self.listen_for_stdout(self.process))
 
     def start_backup_timer(self, force=False):
-        if hasattr(self, 'backup_timer') and self.backup_timer and self.backup_timer.is_alive():
+        if self.backup_timer and not self.backup_timer.done():
             if not force:
                 self.log('Backup timer already in progress. Not creating a new one...')
                 return
@@ -136,49 +499,178 @@ class MinecraftManager:
             self.backup_timer.cancel()
 
         try:
-            self.backup_timer = Timer(self.backup_frequency, self.perform_backup) # FIND NEXT HOURLY MARK
-            self.backup_timer.start()
-
-            next_time = datetime.timestamp(datetime.utcnow()) + self.backup_frequency
-            next_time = datetime.fromtimestamp(next_time)
-            logging.info('Backup timer started. Next backup at: {}'.format(
-                next_time.now().strftime('%Y-%m-%d %H:%M:%S')))
+            delay = self.get_next_backup_delay(datetime.now())
+            self.backup_timer = asyncio.create_task(self.run_backup_timer(delay))
+            self.next_backup_time = datetime.now() + timedelta(seconds=delay)
+            self.log('Backup timer started. Next backup at: {}'.format(
+                self.next_backup_time.strftime('%Y-%m-%d %H:%M:%S')))
         except Exception as ex:
             self.log('Failed to start backup timer! Error: {}'.format(
                 ex.message if hasattr(ex, 'message') else str(ex)))
 
+    def get_next_backup_delay(self, now):
+        if not self.align_backups:
+            return self.backup_frequency
+
+        # Line backups up with wall-clock marks counted from midnight, e.g. every 6 hours runs at 00:00, 06:00,
+        # 12:00 and 18:00. The offset shifts the marks (so several servers can take turns), and a mark that's
+        # only moments away (right after a manual backup) is skipped
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = (now - midnight).total_seconds() - self.backup_offset
+        delay = (elapsed // self.backup_frequency + 1) * self.backup_frequency - elapsed
+        if delay < self.backup_frequency * 0.1:
+            delay += self.backup_frequency
+
+        return delay
+
+    async def run_backup_timer(self, delay):
+        await asyncio.sleep(delay)
+
+        # Once the backup starts it's no longer a pending timer, so cancelling the timer won't interrupt it
+        self.backup_timer = None
+        await self.perform_scheduled_backup()
+
+    async def perform_scheduled_backup(self):
+        # Nothing to back up if nobody played and the world on disk hasn't changed
+        if self.skip_idle_backups and not self.players_seen:
+            backup = self.get_backup_manager()
+            last_time = backup.get_last_snapshot_time()
+            changed = last_time is None or await asyncio.get_running_loop().run_in_executor(
+                self.backup_executor, backup.has_changes_since, last_time)
+            if not changed:
+                self.log('Skipping backup. Nobody has played and no world files changed since the last one')
+                self.metrics.counter('minecraft_backups_skipped_total', 'Scheduled backups skipped').inc(reason='idle')
+                self.start_backup_timer()
+                return
+
+        # Don't add to the load while the server is struggling, but don't put the backup off forever either
+        reason = await self.get_backup_deferral_reason()
+        if reason:
+            now = time.monotonic()
+            self.backup_deferred_since = self.backup_deferred_since or now
+            if now - self.backup_deferred_since + self.backup_defer_delay <= self.max_backup_deferral:
+                self.log('Deferring backup for {}s, {}'.format(int(self.backup_defer_delay), reason))
+                self.metrics.counter('minecraft_backups_deferred_total', 'Scheduled backups put off').inc()
+                self.backup_timer = asyncio.create_task(self.run_backup_timer(self.backup_defer_delay))
+                return
+
+            self.log('Backup has been deferred for {}s, backing up anyway ({})'.format(
+                int(now - self.backup_deferred_since), reason), level='warn')
+
+        await self.scheduler.submit('backup', self.perform_backup, Priority.ROUTINE, key='backup')
+
+    async def get_backup_deferral_reason(self):
+        if not self.minecraft_running():
+            return None
+
+        if self.last_lag and (datetime.utcnow() - self.last_lag[0]).total_seconds() < self.backup_defer_delay:
+            return 'the server is lagging ({}ms behind)'.format(self.last_lag[1].behind_ms)
+
+        tps = await self.get_tps()
+        if tps is not None and tps < self.min_backup_tps:
+            return 'TPS is {} (minimum {})'.format(tps, self.min_backup_tps)
+
+        return None
+
+    async def get_tps(self):
+        # Paper-based servers report TPS on demand. Vanilla doesn't, so stop asking once it goes unanswered
+        if not self.min_backup_tps or self.tps_supported is False:
+            return None
+
+        self.tps_reported.clear()
+        self.run_server_command('tps')
+        try:
+            await asyncio.wait_for(self.tps_reported.wait(), 5)
+        except asyncio.TimeoutError:
+            self.log('Server did not report TPS. Only lag warnings will defer backups', level='debug')
+            self.tps_supported = False
+            return None
+
+        self.tps_supported = True
+        return self.last_tps[1].tps_1m
+
     async def command_handler(self, command):
         if not command:
             return
 
+        parts = command.strip().split(maxsplit=1)
+        label = parts[0].lower().replace('_', '-') if parts else ''
+
+        # The scheduler times queued commands itself, including how long they waited
+        if label in self.command_priorities:
+            name = self.command_aliases.get(label, label)
+            return await self.scheduler.submit(
+                name, lambda: self.handle_command(command), self.command_priorities[label],
+                key=name if name in self.coalesced_commands else None)
+
+        # Time every command, but keep server commands under one label so chat can't blow up the label set
+        start_time = time.monotonic()
+        try:
+            await self.handle_command(command)
+        finally:
+            self.metrics.histogram('minecraft_command_duration_seconds', 'Time spent handling console commands').observe(
+                time.monotonic() - start_time, command=label if label in self.manager_commands else 'server')
+
+    async def handle_command(self, command):
         self.log('Handling Command: "{}"'.format(command), level='debug')
         sani_cmd = command.lower().strip().replace('_', '-').replace(' ', '-')
-        if sani_cmd.lower() in ['start']:
+
+        # Some commands take arguments, so split those off of the command name
+        parts = command.strip().split(maxsplit=1)
+        cmd_name = parts[0].lower().replace('_', '-')
+        cmd_args = parts[1].strip() if len(parts) > 1 else ''
+
+        if cmd_name in ['restore-file']:
+            snapshot, _, path = cmd_args.partition(' ')
+            if not path.strip():
+                self.log('Usage: restore-file <snapshot|latest> <path>', level='warn')
+                return
+
+            await self.perform_restore_files(snapshot, path.strip())
+        elif cmd_name in ['restore-region']:
+            region_args = cmd_args.split()
+            if len(region_args) != 4 or not all(i.lstrip('-').isdigit() for i in region_args[2:]):
+                self.log('Usage: restore-region <snapshot|latest> <world> <region x> <region z>', level='warn')
+                return
+
+            snapshot, world, x, z = region_args
+            await self.perform_restore_files(snapshot, os.path.join(world, 'region', 'r.{}.{}.mca'.format(x, z)))
+        elif sani_cmd.lower() in ['start']:
             if self.process and self.state != ManagerState.INACTIVE:
                 self.log('Minecraft server is already running! Not starting it again...')
                 return
 
-            self.start_server()
+            await self.start_server()
+            await self.wait_until_ready()
         elif sani_cmd.lower() in ['restart']:
+            # Make sure the old server is completely gone before the new one starts
             if self.process and self.state == ManagerState.RUNNING:
-                await self.command_handler('stop')
-            self.start_server()
+                await self.stop_server()
+            await self.start_server()
+            await self.wait_until_ready()
         elif sani_cmd.lower() in ['stop']:
             if self.process and self.state == ManagerState.RUNNING:
-                self.run_server_command('stop')
-            self.state == ManagerState.INACTIVE
+                await self.stop_server()
         elif sani_cmd.lower() in ['quit', 'exit']:
             self.log('Quiting Minecraft Manager...')
             await self.stop_server(quit=True)
         elif sani_cmd.lower() in ['backup', 'backup-now']:
             self.stop_backup()
-            self.perform_backup(start_next_timer=True)
+            await self.perform_backup(start_next_timer=True)
         elif sani_cmd.lower() in ['cancel-backup-timer', 'cancel-backup', 'cancel-backup-schedule']:
             self.stop_backup()
         elif sani_cmd.lower() in ['start-backup', 'start-backup-timer']:
             self.start_backup_timer()
         elif sani_cmd.lower() in ['restore', 'restore-last']:
             await self.perform_restore_last_snapshot()
+        elif sani_cmd.lower() in ['list-backups', 'backups']:
+            self.display_backups()
+        elif sani_cmd.lower() in ['verify-backups', 'verify']:
+            await self.perform_verify_backups()
+        elif sani_cmd.lower() in ['stats']:
+            self.display_stats()
+        elif sani_cmd.lower() in ['status']:
+            self.display_status()
         elif sani_cmd.lower() in ['help']:
             self.display_help()
         elif self.process and self.state == ManagerState.RUNNING:
@@ -187,91 +679,244 @@ class MinecraftManager:
         else:
             self.log("Unable to handle command: {}! (State: {})".format(command, self.state))
 
-    async def listen_for_stdout(self):
-        if not self.process:
-            return
-
+    async def listen_for_stdout(self, process):
         self.log('Listening for Minecraft server outputs...', level='debug')
+        lines = self.metrics.counter('minecraft_console_lines_total', 'Lines read from the server console')
 
-        ret_code = None
-        for stdout_line in iter(self.process.stdout.readline, ""):
-            line = stdout_line.decode('utf-8').rstrip()
-            if line:
-                self.log(line, level='debug')
-            elif self.process.returncode is not None:
-                # If the process has returned, stop listening
-                ret_code = self.process.returncode
-                break
-            
-            if (self.state != ManagerState.RUNNING):
-                ret_code = -1
-                break
+        while True:
+            try:
+                stdout_line = await process.stdout.readline()
+            except ValueError:
+                # Skip over lines too long to buffer
+                continue
 
-            if not self.process or not self.process.stdout or self.process.stdout.closed:
-                ret_code = 0
+            # An empty read means the pipe was closed
+            if not stdout_line:
                 break
 
-        self.log('Stopped listening for Minecraft server outputs...', level='debug')
-        
-        if ret_code in [None, -1]:
-            self.log('Waiting for Minecraft server to close...', level='debug')
+            line = stdout_line.decode('utf-8', errors='replace').rstrip()
+            if line:
+                self.log(line, level='debug')
+                lines.inc()
 
-            try:
-                ret_code = self.process.wait()
-            except:
-                pass
+                # Let subscribers know about the line, and anything it tells us about the server
+                self.events.publish(ConsoleLine(line))
+                event = self.log_parser.parse(line)
+                if event is not None:
+                    self.events.publish(event)
 
-            self.log('Minecraft server closed', level='debug')
+        self.log('Stopped listening for Minecraft server outputs...', level='debug')
+        self.log('Waiting for Minecraft server to close...', level='debug')
+        ret_code = await process.wait()
+        self.log('Minecraft server closed', level='debug')
 
-        if ret_code and ret_code != 130:  # 130 is SIGKILL/SIGTERM
+        if ret_code and ret_code not in [130, -signal.SIGTERM]:  # 130 is SIGKILL/SIGTERM
             self.log('Subprocess error detected! Code: {}; Command: {}'.format(ret_code, self.get_run_command()))
 
-        self.listen_thread = None
-        await self.stop_server()
+        # Nobody can be online on a stopped server
+        if process is self.process:
+            self.players.clear()
+            self.metrics.gauge('minecraft_players_online', 'Players currently online').set(0)
+            self.metrics.gauge('minecraft_server_up', 'Whether the server process is running').set(0)
 
-    async def listen_for_stdin(self):
-        self.log('Listening for input commands...', level='debug')
+        # Sum up how the GC did over this run of the server
+        if self.gc_analyzer and process is self.process:
+            self.update_gc_report()
+            self.log('GC over this run: {}'.format(describe_gc_report(self.gc_analyzer.report())))
 
-        for line in iter(sys.stdin.readline, ""):   
-            if self.state == ManagerState.QUITING or not sys.stdin or sys.stdin.closed:
-                break
-            if line:
-                await self.command_handler(line.rstrip())
+        # The server stopped on its own (crash, or `stop` from in-game)
+        if self.state == ManagerState.RUNNING and process is self.process:
+            self.state = ManagerState.INACTIVE
 
-        self.log('Stopped listening for input commands', level='debug')
+    async def listen_for_stdin(self):
+        await listen_for_commands(self)
 
     async def stop_server(self, quit=False, exit_code=0):
-        if self.state in [ManagerState.STOPPING, ManagerState.QUITING]:
+        if quit:
+            if self.quit_requested.is_set():
+                return
+
+            # Nothing new gets to start, but the running command finishes before the state changes, so a restore
+            # still stops the server itself and a stop in progress carries on into quitting
+            self.quit_requested.set()
+            self.stop_backup()
+            if self.scheduler:
+                self.scheduler.close()
+            await self.finish_running_command()
+        elif self.state in [ManagerState.STOPPING, ManagerState.QUITING]:
             return
 
         self.state = ManagerState.QUITING if quit else ManagerState.STOPPING
+
         if self.process and self.process.returncode is None:
-            await self.command_handler("stop")
+            self.run_server_command('stop')
 
-        try:
-            if self.listen_thread and self.listen_thread.is_alive:
-                self.listen_thread.join()
-        except:
-            pass
+        # Wait for the server to exit and its output to be drained, and make it exit if it won't by itself
+        if self.listen_task and self.listen_task is not asyncio.current_task():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.listen_task), self.stop_timeout)
+            except asyncio.TimeoutError:
+                self.log('Minecraft server did not stop after {}s. Terminating it...'.format(self.stop_timeout),
+                         level='warn')
+                self.terminate_server()
+                await self.listen_task
+            except Exception:
+                self.log('Error while waiting for the Minecraft server to stop', level='error', with_traceback=True)
 
         if quit:
             self.log('Quitting...')
+            if self.replicator:
+                self.replicator.stop()
+            if self.gc_task:
+                self.gc_task.cancel()
             if self.discord:
                 await self.discord.stop()
 
-            os._exit(exit_code)
-        else:
+            self.exit_code = exit_code
+            self.quit_event.set()
+        elif self.state == ManagerState.STOPPING:
             self.state = ManagerState.INACTIVE
 
+    async def finish_running_command(self):
+        # Quitting never walks away from a command halfway: a running backup is cancelled (and its partial
+        # snapshot removed), and anything else is waited for. Starts don't wait for the server to be ready
+        # once quitting, so this is never held up for `startup_timeout`
+        job = self.scheduler.current if self.scheduler else None
+        if not job:
+            return
+
+        if self.running_backup:
+            self.log('Cancelling the running backup...')
+            self.running_backup.cancel()
+        else:
+            self.log('Waiting for `{}` to finish before quitting...'.format(job.name))
+
+        try:
+            await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if not job.future.cancelled():
+                raise
+        except Exception:
+            pass
+
+    async def wait_until_ready(self):
+        # Ready means the server logged "Done (...)!", not just that the process is up
+        if not self.process or self.server_ready.is_set():
+            return self.server_ready.is_set()
+
+        ready_task = asyncio.create_task(self.server_ready.wait())
+        quit_task = asyncio.create_task(self.quit_requested.wait())
+        try:
+            await asyncio.wait([ready_task, quit_task, self.listen_task], timeout=self.startup_timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready_task.cancel()
+            quit_task.cancel()
+
+        if self.server_ready.is_set():
+            return True
+
+        # The server is about to be stopped anyway
+        if self.quit_requested.is_set():
+            return False
+
+        if self.listen_task.done():
+            raise RuntimeError('Minecraft server exited before it finished starting!')
+
+        self.log('Minecraft server is not ready after {}s. Still waiting on it in the background...'.format(
+            self.startup_timeout), level='warn')
+        return False
+
+    def load_startup_history(self):
+        try:
+            with open(self.startup_history_path, 'r') as f:
+                return [json.loads(i) for i in f if i.strip()][-100:]
+        except (OSError, ValueError):
+            return []
+
+    def record_startup(self, duration, reported):
+        entry = {
+            'timestamp': int(time.time()),
+            'duration': round(duration, 3),
+            'reported': reported,
+            'prewarm': self.last_prewarm
+        }
+        self.startup_history = (self.startup_history + [entry])[-100:]
+
+        try:
+            os.makedirs(os.path.dirname(self.startup_history_path), exist_ok=True)
+            with open(self.startup_history_path, 'a') as f:
+                f.write('{}\n'.format(json.dumps(entry)))
+        except OSError as ex:
+            self.log('Unable to record startup time: {}'.format(str(ex)), level='warn')
+
+    def get_level_name(self):
+        try:
+            with open(os.path.join(self.get_jar_dir(), 'server.properties'), 'r', errors='replace') as f:
+                for line in f:
+                    key, _, value = line.partition('=')
+                    if key.strip() == 'level-name' and value.strip():
+                        return value.strip()
+        except OSError:
+            pass
+
+        return 'world'
+
+    def prewarm_world(self):
+        world_dir = os.path.join(self.get_jar_dir(), self.get_level_name())
+        try:
+            spawn_x, spawn_z = read_level_spawn(os.path.join(world_dir, 'level.dat'))
+        except (OSError, ValueError, EOFError):
+            spawn_x, spawn_z = 0, 0
+
+        # The region files around spawn, and the server jar itself
+        region_x, region_z = get_region_coords(spawn_x, spawn_z)
+        radius = self.prewarm_radius
+        paths = [os.path.join(world_dir, 'region', 'r.{}.{}.mca'.format(x, z))
+                 for x in range(region_x - radius, region_x + radius + 1)
+                 for z in range(region_z - radius, region_z + radius + 1)]
+        paths.append(os.path.abspath(self.server_path))
+
+        start_time = time.monotonic()
+        files = 0
+        size = 0
+        for path in paths:
+            try:
+                with open(path, 'rb', buffering=0) as f:
+                    # Reading is what actually fills the cache, the hint just lets the kernel read ahead
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    while True:
+                        data = f.read(1048576)
+                        if not data:
+                            break
+                        size += len(data)
+                files += 1
+            except OSError:
+                continue
+
+        duration = time.monotonic() - start_time
+        self.log('Pre-warmed {} file(s) around spawn ({}, {}), {} bytes in {:.2f}s'.format(
+            files, spawn_x, spawn_z, size, duration))
+        return {'files': files, 'bytes': size, 'duration': round(duration, 3)}
+
+    def terminate_server(self):
+        # Last resort for when the event loop is already gone (crashes, force closes)
+        if self.process and self.process.returncode is None:
+            try:
+                os.kill(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
     def stop_backup(self):
         self.log('Cancelling backup timer...', level='debug')
-        if self.backup_timer and self.backup_timer.is_alive:
+        if self.backup_timer and not self.backup_timer.done():
             self.backup_timer.cancel()
-        
+
         self.backup_timer = None
 
     def run_server_command(self, cmd):
-        if not self.process or not self.process.stdin or self.process.stdin.closed:
+        if not self.process or not self.process.stdin or self.process.stdin.is_closing():
             self.log("Can't send command to Minecraft server. Server is not running!")
             return
 
@@ -279,36 +924,91 @@ class MinecraftManager:
 
         try:
             self.process.stdin.write(str.encode('{}\n'.format(cmd)))
-            self.process.stdin.flush()
         except Exception as ex:
             self.log('Failed to execute server command! Error: {}'.format(str(ex)), level='error')
 
     def send_server_message(self, message):
         self.run_server_command('say {}'.format(message))
 
-    def perform_backup(self, start_next_timer=True):
-        self.log('Performing backup...')
-        self.run_server_command("say Performing backup...")
-        self.run_server_command("save-off")
-        self.run_server_command("save-all")
+    async def save_world(self):
+        if not self.minecraft_running():
+            return False
 
-        backup = BackupManager(
-            self.server_path,
-            self.backup_dir,
-            excluded_files=self.excluded_files,
-            excluded_file_types=self.excluded_file_types,
-            manager=self,
-            cwd=self.current_dir
-        )
-        file_path = backup.take_snapshot()
-        if file_path:
-            self.log('Successfully created new backup at: {}'.format(file_path))
-        else:
-            self.log('Failed to take backup!', level='error')
+        # Wait for the server to confirm the save so we never archive half-written region files
+        self.save_complete.clear()
+        self.run_server_command("save-all flush")
+        try:
+            await asyncio.wait_for(self.save_complete.wait(), self.save_timeout)
+            return True
+        except asyncio.TimeoutError:
+            pass
 
-        if self.state not in [ManagerState.STOPPING, ManagerState.QUITING]:
-            self.run_server_command("save-on")
-            self.run_server_command("say Backup Complete!")
+        self.log('Timed out after {}s waiting for the server to save the world. Continuing anyway...'.format(
+            self.save_timeout), level='warn')
+        return False
+
+    async def perform_backup(self, start_next_timer=True):
+        # Backups take turns (across every supervised server too), and saving isn't turned off until it's ours
+        if self.backup_slot.locked():
+            self.log('Waiting for another backup to finish...')
+
+        async with self.backup_slot:
+            # Quitting while this waited its turn
+            if self.quit_requested.is_set():
+                return
+
+            self.log('Performing backup...')
+            self.run_server_command("say Performing backup...")
+            self.run_server_command("save-off")
+            save_off_at = time.monotonic()
+            await self.save_world()
+
+            backup = self.get_backup_manager()
+            self.running_backup = backup
+            loop = asyncio.get_running_loop()
+            source_dir = None
+            timestamp = None
+            if self.staged_backups:
+                # Copy the world as it is right now, so saving can be turned back on before the slow part
+                try:
+                    timestamp = backup.current_time()
+                    source_dir = await loop.run_in_executor(None, backup.stage_snapshot)
+                except BackupCancelled:
+                    self.running_backup = None
+                    self.end_save_off(save_off_at)
+                    self.log('Backup cancelled', level='warn')
+                    return
+                except Exception:
+                    self.log('Unable to stage a copy of the server. Backing up the live files instead...',
+                             level='warn', with_traceback=True)
+                    timestamp = None
+
+            if source_dir:
+                self.end_save_off(save_off_at)
+
+            # Archiving is blocking disk and CPU work, so keep it off of the event loop
+            try:
+                file_path = await loop.run_in_executor(
+                    self.backup_executor, backup.take_snapshot, source_dir, timestamp)
+            except BackupCancelled:
+                self.log('Backup cancelled, and its partial snapshot removed', level='warn')
+                return
+            finally:
+                self.running_backup = None
+                if not source_dir:
+                    self.end_save_off(save_off_at)
+
+            if file_path:
+                self.log('Successfully created new backup at: {}'.format(file_path))
+                self.players_seen = bool(self.players)
+                self.backup_deferred_since = None
+                self.last_backup_time = backup.get_timestamp_from_file(os.path.basename(file_path))
+                self.replicate_snapshot(backup, file_path)
+            else:
+                self.log('Failed to take backup!', level='error')
+
+            if self.state not in [ManagerState.STOPPING, ManagerState.QUITING]:
+                self.run_server_command("say Backup Complete!")
 
         # Clear the backup timer
         self.backup_timer = None
@@ -318,26 +1018,168 @@ class MinecraftManager:
             self.log("Starting next backup timer...")
             self.start_backup_timer()
 
+    def replicate_snapshot(self, backup, file_path):
+        # Uploads run on the replicator's own threads, so the next backup never waits for them
+        if not self.replicator:
+            return
+
+        try:
+            self.replicator.enqueue(backup.get_snapshot_files(file_path), label=os.path.basename(file_path))
+        except Exception:
+            self.log('Unable to queue {} for replication'.format(file_path), level='error', with_traceback=True)
+
+    def end_save_off(self, save_off_at):
+        if self.state in [ManagerState.STOPPING, ManagerState.QUITING]:
+            return
+
+        self.run_server_command("save-on")
+        duration = time.monotonic() - save_off_at
+        self.metrics.histogram('minecraft_backup_save_off_seconds', 'How long saving was off for backups').observe(
+            duration)
+        self.log('Saving was off for {:.1f}s'.format(duration))
+
+    async def perform_verify_backups(self):
+        # Don't read archives while a backup is being written or pruned
+        async with self.backup_slot:
+            self.log('Verifying backups...')
+            backup = self.get_backup_manager()
+            start_time = time.monotonic()
+            results = await asyncio.get_running_loop().run_in_executor(self.backup_executor, backup.verify_backups)
+            duration = time.monotonic() - start_time
+
+        corrupt = [(snapshot, problems) for snapshot, problems in results if problems]
+        verified = self.metrics.counter('minecraft_backup_verifications_total', 'Snapshots verified, by result')
+        verified.inc(len(results) - len(corrupt), result='ok')
+        verified.inc(len(corrupt), result='corrupt')
+        self.metrics.gauge('minecraft_backup_corrupt', 'Corrupt snapshots found by the last verification').set(
+            len(corrupt))
+
+        size = sum(i.size or 0 for i, _ in results)
+        self.log('Verified {} backup(s), {} bytes in {:.1f}s ({:.1f} MB/s)'.format(
+            len(results), size, duration, size / duration / 1048576 if duration else 0))
+        for snapshot, problems in corrupt:
+            self.log('Backup {} is corrupt: {}'.format(snapshot.name, '; '.join(problems)), level='error')
+
+        if not corrupt:
+            self.log('All backups are intact')
+
     async def perform_restore_last_snapshot(self):
         self.log('Performing restore of last backup...')
 
-        if self.minecraft_running():
+        was_running = self.minecraft_running()
+        if was_running:
             self.run_server_command("say Performing restore...")
-            await self.command_handler('stop')
 
-        backup = BackupManager(
+        backup = self.get_backup_manager()
+
+        # A staged restore unpacks the snapshot before stopping the server, so it's only down for the swap
+        stopped_at = await backup.restore_last_snapshot(staged=self.staged_restore and was_running)
+        if stopped_at is None:
+            return
+
+        self.log('Restore Successful! Starting Minecraft Server...')
+        server_dir = self.get_jar_dir()
+        loop = asyncio.get_running_loop()
+        try:
+            await self.handle_command('start')
+        except Exception:
+            # The restored server wouldn't start, so bring back the one from before the restore
+            self.log('Restored server failed to start! Swapping the previous server files back...', level='error',
+                     with_traceback=True)
+            await loop.run_in_executor(None, backup.roll_back_restore, server_dir)
+            await self.handle_command('start')
+            return
+
+        # The files from before the restore are only dropped once the restored server is up
+        if self.server_ready.is_set():
+            await loop.run_in_executor(None, backup.discard_old_server, server_dir)
+        else:
+            self.log('The restored server isn\'t ready yet, so the files from before the restore are kept in {}'.format(
+                backup.get_old_server_dir(server_dir)), level='warn')
+
+        if was_running:
+            downtime = time.monotonic() - stopped_at
+            self.metrics.histogram('minecraft_restore_downtime_seconds',
+                                   'How long the server was down while restoring snapshots').observe(downtime)
+            self.log('Restore finished. The server was down for {:.1f}s'.format(downtime))
+
+    async def perform_restore_files(self, snapshot_name, path):
+        backup = self.get_backup_manager()
+        snapshot = backup.find_backup(snapshot_name)
+        if not snapshot:
+            self.log('Unable to find backup: {}'.format(snapshot_name), level='warn')
+            return
+
+        self.log('Restoring {} from {}...'.format(path, snapshot))
+
+        # The server can't have the files open while we replace them
+        was_running = self.minecraft_running()
+        if was_running:
+            self.run_server_command('say Restoring {}...'.format(path))
+            await self.stop_server()
+
+        try:
+            start_time = time.monotonic()
+            count = await asyncio.get_running_loop().run_in_executor(None, backup.restore_files, snapshot, path)
+            self.metrics.histogram('minecraft_restore_duration_seconds', 'Time spent restoring snapshots').observe(
+                time.monotonic() - start_time, kind='files')
+        finally:
+            if was_running:
+                await self.handle_command('start')
+
+        if count:
+            self.log('Successfully restored {} file(s) from {}'.format(count, snapshot))
+        else:
+            self.log('No files matching {} were found in {}'.format(path, snapshot), level='warn')
+
+    async def run_gc_reporter(self):
+        while True:
+            await asyncio.sleep(self.gc_report_interval)
+            if not self.minecraft_running():
+                continue
+
+            await asyncio.get_running_loop().run_in_executor(None, self.update_gc_report)
+            self.log('GC: {}'.format(describe_gc_report(self.gc_analyzer.report())))
+
+    def update_gc_report(self):
+        self.gc_analyzer.update()
+        report = self.gc_analyzer.report()
+        if not report:
+            return
+
+        pauses = self.metrics.gauge('minecraft_gc_pause_milliseconds', 'GC pause time percentiles for this run')
+        for quantile in ['p50', 'p95', 'p99', 'max']:
+            pauses.set(report[quantile], quantile=quantile)
+        if report['overhead'] is not None:
+            self.metrics.gauge('minecraft_gc_overhead_ratio', 'Share of time spent in GC pauses').set(
+                round(report['overhead'], 5))
+        if report['allocation_rate'] is not None:
+            self.metrics.gauge('minecraft_gc_allocation_bytes_per_second', 'Heap allocation rate').set(
+                int(report['allocation_rate']))
+
+    def get_backup_manager(self):
+        return BackupManager(
             self.server_path,
             self.backup_dir,
             excluded_files=self.excluded_files,
             excluded_file_types=self.excluded_file_types,
             manager=self,
-            cwd=self.current_dir
+            cwd=self.current_dir,
+            backup_mode=self.backup_mode,
+            compression_workers=self.compression_workers,
+            compression=self.compression,
+            compression_rules=self.compression_rules,
+            compression_sampling=self.compression_sampling,
+            max_backups=self.max_backups,
+            keep_daily=self.keep_daily,
+            keep_weekly=self.keep_weekly,
+            keep_monthly=self.keep_monthly,
+            read_limit=self.backup_read_limit * 1048576,
+            cpu_limit=self.backup_cpu_limit,
+            nice=self.backup_nice,
+            io_priority=self.backup_io_priority
         )
 
-        await backup.restore_last_snapshot()
-        self.log('Restore Successful! Starting Minecraft Server...')
-        await self.command_handler('start')
-
     def display_help(self):
         parts = [
             '[========== Help ========== ]',
@@ -351,12 +1193,97 @@ class MinecraftManager:
             '- quit, exit                 -> Stop the server and quit the application',
             '- backup, backup-now         -> Take a backup of the Minecraft Server',
             '- cancel-backup, stop-backup -> Cancel and Stop the backup scheduler',
-            '- start-backup               -> Start the backup scheduler'
+            '- start-backup               -> Start the backup scheduler',
+            '- restore, restore-last      -> Restore the most recent backup',
+            '- restore-file <snapshot> <path>',
+            '                             -> Restore one file (or directory) from a backup',
+            '- restore-region <snapshot> <world> <x> <z>',
+            '                             -> Restore one region file from a backup',
+            '- list-backups, backups      -> List the backups in the backup catalog',
+            '- verify-backups, verify     -> Check every backup for corruption',
+            '- stats                      -> Show server and backup statistics',
+            '- status                     -> Show the server\'s state, JVM and GC pause times'
         ]
 
         for i in parts:
             self.log(i)
 
+    def display_backups(self):
+        snapshots = self.get_backup_manager().list_backups()
+        self.log('[========== Backups ({}) ========== ]'.format(len(snapshots)))
+        for i in snapshots:
+            self.log('- {} | {} | {} bytes | {} files | {}s'.format(
+                datetime.utcfromtimestamp(i.timestamp).strftime('%Y-%m-%d %H:%M:%S'), i.name, i.size,
+                i.file_count if i.file_count is not None else '?',
+                round(i.duration, 1) if i.duration is not None else '?'))
+
+    def display_status(self):
+        self.log('[========== Status ========== ]')
+        self.log('- Server: {}{}'.format(
+            'running' if self.minecraft_running() else 'stopped',
+            ' (pid {})'.format(self.process.pid) if self.minecraft_running() else ''))
+        self.log('- Players online: {}{}'.format(
+            len(self.players), ' ({})'.format(', '.join(sorted(self.players))) if self.players else ''))
+        if self.last_tps:
+            self.log('- TPS: {} (1m), {} (5m), {} (15m)'.format(*self.last_tps[1]))
+        if self.last_lag:
+            self.log('- Last lag warning: {} ({}ms behind)'.format(
+                self.last_lag[0].strftime('%Y-%m-%d %H:%M:%S'), self.last_lag[1].behind_ms))
+        if self.next_backup_time:
+            self.log('- Next backup: {}'.format(self.next_backup_time.strftime('%Y-%m-%d %H:%M:%S')))
+        if self.scheduler:
+            self.log('- Commands: {}'.format(self.scheduler.describe()))
+        if self.replicator:
+            self.log('- Replication: {}'.format(self.replicator.describe()))
+
+        if self.startup_history:
+            durations = [i['duration'] for i in self.startup_history]
+            self.log('- Last startup: {:.1f}s | {} recorded | avg {:.1f}s | fastest {:.1f}s | slowest {:.1f}s'.format(
+                durations[-1], len(durations), sum(durations) / len(durations), min(durations), max(durations)))
+
+        self.log('- JVM: {}'.format(self.jvm_options.describe()))
+        if self.gc_analyzer:
+            self.update_gc_report()
+            self.log('- GC: {}'.format(describe_gc_report(self.gc_analyzer.report())))
+
+    def display_stats(self):
+        now = time.monotonic()
+        lines = self.metrics.counter('minecraft_console_lines_total', 'Lines read from the server console').get()
+        last_time, last_lines = self.stats_checkpoint
+        self.stats_checkpoint = (now, lines)
+
+        self.log('[========== Stats ========== ]')
+        self.log('- Uptime: {}s | Server running: {} | Players online: {}'.format(
+            int(now - self.started_at), 'yes' if self.minecraft_running() else 'no', len(self.players)))
+        self.log('- Console lines: {} ({:.1f}/s since last `stats`)'.format(
+            lines, (lines - last_lines) / max(now - last_time, 0.001)))
+        self.log('- Lag warnings: {}'.format(
+            self.metrics.counter('minecraft_lag_warnings_total', '"Can\'t keep up!" warnings from the server').get()))
+
+        backups = self.metrics.counter('minecraft_backups_total', 'Snapshots taken, by result')
+        durations = self.metrics.histogram('minecraft_backup_duration_seconds', 'Time spent taking a snapshot')
+        self.log('- Backups: {} succeeded, {} failed'.format(
+            backups.get(result='success'), backups.get(result='failure')))
+        for labels in durations.label_sets():
+            summary = durations.summary(**labels)
+            self.log('  - {}: {} taken | avg {:.1f}s | max {:.1f}s | last {} bytes | compression {}x'.format(
+                labels['mode'], summary['count'], summary['avg'], summary['max'],
+                self.metrics.gauge('minecraft_backup_size_bytes', 'Size of the last snapshot').get(**labels),
+                self.metrics.gauge('minecraft_backup_compression_ratio',
+                                   'Bytes read per byte written by the last snapshot').get(**labels)))
+
+        throttled = self.metrics.counter('minecraft_backup_throttle_seconds_total', 'Time snapshots spent waiting on budgets')
+        if throttled.get(budget='read') or throttled.get(budget='cpu'):
+            self.log('- Backup throttling: {:.1f}s waiting on the read budget, {:.1f}s on the CPU budget'.format(
+                throttled.get(budget='read'), throttled.get(budget='cpu')))
+
+        commands = self.metrics.histogram('minecraft_command_duration_seconds', 'Time spent handling console commands')
+        for labels in sorted(commands.label_sets(), key=lambda i: i['command']):
+            summary = commands.summary(**labels)
+            self.log('- Command `{}`: {} call(s) | avg {:.1f}ms | p95 <= {:.1f}ms | max {:.1f}ms'.format(
+                labels['command'], summary['count'], summary['avg'] * 1000, summary['p95'] * 1000,
+                summary['max'] * 1000))
+
     def minecraft_running(self):
         return self.state == ManagerState.RUNNING and self.process and self.process.returncode is None
 
@@ -364,7 +1291,7 @@ class MinecraftManager:
         return Path(self.server_path).parent.absolute()
 
     def get_command_parts(self):
-        return ['java', '-Xms2G', '-Xmx2G', '-jar', self.server_path, '--nogui']
+        return [self.java_path] + self.jvm_options.get_args() + ['-jar', self.server_path, '--nogui']
 
     def get_run_command(self):
         return ' '.join(self.get_command_parts())
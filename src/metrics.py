@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import threading
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels))
+
+
+class Metric:
+
+    type_name = 'untyped'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render_header(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.type_name)
+        ]
+
+    def render(self, const_labels=()):
+        return self.render_header() + self.render_samples(const_labels)
+
+    def render_samples(self, const_labels=()):
+        lines = []
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, format_labels(tuple(const_labels) + labels), value))
+
+        return lines
+
+
+class Counter(Metric):
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+
+    type_name = 'histogram'
+
+    def __init__(self, name, description, buckets=None):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0, 'count': 0, 'max': 0}
+
+            item = self.values[key]
+            item['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            item['sum'] += value
+            item['count'] += 1
+            item['max'] = max(item['max'], value)
+
+    def summary(self, **labels):
+        with self.lock:
+            item = self.values.get(tuple(sorted(labels.items())))
+            if not item or not item['count']:
+                return None
+
+            return {
+                'count': item['count'],
+                'avg': item['sum'] / item['count'],
+                'max': item['max'],
+                'p95': self._quantile(item, 0.95)
+            }
+
+    def label_sets(self):
+        with self.lock:
+            return [dict(i) for i in self.values]
+
+    def _quantile(self, item, quantile):
+        # Upper bound of the bucket the quantile falls in
+        target = item['count'] * quantile
+        seen = 0
+        for index, count in enumerate(item['counts']):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else item['max']
+
+        return item['max']
+
+    def render_samples(self, const_labels=()):
+        lines = []
+        with self.lock:
+            for labels, item in sorted(self.values.items(), key=lambda i: i[0]):
+                labels = tuple(const_labels) + labels
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], item['counts']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), item['sum']))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(labels), item['count']))
+
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self, const_labels=None):
+        self.const_labels = tuple(sorted((const_labels or {}).items()))
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, description):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=None):
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def render(self):
+        return render_registries([self])
+
+    def get_metrics(self):
+        with self.lock:
+            return list(self.metrics.values())
+
+    def _get_or_create(self, cls, name, description, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, description, **kwargs)
+
+            return self.metrics[name]
+
+
+def render_registries(registries):
+    # Several servers share metric names, and Prometheus wants each family (HELP, TYPE and every sample) in
+    # one place, so samples are grouped by name, each keeping its registry's labels
+    families = {}
+    for registry in registries:
+        for metric in registry.get_metrics():
+            families.setdefault(metric.name, []).append((registry, metric))
+
+    lines = []
+    for name in sorted(families):
+        lines.extend(families[name][0][1].render_header())
+        for registry, metric in families[name]:
+            lines.extend(metric.render_samples(registry.const_labels))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Tiny HTTP endpoint that serves the registries in the Prometheus text format
+    """
+
+    def __init__(self, registries, host='127.0.0.1', port=9225):
+        self.registries = registries
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_request, self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            parts = request.decode('latin-1').split()
+            path = parts[1] if len(parts) > 1 else '/'
+
+            # Drain the request headers
+            while (await asyncio.wait_for(reader.readline(), 10)) not in [b'\r\n', b'\n', b'']:
+                pass
+
+            if path.split('?')[0] in ['/', '/metrics']:
+                status = '200 OK'
+                body = render_registries(self.registries).encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
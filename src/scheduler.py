@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import time
+
+
+class Priority:
+    URGENT = 0
+    NORMAL = 1
+    ROUTINE = 2
+
+
+class Job:
+
+    def __init__(self, name, func, priority, key=None):
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.requests = 1
+
+
+class CommandScheduler:
+    """
+    Runs commands that change the server's state (starting, stopping, backups, restores) one at a time,
+    however they were triggered: the console, Discord or the backup timer. Waiting commands run most
+    urgent first, so a `stop` or `restore` never queues behind routine work, and a backup requested while
+    another is still waiting joins that one instead of queueing a second
+    """
+
+    def __init__(self, log=None, metrics=None):
+        self.log = log or (lambda msg, level='info': None)
+        self.metrics = metrics
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending = {}
+        self.waiting = []
+        self.current = None
+        self.worker = None
+        self.closed = False
+
+    def start(self):
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    def submit(self, name, func, priority=Priority.NORMAL, key=None):
+        # Nothing new runs once the manager is quitting
+        if self.closed:
+            future = asyncio.get_running_loop().create_future()
+            future.cancel()
+            return future
+
+        # Commands with a key are coalesced: asking again while one is waiting just waits for that one
+        if key and key in self.pending:
+            job = self.pending[key]
+            job.requests += 1
+            self.log('`{}` is already waiting to run, not queueing it again'.format(name))
+            if self.metrics:
+                self.metrics.counter('minecraft_commands_coalesced_total', 'Commands merged into a waiting one').inc(
+                    command=name)
+        else:
+            job = Job(name, func, priority, key)
+            if key:
+                self.pending[key] = job
+            if self.current:
+                self.log('Queued `{}` until `{}` is done'.format(name, self.current.name))
+
+            self.waiting.append(job)
+            self.queue.put_nowait((priority, next(self.sequence), job))
+            self.set_queue_gauge()
+
+        self.start()
+
+        # Callers that give up waiting (like a cancelled timer) don't cancel the command for everyone else
+        return asyncio.shield(job.future)
+
+    async def run(self):
+        while True:
+            _, _, job = await self.queue.get()
+            if job.key and self.pending.get(job.key) is job:
+                del self.pending[job.key]
+            if job in self.waiting:
+                self.waiting.remove(job)
+            self.set_queue_gauge()
+
+            if job.future.done():
+                continue
+
+            waited = time.monotonic() - job.queued_at
+            start_time = time.monotonic()
+            self.current = job
+            try:
+                job.future.set_result(await job.func())
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as ex:
+                job.future.set_exception(ex)
+            finally:
+                self.current = None
+                self.record(job, waited, time.monotonic() - start_time)
+
+    def record(self, job, waited, duration):
+        self.log('`{}` waited {:.1f}s in the queue and ran for {:.1f}s{}'.format(
+            job.name, waited, duration, ' ({} requests)'.format(job.requests) if job.requests > 1 else ''),
+            level='debug')
+
+        if self.metrics:
+            self.metrics.histogram('minecraft_command_queue_seconds', 'Time commands spent waiting to run').observe(
+                waited, command=job.name)
+            self.metrics.histogram('minecraft_command_duration_seconds', 'Time spent handling console commands').observe(
+                duration, command=job.name)
+
+    def cancel_pending(self):
+        while not self.queue.empty():
+            _, _, job = self.queue.get_nowait()
+            job.future.cancel()
+
+        self.pending = {}
+        self.waiting = []
+        self.set_queue_gauge()
+
+    def close(self):
+        # Drops the waiting commands and refuses new ones, but lets the running one finish
+        self.closed = True
+        self.cancel_pending()
+
+    def stop(self):
+        self.close()
+        if self.worker:
+            self.worker.cancel()
+
+    def set_queue_gauge(self):
+        if self.metrics:
+            self.metrics.gauge('minecraft_command_queue', 'Commands waiting to run').set(self.queue.qsize())
+
+    def describe(self):
+        waiting = [i.name for i in sorted(self.waiting, key=lambda i: i.priority)]
+        return '{} | {} waiting{}'.format(
+            'running `{}`'.format(self.current.name) if self.current else 'idle', len(waiting),
+            ' ({})'.format(', '.join(waiting)) if waiting else '')
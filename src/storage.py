@@ -0,0 +1,580 @@
+import hashlib
+import hmac
+import json
+import math
+import os
+import posixpath
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from .throttle import TokenBucket, lower_thread_priority
+
+
+class StorageError(Exception):
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+class Part:
+    """
+    One part of a file being uploaded. Every read of it goes through the shared bandwidth limit, and
+    stops as soon as the upload is cancelled
+    """
+
+    def __init__(self, path, number, offset, size, bucket=None, cancelled=None):
+        self.path = path
+        self.number = number
+        self.offset = offset
+        self.size = size
+        self.bucket = bucket
+        self.cancelled = cancelled
+
+    def open(self, throttled=True):
+        return PartReader(self, throttled)
+
+
+class PartReader:
+
+    def __init__(self, part, throttled=True):
+        self.part = part
+        self.throttled = throttled
+        self.remaining = part.size
+        self.f = open(part.path, 'rb')
+        self.f.seek(part.offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.part.size
+
+    def read(self, size=-1):
+        if self.part.cancelled and self.part.cancelled.is_set():
+            raise UploadCancelled()
+
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        if self.throttled and self.part.bucket and data:
+            self.part.bucket.consume(len(data))
+
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class StorageBackend:
+    """
+    Somewhere to keep copies of snapshots. Files are uploaded in parts, possibly at the same time and
+    across restarts: `begin_upload` returns a (JSON serializable) state, which every `upload_part` and
+    `complete_upload` call is given back
+    """
+
+    scheme = None
+
+    def __init__(self, url):
+        self.url = url
+        self.name = '{}-{}'.format(self.scheme, hashlib.sha256(url.encode('utf-8')).hexdigest()[:8])
+
+    def describe(self):
+        return self.url
+
+    def begin_upload(self, key, size):
+        raise NotImplementedError()
+
+    def upload_part(self, state, part):
+        raise NotImplementedError()
+
+    def complete_upload(self, state, parts):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class LocalStorage(StorageBackend):
+    # Another directory, typically a different disk or a network mount
+
+    scheme = 'file'
+
+    def __init__(self, url, path):
+        super().__init__(url)
+        self.path = path
+
+    def begin_upload(self, key, size):
+        path = os.path.join(self.path, key)
+        temp_path = '{}.part'.format(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'ab') as f:
+            f.truncate(size)
+
+        return {'path': path, 'temp_path': temp_path}
+
+    def upload_part(self, state, part):
+        with open(state['temp_path'], 'r+b') as f, part.open() as reader:
+            f.seek(part.offset)
+            while True:
+                data = reader.read(1048576)
+                if not data:
+                    break
+                f.write(data)
+
+        return {'size': part.size}
+
+    def complete_upload(self, state, parts):
+        os.replace(state['temp_path'], state['path'])
+
+
+class SftpStorage(StorageBackend):
+    # A directory on another machine, over SSH. Needs paramiko, and the host has to be in known_hosts
+
+    scheme = 'sftp'
+
+    def __init__(self, url, host, path, port=22, username=None, password=None, key_file=None, timeout=30):
+        super().__init__(url)
+        try:
+            import paramiko
+        except ImportError:
+            raise ValueError('SFTP replication needs paramiko. Install it with `pip install paramiko`')
+
+        self.paramiko = paramiko
+        self.host = host
+        self.path = path or '.'
+        self.port = port or 22
+        self.username = username
+        self.password = password
+        self.key_file = key_file
+        self.timeout = timeout
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def describe(self):
+        return 'sftp://{}{}:{}/{}'.format(
+            '{}@'.format(self.username) if self.username else '', self.host, self.port, self.path.lstrip('/'))
+
+    def get_client(self):
+        # Every upload thread gets its own connection
+        sftp = getattr(self.local, 'sftp', None)
+        if sftp is None:
+            ssh = self.paramiko.SSHClient()
+            ssh.load_system_host_keys()
+            ssh.connect(self.host, port=self.port, username=self.username, password=self.password,
+                        key_filename=self.key_file, timeout=self.timeout)
+            sftp = self.local.sftp = ssh.open_sftp()
+            with self.lock:
+                self.clients.append(ssh)
+
+        return sftp
+
+    def makedirs(self, sftp, path):
+        current = '/' if path.startswith('/') else ''
+        for name in [i for i in path.split('/') if i]:
+            current = posixpath.join(current, name)
+            try:
+                sftp.stat(current)
+            except IOError:
+                sftp.mkdir(current)
+
+    def begin_upload(self, key, size):
+        sftp = self.get_client()
+        path = posixpath.join(self.path, key)
+        temp_path = '{}.part'.format(path)
+        self.makedirs(sftp, posixpath.dirname(path))
+        with sftp.open(temp_path, 'ab') as f:
+            f.truncate(size)
+
+        return {'path': path, 'temp_path': temp_path}
+
+    def upload_part(self, state, part):
+        with self.get_client().open(state['temp_path'], 'r+b') as f, part.open() as reader:
+            f.set_pipelined(True)
+            f.seek(part.offset)
+            while True:
+                data = reader.read(1048576)
+                if not data:
+                    break
+                f.write(data)
+
+        return {'size': part.size}
+
+    def complete_upload(self, state, parts):
+        self.get_client().posix_rename(state['temp_path'], state['path'])
+
+    def close(self):
+        with self.lock:
+            for ssh in self.clients:
+                ssh.close()
+            self.clients = []
+
+
+class S3Storage(StorageBackend):
+    """
+    An S3 compatible object store (AWS, MinIO, Backblaze B2, ...), using multipart uploads signed with
+    AWS Signature Version 4. Buckets are addressed by path, which every S3 compatible store supports
+    """
+
+    scheme = 's3'
+
+    def __init__(self, url, bucket, prefix='', endpoint=None, region=None, access_key=None, secret_key=None,
+                 timeout=60):
+        super().__init__(url)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.region = region or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        self.endpoint = (endpoint or 'https://s3.{}.amazonaws.com'.format(self.region)).rstrip('/')
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.timeout = timeout
+
+        if not self.access_key or not self.secret_key:
+            raise ValueError('S3 replication needs credentials. Set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY')
+
+    def describe(self):
+        return 's3://{}/{} ({})'.format(self.bucket, self.prefix, self.endpoint)
+
+    def get_signing_key(self, date):
+        key = 'AWS4{}'.format(self.secret_key).encode('utf-8')
+        for item in [date, self.region, 's3', 'aws4_request']:
+            key = hmac.new(key, item.encode('utf-8'), hashlib.sha256).digest()
+
+        return key
+
+    def request(self, method, key, query=None, body=b'', payload_hash=None, length=None):
+        path = '/{}/{}'.format(self.bucket, urllib.parse.quote(self.prefix + key, safe='/~'))
+        query = '&'.join('{}={}'.format(urllib.parse.quote(k, safe='~'), urllib.parse.quote(str(v), safe='~'))
+                         for k, v in sorted((query or {}).items()))
+
+        now = datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = '{}/{}/s3/aws4_request'.format(now.strftime('%Y%m%d'), self.region)
+        payload_hash = payload_hash or hashlib.sha256(body).hexdigest()
+        headers = {
+            'host': urllib.parse.urlparse(self.endpoint).netloc,
+            'x-amz-content-sha256': payload_hash,
+            'x-amz-date': amz_date
+        }
+
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method, path, query, ''.join('{}:{}\n'.format(k, headers[k]) for k in sorted(headers)), signed_headers,
+            payload_hash])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signature = hmac.new(self.get_signing_key(now.strftime('%Y%m%d')), string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            self.access_key, scope, signed_headers, signature)
+        headers['Content-Length'] = str(len(body) if length is None else length)
+
+        request = urllib.request.Request(
+            '{}{}{}'.format(self.endpoint, path, '?{}'.format(query) if query else ''),
+            data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.headers, response.read()
+        except urllib.error.HTTPError as ex:
+            error = ex.read().decode('utf-8', errors='replace')
+            code = re.search(r'<Code>(.*?)</Code>', error)
+            raise StorageError('S3 {} {} failed: {} {}'.format(method, key, ex.code, code.group(1) if code else ''),
+                               code=code.group(1) if code else ex.code)
+
+    def begin_upload(self, key, size):
+        _, body = self.request('POST', key, {'uploads': ''})
+        upload_id = re.search(r'<UploadId>(.*?)</UploadId>', body.decode('utf-8'))
+        if not upload_id:
+            raise StorageError('S3 did not return an upload ID for {}'.format(key))
+
+        return {'key': key, 'upload_id': upload_id.group(1)}
+
+    def upload_part(self, state, part):
+        # The payload hash is signed, so each part is read twice: once to hash it, once to send it
+        digest = hashlib.sha256()
+        with part.open(throttled=False) as reader:
+            while True:
+                data = reader.read(1048576)
+                if not data:
+                    break
+                digest.update(data)
+
+        with part.open() as reader:
+            headers, _ = self.request('PUT', state['key'], {'partNumber': part.number, 'uploadId': state['upload_id']},
+                                      body=reader, payload_hash=digest.hexdigest(), length=part.size)
+
+        return {'etag': headers.get('ETag')}
+
+    def complete_upload(self, state, parts):
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+            '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, info['etag'])
+            for number, info in parts)).encode('utf-8')
+
+        # Completing can fail after a 200 response, with the error in the body
+        _, response = self.request('POST', state['key'], {'uploadId': state['upload_id']}, body=body)
+        if b'<Error>' in response:
+            code = re.search(r'<Code>(.*?)</Code>', response.decode('utf-8', errors='replace'))
+            raise StorageError('S3 could not complete {}: {}'.format(state['key'], code.group(1) if code else '?'),
+                               code=code.group(1) if code else None)
+
+
+def create_storage(url, s3_endpoint=None, s3_region=None, sftp_key_file=None):
+    """
+    `file:///mnt/backups`, `sftp://user@host:22/backups` or `s3://bucket/prefix`
+    """
+
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme in ['', 'file']:
+        return LocalStorage(url, os.path.abspath(parsed.path if parsed.scheme else url))
+    if parsed.scheme == 'sftp':
+        return SftpStorage(url, parsed.hostname, parsed.path.lstrip('/') or '.', port=parsed.port,
+                           username=urllib.parse.unquote(parsed.username) if parsed.username else None,
+                           password=urllib.parse.unquote(parsed.password) if parsed.password else None,
+                           key_file=sftp_key_file)
+    if parsed.scheme == 's3':
+        return S3Storage(url, parsed.netloc, parsed.path, endpoint=s3_endpoint, region=s3_region)
+
+    raise ValueError('Unknown replication target: {}. Use file://, sftp:// or s3://'.format(url))
+
+
+class Replicator:
+    """
+    Copies snapshots to other storage in the background. Each snapshot's files go up in parallel parts
+    within a bandwidth limit, and progress is saved after every part, so an interrupted upload picks up
+    where it left off. It runs on its own threads, so it never holds up the next backup
+    """
+
+    def __init__(self, backends, backup_path, workers=4, bandwidth=0, part_size=8388608, priority=(10, 'low'),
+                 log=None, metrics=None):
+        self.backends = backends
+        self.backup_path = backup_path
+        self.state_dir = os.path.join(backup_path, 'replication')
+        self.part_size = part_size
+        self.bucket = TokenBucket(bandwidth, burst=max(bandwidth / 4, 1048576)) if bandwidth else None
+        self.log = log or (lambda msg, level='info': None)
+        self.metrics = metrics
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.queued = []
+        self.current = None
+        self.failed = {}
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.uploaded = {i.name: self.load_uploaded(i) for i in backends}
+
+        # Snapshots upload one at a time, and the parts of each file in parallel
+        self.jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix='replicate')
+        self.parts = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix='upload',
+                                        initializer=lower_thread_priority, initargs=priority)
+
+    def enqueue(self, keys, label=None):
+        # `keys` are paths relative to the backup directory, uploaded in order
+        label = label or keys[-1]
+        with self.lock:
+            self.queued.append(label)
+        self.set_queue_gauge()
+        return self.jobs.submit(self.replicate, keys, label)
+
+    def resume(self):
+        # Finish uploads that were interrupted last time
+        keys = []
+        for entry in os.scandir(self.state_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    with open(entry.path, 'r') as f:
+                        keys.append(json.load(f)['key'])
+                except (OSError, ValueError, KeyError):
+                    os.unlink(entry.path)
+
+        if keys:
+            self.log('Resuming {} interrupted upload(s)...'.format(len(keys)))
+            self.enqueue(sorted(set(keys), key=lambda i: (not i.startswith('store/'), i)), label='interrupted uploads')
+
+    def stop(self):
+        self.cancelled.set()
+        self.jobs.shutdown(wait=False, cancel_futures=True)
+        self.parts.shutdown(wait=False, cancel_futures=True)
+        for backend in self.backends:
+            backend.close()
+
+    def replicate(self, keys, label):
+        with self.lock:
+            self.queued.remove(label)
+            self.current = label
+        self.set_queue_gauge()
+
+        try:
+            for backend in self.backends:
+                # Retry whatever failed last time first, so nothing is left behind
+                retry = [i for i in self.failed.get(backend.name, []) if i not in keys]
+                self.failed[backend.name] = []
+                start_time = time.monotonic()
+                uploaded = 0
+
+                for key in retry + keys:
+                    if self.cancelled.is_set():
+                        return
+
+                    try:
+                        uploaded += self.upload_file(backend, key)
+                    except UploadCancelled:
+                        return
+                    except Exception as ex:
+                        self.failed[backend.name].append(key)
+                        self.log('Unable to upload {} to {}: {}. It will be retried with the next backup'.format(
+                            key, backend.describe(), str(ex)), level='warn')
+                        self.count_upload(backend, 'failure')
+
+                duration = time.monotonic() - start_time
+                if uploaded and not self.failed[backend.name]:
+                    self.count_upload(backend, 'success')
+                    self.log('Replicated {} to {}: {} bytes in {:.1f}s ({:.1f} MB/s)'.format(
+                        label, backend.describe(), uploaded, duration,
+                        uploaded / duration / 1048576 if duration else 0))
+        finally:
+            with self.lock:
+                self.current = None
+
+    def upload_file(self, backend, key):
+        path = os.path.join(self.backup_path, key)
+        state_path = os.path.join(self.state_dir, '{}.{}.json'.format(backend.name, key.replace('/', '_')))
+        if not os.path.exists(path):
+            # Pruned before it could be uploaded
+            if os.path.exists(state_path):
+                os.unlink(state_path)
+            return 0
+
+        st = os.stat(path)
+        if self.get_upload_id(key, st) in self.uploaded[backend.name]:
+            return 0
+
+        state = self.load_state(state_path)
+        if state and (state.get('size') != st.st_size or state.get('mtime_ns') != st.st_mtime_ns):
+            state = None
+
+        if state:
+            self.log('Resuming upload of {} to {} ({} of {} part(s) done)'.format(
+                key, backend.describe(), len(state['parts']), state['part_count']), level='debug')
+        else:
+            part_count = max(1, math.ceil(st.st_size / self.part_size))
+            state = {'key': key, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'part_size': self.part_size,
+                     'part_count': part_count, 'upload': backend.begin_upload(key, st.st_size), 'parts': {}}
+            self.save_state(state_path, state)
+
+        try:
+            uploaded = self.upload_parts(backend, path, state, state_path)
+            backend.complete_upload(state['upload'], sorted((int(k), v) for k, v in state['parts'].items()))
+        except StorageError as ex:
+            # The store forgot about the upload (it expired, or was aborted), so start it over next time
+            if ex.code in ['NoSuchUpload', 404]:
+                os.unlink(state_path)
+            raise
+
+        os.unlink(state_path)
+        self.mark_uploaded(backend, self.get_upload_id(key, st))
+        return uploaded
+
+    def upload_parts(self, backend, path, state, state_path):
+        part_size = state['part_size']
+        parts = [
+            Part(path, number, (number - 1) * part_size, min(part_size, state['size'] - (number - 1) * part_size),
+                 bucket=self.bucket, cancelled=self.cancelled)
+            for number in range(1, state['part_count'] + 1) if str(number) not in state['parts']]
+
+        uploaded = 0
+        futures = {self.parts.submit(self.upload_part, backend, state['upload'], part): part for part in parts}
+        try:
+            for future in as_completed(futures):
+                part = futures[future]
+                state['parts'][str(part.number)] = future.result()
+                self.save_state(state_path, state)
+
+                uploaded += part.size
+                if self.metrics:
+                    self.metrics.counter('minecraft_replication_bytes_total', 'Bytes uploaded to replicas').inc(
+                        part.size, backend=backend.name)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        return uploaded
+
+    def upload_part(self, backend, state, part, attempts=3):
+        for attempt in range(attempts):
+            try:
+                return backend.upload_part(state, part)
+            except UploadCancelled:
+                raise
+            except Exception:
+                if attempt == attempts - 1 or self.cancelled.is_set():
+                    raise
+
+                time.sleep(2 ** attempt)
+
+    def load_state(self, state_path):
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, state_path, state):
+        tmp_path = '{}.tmp'.format(state_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def get_upload_id(self, key, st):
+        # Snapshots and chunks never change, but the server JAR copies are replaced when the server is upgraded,
+        # so those are told apart by size and modification time too
+        return '{} {} {}'.format(key, st.st_size, st.st_mtime_ns) if key.endswith('.jar') else key
+
+    def load_uploaded(self, backend):
+        # Keys already uploaded to a backend (see `get_upload_id`), which are never sent twice
+        try:
+            with open(os.path.join(self.state_dir, '{}.uploaded'.format(backend.name)), 'r') as f:
+                return set(line.strip() for line in f if line.strip())
+        except OSError:
+            return set()
+
+    def mark_uploaded(self, backend, key):
+        self.uploaded[backend.name].add(key)
+        with open(os.path.join(self.state_dir, '{}.uploaded'.format(backend.name)), 'a') as f:
+            f.write('{}\n'.format(key))
+
+    def count_upload(self, backend, result):
+        if self.metrics:
+            self.metrics.counter('minecraft_replication_uploads_total', 'Snapshots replicated, by result').inc(
+                backend=backend.name, result=result)
+            if result == 'success':
+                self.metrics.gauge('minecraft_replication_last_success_timestamp_seconds',
+                                   'When a snapshot was last replicated').set(int(time.time()), backend=backend.name)
+
+    def set_queue_gauge(self):
+        if self.metrics:
+            with self.lock:
+                queued = len(self.queued)
+            self.metrics.gauge('minecraft_replication_queue', 'Snapshots waiting to be replicated').set(queued)
+
+    def describe(self):
+        with self.lock:
+            queued, current = len(self.queued), self.current
+
+        failed = sum(len(i) for i in self.failed.values())
+        return '{} to {} | {} queued{}'.format(
+            'uploading {}'.format(current) if current else 'idle', ', '.join(i.describe() for i in self.backends),
+            queued, ' | {} file(s) to retry'.format(failed) if failed else '')
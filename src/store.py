@@ -0,0 +1,120 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+
+
+class ChunkStore:
+    """
+    Content-addressed store for file chunks. Each chunk is saved once, keyed by its
+    SHA-256 digest, so unchanged data is shared between every snapshot that references it
+    """
+
+    def __init__(self, root_path, chunk_size=1048576, compress_level=6):
+        self.root_path = root_path
+        self.objects_path = os.path.join(root_path, 'objects')
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+        self.level_stats = {}
+
+        os.makedirs(self.objects_path, exist_ok=True)
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.get_object_path(digest))
+
+    def put(self, data, level=None):
+        digest = hashlib.sha256(data).hexdigest()
+        if self.has(digest):
+            return digest, 0
+
+        # Write to a temp file first so a crash never leaves a partial chunk behind
+        path = self.get_object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.tmp'.format(path)
+
+        level = self.compress_level if level is None else level
+        start = time.perf_counter()
+        compressed = zlib.compress(data, level)
+
+        # Input bytes, output bytes and compression time, per level
+        stats = self.level_stats.setdefault(level, [0, 0, 0])
+        stats[0] += len(data)
+        stats[1] += len(compressed)
+        stats[2] += time.perf_counter() - start
+
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, path)
+
+        return digest, len(compressed)
+
+    def get(self, digest):
+        with open(self.get_object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def verify(self, digest):
+        # A chunk is intact if it still decompresses to data with the digest it's stored under
+        try:
+            return hashlib.sha256(self.get(digest)).hexdigest() == digest
+        except (OSError, zlib.error):
+            return False
+
+    def iter_digests(self):
+        for prefix in os.scandir(self.objects_path):
+            if not prefix.is_dir():
+                continue
+
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+
+                yield entry.name
+
+    def read_chunks(self, path, opener=None):
+        with (opener(path) if opener else open(path, 'rb')) as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+
+                yield data
+
+    def collect_garbage(self, referenced):
+        removed = 0
+        for digest in list(self.iter_digests()):
+            if digest in referenced:
+                continue
+
+            try:
+                os.unlink(self.get_object_path(digest))
+                removed += 1
+            except OSError:
+                pass
+
+        return removed
+
+
+def read_manifest(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    tmp_path = '{}.tmp'.format(path)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def get_manifest_digests(manifest):
+    digests = set()
+    for item in manifest.get('files', []):
+        digests.update(item.get('chunks', []))
+        digests.update(i[4] for i in item.get('region', []))
+
+    return digests
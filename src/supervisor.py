@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .utils import get_with_default
+from .discord import DiscordManager
+from .log import LogPipeline
+from .manager import MinecraftManager, ManagerState, listen_for_commands
+from .metrics import MetricsServer
+from .throttle import lower_thread_priority
+
+
+def load_config(config_path):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+
+    if not config.get('servers'):
+        raise ValueError('Config file, `{}` does not define any servers!'.format(config_path))
+
+    return config
+
+
+class ServerSupervisor:
+    """
+    Runs several Minecraft servers from one process. Every server gets its own MinecraftManager, while
+    logging, Discord, metrics and the backup worker pool are shared. Backups take turns, so only a
+    bounded number ever run at once
+    """
+
+    # Settings that belong to the supervisor, rather than being defaults for every server
+    supervisor_fields = ['servers', 'log_path', 'log_queue_size', 'discord_api_token', 'discord_console_channel',
+                         'discord_status_channel', 'discord_console_interval', 'discord_status_interval',
+                         'metrics_port', 'max_concurrent_backups', 'backup_stagger']
+
+    def __init__(self, config):
+        self.state = ManagerState.INACTIVE
+        self.log_path = get_with_default(config, 'log_path', default='./minecraft-manager.log')
+        self.log_queue_size = get_with_default(config, 'log_queue_size', default=10000)
+        self.discord_api_token = config.get('discord_api_token')
+        self.discord_options = {
+            'console_channel': config.get('discord_console_channel'),
+            'status_channel': config.get('discord_status_channel'),
+            'console_interval': config.get('discord_console_interval'),
+            'status_interval': config.get('discord_status_interval')
+        }
+        self.metrics_port = config.get('metrics_port')
+        self.max_concurrent_backups = int(get_with_default(config, 'max_concurrent_backups', default=1))
+        self.backup_slot = None
+        self.quit_event = None
+        self.exit_code = 0
+        self.discord = None
+        self.discord_task = None
+        self.metrics_server = None
+        self.command_tasks = set()
+
+        self.configure_logging()
+
+        # Backups from every server share one small pool of low priority threads
+        defaults = {k: v for k, v in config.items() if k not in self.supervisor_fields}
+        self.backup_executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrent_backups, thread_name_prefix='backup', initializer=lower_thread_priority,
+            initargs=(get_with_default(defaults, 'backup_nice', default=10),
+                      get_with_default(defaults, 'backup_io_priority', default='low')))
+
+        self.instances = {}
+        servers = config['servers']
+        used_paths = {}
+
+        # Servers with automatically sized heaps split the host's memory evenly
+        auto_heaps = [name for name, server in servers.items()
+                      if str(dict(defaults, **server).get('max_java_memory')).lower() == 'auto']
+
+        for index, (name, server) in enumerate(servers.items()):
+            if ' ' in name or name.lower() in ['all', 'quit', 'exit', 'help', 'instances', 'servers']:
+                raise ValueError('`{}` can\'t be used as a server name!'.format(name))
+
+            kwargs = dict(defaults, **server)
+            for key in ['excluded_files', 'excluded_file_types', 'compression_rules', 'replicate_to']:
+                if isinstance(kwargs.get(key), str):
+                    kwargs[key] = kwargs[key].split(',')
+
+            # Servers sharing a backup directory would share one catalog, and restore and prune each other's
+            # snapshots, so each gets its own under the common one unless it names its own
+            if 'backup_dir' not in server:
+                kwargs['backup_dir'] = os.path.join(get_with_default(defaults, 'backup_dir', default='./backups'), name)
+
+            for key in ['server_path', 'backup_dir']:
+                path = kwargs.get(key)
+                if not path:
+                    continue
+
+                path = os.path.abspath(os.path.dirname(path) if path.endswith('.jar') else path)
+                if path in used_paths:
+                    raise ValueError('`{}` and `{}` can\'t share a {}: {}'.format(used_paths[path], name, key, path))
+                used_paths[path] = name
+
+            if name in auto_heaps:
+                kwargs.setdefault('heap_share', 1.0 / len(auto_heaps))
+
+            # Spread scheduled backups evenly across the backup period, unless told otherwise
+            if 'backup_offset' not in kwargs:
+                frequency = int(get_with_default(kwargs, 'backup_frequency', default=21600))
+                kwargs['backup_offset'] = get_with_default(
+                    config, 'backup_stagger', default=frequency / len(servers)) * index
+
+            self.instances[name] = MinecraftManager(
+                kwargs.pop('server_path', None), name=name, supervisor=self, **kwargs)
+
+    @classmethod
+    def from_file(cls, config_path):
+        return cls(load_config(config_path))
+
+    def configure_logging(self):
+        self.log_pipeline = LogPipeline(self.log_path, queue_size=self.log_queue_size)
+        logging.basicConfig(
+            level=logging.DEBUG,
+            handlers=[self.log_pipeline.start()]
+        )
+
+        self.logger = logging.getLogger('minecraft-manager')
+        logging.getLogger('asyncio').setLevel(logging.WARNING)
+
+    def log(self, msg, level='info', with_traceback=False):
+        if hasattr(self.logger, level):
+            getattr(self.logger, level)(msg)
+        if with_traceback:
+            self.logger.debug(traceback.format_exc())
+
+    def start(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self.backup_slot = asyncio.Semaphore(self.max_concurrent_backups)
+        self.quit_event = asyncio.Event()
+        self.state = ManagerState.RUNNING
+
+        self.log('Starting Minecraft Manager for {} servers: {}'.format(
+            len(self.instances), ', '.join(self.instances)))
+        self.log('Type `help` for a list of commands')
+
+        # One endpoint serves every server's metrics, labelled by server name
+        if self.metrics_port:
+            self.metrics_server = MetricsServer([i.metrics for i in self.instances.values()], port=self.metrics_port)
+            try:
+                await self.metrics_server.start()
+            except OSError as ex:
+                self.log('Unable to serve metrics on port {}: {}'.format(self.metrics_port, str(ex)), level='warn')
+                self.metrics_server = None
+
+        stdin_task = asyncio.create_task(listen_for_commands(self))
+
+        for instance in self.instances.values():
+            instance.create_loop_state()
+            await instance.start_instance()
+
+        if self.discord_api_token:
+            self.discord = DiscordManager(self.discord_api_token, self, **self.discord_options)
+            self.discord_task = asyncio.create_task(self.discord.start())
+
+        await self.quit_event.wait()
+
+        for task in [stdin_task, self.discord_task] + list(self.command_tasks):
+            if task and not task.done() and task is not asyncio.current_task():
+                task.cancel()
+
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+        self.backup_executor.shutdown(wait=False)
+
+    async def command_handler(self, command):
+        if not command:
+            return
+
+        parts = command.strip().split(maxsplit=1)
+        target = parts[0]
+        args = parts[1] if len(parts) > 1 else ''
+
+        if target.lower() in ['quit', 'exit']:
+            await self.quit()
+        elif target.lower() in ['help']:
+            self.display_help()
+        elif target.lower() in ['instances', 'servers']:
+            self.display_instances()
+        elif target.lower() == 'all' and args:
+            await asyncio.gather(*[i.command_handler(args) for i in self.instances.values()])
+        elif target in self.instances and args:
+            await self.instances[target].command_handler(args)
+        elif len(self.instances) == 1:
+            # With only one server, there's nothing to choose between
+            await next(iter(self.instances.values())).command_handler(command)
+        else:
+            self.log('Unknown server, "{}". Start commands with one of: {}, all'.format(
+                target, ', '.join(self.instances)), level='warn')
+
+    async def quit(self, exit_code=0):
+        self.log('Quiting Minecraft Manager...')
+        self.state = ManagerState.QUITING
+        await asyncio.gather(*[i.stop_server(quit=True) for i in self.instances.values()])
+        if self.discord:
+            await self.discord.stop()
+
+        self.exit_code = exit_code
+        self.quit_event.set()
+
+    def terminate_server(self):
+        for instance in self.instances.values():
+            instance.terminate_server()
+
+    def display_help(self):
+        parts = [
+            '[========== Help ========== ]',
+            '',
+            'Hint: Start commands with the name of the server they are for, e.g. `{} backup`'.format(
+                next(iter(self.instances))),
+            '',
+            'Commands:',
+            '- <server> <command>         -> Run a command on one server (`<server> help` lists them)',
+            '- all <command>              -> Run a command on every server',
+            '- instances, servers         -> List the servers and their state',
+            '- quit, exit                 -> Stop every server and quit the application'
+        ]
+
+        for i in parts:
+            self.log(i)
+
+    def display_instances(self):
+        states = {
+            ManagerState.INACTIVE: 'stopped', ManagerState.RUNNING: 'running',
+            ManagerState.STOPPING: 'stopping', ManagerState.QUITING: 'quit'
+        }
+
+        self.log('[========== Servers ({}) ========== ]'.format(len(self.instances)))
+        for name, instance in self.instances.items():
+            self.log('- {} | {} | {} player(s) online | next backup: {}'.format(
+                name, states.get(instance.state, '?'), len(instance.players),
+                instance.next_backup_time.strftime('%Y-%m-%d %H:%M:%S') if instance.next_backup_time else 'none'))
@@ -0,0 +1,165 @@
+import os
+import platform
+import sys
+import threading
+import time
+
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASSES = {
+    'normal': (2, 4),  # Best effort, default level
+    'low': (2, 7),  # Best effort, lowest level
+    'idle': (3, 0)  # Only when nobody else wants the disk
+}
+
+# ioprio_set has no libc wrapper, so it has to be called by syscall number
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273
+}
+
+
+def set_io_priority(tid, priority):
+    ioprio_class, level = IOPRIO_CLASSES[priority]
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not syscall:
+        return False
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall(syscall, IOPRIO_WHO_PROCESS, tid, (ioprio_class << IOPRIO_CLASS_SHIFT) | level) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+def lower_thread_priority(nice=10, io_priority='low'):
+    """
+    Lowers the CPU and I/O priority of the calling thread. Linux tracks both per thread, so this only
+    affects threads dedicated to backup work, never the event loop
+    """
+
+    if not sys.platform.startswith('linux') or not hasattr(threading, 'get_native_id'):
+        return
+
+    tid = threading.get_native_id()
+    try:
+        if nice:
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + int(nice)))
+    except OSError:
+        pass
+
+    if io_priority and io_priority != 'normal':
+        set_io_priority(tid, io_priority)
+
+
+class TokenBucket:
+    """
+    Limits throughput to `rate` units per second, allowing bursts of up to `burst` units
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        # Returns how long the caller had to wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Go into debt for large reads, and wait for the bucket to refill
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+
+class CpuBudget:
+    """
+    Keeps the process' CPU use at or below `cores` CPU seconds per wall-clock second, by sleeping
+    whenever work runs ahead of the budget
+    """
+
+    def __init__(self, cores, interval=0.1):
+        self.cores = float(cores)
+        self.interval = interval
+        self.start_cpu = time.process_time()
+        self.start = time.monotonic()
+        self.checked = self.start
+
+    def check(self):
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return 0
+
+        self.checked = now
+        wait = (time.process_time() - self.start_cpu) / self.cores - (now - self.start)
+        if wait > 0:
+            time.sleep(wait)
+            self.checked = time.monotonic()
+            return wait
+
+        return 0
+
+
+class BackupThrottle:
+    """
+    Read bandwidth and CPU time budgets for a single snapshot. Every file read made by the snapshot goes
+    through `read`, which waits as long as needed to stay within both budgets
+    """
+
+    def __init__(self, read_limit=0, cpu_limit=0):
+        self.read_bucket = TokenBucket(read_limit, burst=read_limit / 4) if read_limit else None
+        self.cpu_budget = CpuBudget(cpu_limit) if cpu_limit else None
+        self.read_wait = 0
+        self.cpu_wait = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.read_bucket or self.cpu_budget)
+
+    def read(self, size):
+        read_wait = self.read_bucket.consume(size) if self.read_bucket else 0
+        cpu_wait = self.cpu_budget.check() if self.cpu_budget else 0
+        if read_wait or cpu_wait:
+            with self.lock:
+                self.read_wait += read_wait
+                self.cpu_wait += cpu_wait
+
+    def open(self, path):
+        f = open(path, 'rb')
+        return ThrottledFile(f, self) if self.enabled else f
+
+
+class ThrottledFile:
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fileobj.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.read(len(data))
+        return data
@@ -0,0 +1,208 @@
+import os
+import struct
+import time
+import zlib
+
+import pytest
+
+from src.anvil import SECTOR_SIZE, read_region_header, write_region_file
+from src.backup import BackupCancelled, BackupManager, BackupMode
+from src.benchmark import BenchmarkManager
+from src.store import read_manifest
+
+
+def make_chunk(payload):
+    data = zlib.compress(payload)
+    return struct.pack('>IB', len(data) + 1, 2) + data
+
+
+def rewrite_chunk(path, index, payload):
+    # In place, keeping the location and the save timestamp, like a second save within the same second
+    with open(path, 'r+b') as f:
+        offset = [i for i in read_region_header(f, os.path.getsize(path)) if i[0] == index][0][1]
+        f.seek(offset * SECTOR_SIZE)
+        f.write(make_chunk(payload))
+
+
+def take_snapshot(server_dir, backup_dir, mtime):
+    region_path = os.path.join(server_dir, 'world', 'region', 'r.0.0.mca')
+    os.utime(region_path, (mtime, mtime))
+
+    manager = BenchmarkManager(os.path.join(server_dir, 'server.jar'))
+    backup = BackupManager(manager.jar_path, backup_dir, manager=manager, backup_mode=BackupMode.REGION)
+    snapshot = backup.take_snapshot()
+    time.sleep(1)  # Snapshots are named by the second
+    return backup, snapshot
+
+
+def get_region_entries(snapshot):
+    return {i['path']: i for i in read_manifest(snapshot)['files'] if i['path'].endswith('.mca')}
+
+
+def make_server(tmp_path, saved_at):
+    server_dir = tmp_path / 'server'
+    region_dir = server_dir / 'world' / 'region'
+    region_dir.mkdir(parents=True)
+    (server_dir / 'server.jar').write_bytes(b'jar')
+
+    chunks = [(0, 2, 1, saved_at, make_chunk(b'a' * 100)), (1, 3, 1, saved_at, make_chunk(b'b' * 100))]
+    write_region_file(str(region_dir / 'r.0.0.mca'), 0, chunks, lambda data: data)
+    return str(server_dir), str(region_dir / 'r.0.0.mca')
+
+
+def restore_region(backup, snapshot, tmp_path):
+    target_dir = tmp_path / 'restored'
+    target_dir.mkdir(exist_ok=True)
+    backup.restore_manifest(snapshot, str(target_dir), 'world/region/r.0.0.mca')
+    with open(target_dir / 'world' / 'region' / 'r.0.0.mca', 'rb') as f:
+        return f.read()
+
+
+def test_rewrite_in_the_same_second_is_not_reused(tmp_path):
+    saved_at = int(time.time())
+    server_dir, region_path = make_server(tmp_path, saved_at)
+    backup_dir = str(tmp_path / 'backups')
+
+    # The first snapshot reads the file in the second its chunks were saved
+    take_snapshot(server_dir, backup_dir, saved_at)
+    rewrite_chunk(region_path, 0, b'c' * 100)
+    backup, snapshot = take_snapshot(server_dir, backup_dir, saved_at + 1)
+
+    with open(region_path, 'rb') as f:
+        assert restore_region(backup, snapshot, tmp_path) == f.read()
+
+
+def test_rewrite_with_a_new_length_is_not_reused(tmp_path):
+    saved_at = int(time.time()) - 3600
+    server_dir, region_path = make_server(tmp_path, saved_at)
+    backup_dir = str(tmp_path / 'backups')
+
+    take_snapshot(server_dir, backup_dir, saved_at + 60)
+    rewrite_chunk(region_path, 1, os.urandom(200))
+    backup, snapshot = take_snapshot(server_dir, backup_dir, saved_at + 120)
+
+    with open(region_path, 'rb') as f:
+        assert restore_region(backup, snapshot, tmp_path) == f.read()
+
+
+def test_untouched_chunks_are_reused(tmp_path):
+    saved_at = int(time.time()) - 3600
+    server_dir, region_path = make_server(tmp_path, saved_at)
+    backup_dir = str(tmp_path / 'backups')
+
+    _, first = take_snapshot(server_dir, backup_dir, saved_at + 60)
+    _, second = take_snapshot(server_dir, backup_dir, saved_at + 120)
+
+    first_entries = get_region_entries(first)
+    second_entries = get_region_entries(second)
+    assert first_entries.keys() == second_entries.keys()
+    for path, item in second_entries.items():
+        assert item['region'] == first_entries[path]['region']
+        assert all(i[5] for i in item['region'])
+
+
+def test_small_files_are_not_stored_after_a_region_file(tmp_path):
+    server_dir = tmp_path / 'server'
+    (server_dir / 'world').mkdir(parents=True)
+    (server_dir / 'server.jar').write_bytes(b'jar')
+    (server_dir / 'world' / 'r.0.0.mca').write_bytes(os.urandom(BackupManager.min_codec_size))
+    (server_dir / 'world' / 'z.txt').write_bytes(b'log line\n' * 100)
+    (server_dir / 'world' / 'zz.json').write_bytes(b'{}')
+
+    manager = BenchmarkManager(str(server_dir / 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(tmp_path / 'backups'), manager=manager)
+    backup.take_snapshot()
+
+    assert backup.codec_stats['store'][0] == 1
+    assert backup.codec_stats['default'][0] == 2
+
+
+@pytest.mark.parametrize('mode', [BackupMode.FULL, BackupMode.REGION])
+def test_cancelled_snapshot_leaves_nothing_behind(tmp_path, mode):
+    server_dir, _ = make_server(tmp_path, int(time.time()) - 3600)
+    backup_dir = tmp_path / 'backups'
+
+    manager = BenchmarkManager(os.path.join(server_dir, 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(backup_dir), manager=manager, backup_mode=mode)
+    backup.cancel()
+    with pytest.raises(BackupCancelled):
+        backup.take_snapshot()
+
+    assert not [i for i in os.listdir(backup_dir) if i.startswith('minecraft-backup-')]
+    assert backup.get_backup_count() == 0
+
+
+def test_changes_are_seen_in_any_time_zone(tmp_path, monkeypatch):
+    # Snapshot names and file times have to agree on the epoch, or a non-UTC host skips needed backups
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        server_dir, region_path = make_server(tmp_path, int(time.time()) - 3600)
+        backup, snapshot = take_snapshot(server_dir, str(tmp_path / 'backups'), time.time() - 60)
+
+        last = backup.get_last_snapshot_time()
+        assert abs(last - time.time()) < 5
+        assert not backup.has_changes_since(last)
+
+        os.utime(region_path)
+        assert backup.has_changes_since(last)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_staging_links_unchanged_files_to_the_last_copy(tmp_path):
+    server_dir, region_path = make_server(tmp_path, int(time.time()) - 3600)
+    (tmp_path / 'server' / 'server.properties').write_text('motd=hi\n')
+
+    manager = BenchmarkManager(os.path.join(server_dir, 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(tmp_path / 'backups'), manager=manager)
+    first = backup.stage_snapshot()
+    first_inode = os.stat(os.path.join(first, 'server.properties')).st_ino
+
+    os.utime(region_path, (time.time() + 5, time.time() + 5))
+    second = backup.stage_snapshot()
+
+    assert first == second
+    assert os.stat(os.path.join(second, 'server.properties')).st_ino == first_inode
+    assert os.stat(os.path.join(second, 'world', 'region', 'r.0.0.mca')).st_nlink == 1
+
+
+@pytest.mark.parametrize('mode', [BackupMode.INCREMENTAL, BackupMode.REGION])
+def test_restore_that_does_not_match_its_snapshot_is_abandoned(tmp_path, mode):
+    server_dir, region_path = make_server(tmp_path, int(time.time()) - 3600)
+    (tmp_path / 'server' / 'level.dat').write_bytes(b'level' * 1000)
+
+    manager = BenchmarkManager(os.path.join(server_dir, 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(tmp_path / 'backups'), manager=manager, backup_mode=mode)
+    snapshot = backup.take_snapshot()
+
+    # A chunk that still decompresses, but to the wrong data
+    entry = [i for i in read_manifest(snapshot)['files'] if i['path'].endswith('.mca')][0]
+    digest = entry['region'][0][4] if 'region' in entry else entry['chunks'][0]
+    with open(backup.get_chunk_store().get_object_path(digest), 'wb') as f:
+        f.write(zlib.compress(make_chunk(b'x' * 100)))
+
+    with pytest.raises(ValueError, match='world/region/r.0.0.mca is corrupt'):
+        backup.prepare_restore(snapshot, server_dir)
+
+    assert sorted(os.listdir(str(tmp_path))) == ['backups', 'server']
+
+
+def test_restored_server_keeps_the_old_files_until_discarded(tmp_path):
+    server_dir, _ = make_server(tmp_path, int(time.time()) - 3600)
+    (tmp_path / 'server' / 'level.dat').write_bytes(b'before')
+
+    manager = BenchmarkManager(os.path.join(server_dir, 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(tmp_path / 'backups'), manager=manager)
+    snapshot = backup.take_snapshot()
+    (tmp_path / 'server' / 'level.dat').write_bytes(b'after')
+
+    backup.swap_in_restore(backup.prepare_restore(snapshot, server_dir), server_dir)
+    assert (tmp_path / 'server' / 'level.dat').read_bytes() == b'before'
+    assert (tmp_path / 'server.old' / 'level.dat').read_bytes() == b'after'
+
+    # A restore that won't start is swapped back
+    backup.roll_back_restore(server_dir)
+    assert (tmp_path / 'server' / 'level.dat').read_bytes() == b'after'
+    assert sorted(os.listdir(str(tmp_path))) == ['backups', 'server']
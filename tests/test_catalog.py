@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from src.catalog import RetentionPolicy, Snapshot
+
+
+def make_snapshots(*times):
+    return [Snapshot('minecraft-backup-{}.tar.gz'.format(i), i) for i in
+            (int((time - datetime(1970, 1, 1)).total_seconds()) for time in times)]
+
+
+def get_kept(policy, snapshots):
+    expired = policy.get_expired(snapshots)
+    return sorted(datetime.utcfromtimestamp(i.timestamp) for i in snapshots if i not in expired)
+
+
+def test_keeps_the_newest_snapshots():
+    start = datetime(2021, 10, 1)
+    snapshots = make_snapshots(*[start + timedelta(hours=i) for i in range(10)])
+
+    assert get_kept(RetentionPolicy(keep_last=3), snapshots) == [start + timedelta(hours=i) for i in [7, 8, 9]]
+
+
+def test_keeps_the_newest_snapshot_of_each_day():
+    # Four backups a day for five days
+    start = datetime(2021, 10, 1)
+    snapshots = make_snapshots(*[start + timedelta(hours=i * 6) for i in range(20)])
+
+    assert get_kept(RetentionPolicy(keep_last=2, keep_daily=3), snapshots) == [
+        datetime(2021, 10, 3, 18), datetime(2021, 10, 4, 18), datetime(2021, 10, 5, 12), datetime(2021, 10, 5, 18)]
+
+
+def test_weeks_and_months_are_kept_on_top_of_days():
+    # One backup a day, from a Monday, for eight weeks
+    start = datetime(2021, 9, 6)
+    snapshots = make_snapshots(*[start + timedelta(days=i) for i in range(56)])
+
+    kept = get_kept(RetentionPolicy(keep_last=1, keep_daily=2, keep_weekly=3, keep_monthly=3), snapshots)
+
+    # Sundays end ISO weeks, and the last day of September ends that month
+    assert kept == [datetime(2021, 9, 30), datetime(2021, 10, 17), datetime(2021, 10, 24), datetime(2021, 10, 30),
+                    datetime(2021, 10, 31)]
+
+
+def test_nothing_is_kept_past_the_limits():
+    snapshots = make_snapshots(datetime(2020, 1, 1), datetime(2021, 6, 1), datetime(2021, 10, 1))
+
+    assert get_kept(RetentionPolicy(keep_last=0, keep_monthly=1), snapshots) == [datetime(2021, 10, 1)]
@@ -0,0 +1,112 @@
+import asyncio
+
+from src.discord import ConsoleRelay, DiscordManager, MAX_MESSAGE_SIZE
+from src.events import ConsoleLine, EventBus
+
+
+class StubChannel:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content):
+        assert len(content) <= MAX_MESSAGE_SIZE
+        self.sent.append(content)
+
+
+class StubClient:
+    user = 'bot'
+
+    def __init__(self):
+        self.channel = StubChannel()
+
+    def get_channel(self, channel_id):
+        return self.channel
+
+    async def close(self):
+        pass
+
+
+class StubManager:
+    name = None
+
+    def __init__(self):
+        self.events = EventBus()
+
+    def log(self, msg, level='info', with_traceback=False):
+        pass
+
+
+def get_lines(messages):
+    lines = []
+    for message in messages:
+        assert message.startswith('```\n') and message.endswith('\n```')
+        lines.extend(message[4:-4].split('\n'))
+    return lines
+
+
+def test_batches_lines_into_few_messages():
+    relay = ConsoleRelay(None)
+    for i in range(10):
+        relay.add('line {}'.format(i))
+
+    messages = relay.get_messages()
+    assert len(messages) == 1
+    assert get_lines(messages) == ['line {}'.format(i) for i in range(10)]
+    assert relay.get_messages() == []
+
+
+def test_splits_messages_at_the_discord_limit():
+    relay = ConsoleRelay(None, messages_per_flush=10)
+    for i in range(100):
+        relay.add('{:03d} {}'.format(i, 'x' * 96))
+
+    messages = relay.get_messages()
+    assert len(messages) > 1
+    assert all(len(i) <= MAX_MESSAGE_SIZE for i in messages)
+    assert get_lines(messages) == ['{:03d} {}'.format(i, 'x' * 96) for i in range(100)]
+
+
+def test_long_lines_and_code_fences_are_made_safe():
+    relay = ConsoleRelay(None)
+    relay.add('a' * 5000)
+    relay.add('```oops```')
+
+    lines = get_lines(relay.get_messages())
+    assert len(lines[0]) == MAX_MESSAGE_SIZE - 100
+    assert '```' not in lines[1]
+
+
+def test_hides_player_addresses():
+    relay = ConsoleRelay(None)
+    relay.add('Steve[/203.0.113.7:51234] logged in with entity id 42')
+
+    lines = get_lines(relay.get_messages())
+    assert lines == ['Steve[/<ip hidden>] logged in with entity id 42']
+
+
+def test_overflow_keeps_the_newest_lines():
+    relay = ConsoleRelay(None, messages_per_flush=100, max_lines=5)
+    for i in range(8):
+        relay.add('line {}'.format(i))
+
+    lines = get_lines(relay.get_messages())
+    assert lines == ['... 3 line(s) skipped to keep up'] + ['line {}'.format(i) for i in range(3, 8)]
+
+
+def test_streams_console_events_to_the_channel():
+    async def run():
+        client = StubClient()
+        manager = StubManager()
+        discord = DiscordManager('token', manager, console_channel=1, console_interval=0.05, client=client)
+        await discord.start_channels()
+
+        for i in range(3):
+            manager.events.publish(ConsoleLine('[12:00:00 INFO]: line {} from /10.0.0.1:25565'.format(i)))
+        await asyncio.sleep(0.2)
+        await discord.stop()
+        return client.channel.sent
+
+    sent = asyncio.run(run())
+    assert len(sent) == 1
+    assert get_lines(sent) == ['[12:00:00 INFO]: line {} from /<ip hidden>'.format(i) for i in range(3)]
@@ -0,0 +1,36 @@
+import pytest
+
+from src.events import LogParser, PlayerCount, PlayerJoined, PlayerLeft, ServerLagging, ServerReady, \
+    ServerStopping, TpsReport, WorldSaved
+
+
+@pytest.mark.parametrize('line, event', [
+    ('[12:00:00] [Server thread/INFO]: Steve joined the game', PlayerJoined('Steve')),
+    ('[12:00:00 INFO]: Steve left the game', PlayerLeft('Steve')),
+    ('[12:00:00] [Server thread/INFO]: Done (12.345s)! For help, type "help"', ServerReady(12.345)),
+    ('[12:00:00] [Server thread/INFO]: Done (12,5s)! For help, type "help"', ServerReady(12.5)),
+    ('[12:00:00] [Server thread/WARN]: Can\'t keep up! Is the server overloaded? Running 2500ms or 50 ticks behind',
+     ServerLagging(2500, 50)),
+    ('[12:00:00] [Server thread/INFO]: \x1b[0;33mTPS from last 1m, 5m, 15m: \x1b[0;32m*20.0, 19.5, §a18.25',
+     TpsReport(20.0, 19.5, 18.25)),
+    ('[12:00:00] [Server thread/INFO]: There are 3 of a max of 20 players online: Steve, Alex, Herobrine',
+     PlayerCount(3, 20)),
+    ('[12:00:00] [Server thread/INFO]: Stopping the server', ServerStopping()),
+    ('[12:00:00] [Server thread/INFO]: Saved the game', WorldSaved())
+])
+def test_parses_server_messages(line, event):
+    parsed = LogParser().parse(line)
+    assert type(parsed) is type(event)
+    assert parsed == event
+
+
+@pytest.mark.parametrize('line', [
+    '[12:00:00] [Server thread/INFO]: <Steve> Alex joined the game',
+    '[12:00:00] [Server thread/INFO]: <Steve> Alex left the game',
+    '[12:00:00] [Async Chat Thread - #0/INFO]: <Steve> Done (1.0s)! For help, type "help"',
+    '[12:00:00] [Server thread/INFO]: [Steve] Saved the game',
+    '[12:00:00] [Server thread/INFO]: * Steve Stopping the server',
+    '[12:00:00] [Server thread/INFO]: Preparing spawn area: 83%'
+])
+def test_chat_cannot_pass_for_server_messages(line):
+    assert LogParser().parse(line) is None
@@ -0,0 +1,59 @@
+import os
+
+from src.backup import BackupManager
+from src.benchmark import BenchmarkManager
+from src.ignore import IgnoreRules
+
+
+def make_rules(*patterns):
+    rules = IgnoreRules()
+    for pattern in patterns:
+        rules.add(pattern)
+    rules.compile()
+    return rules
+
+
+def test_negated_patterns_bring_files_back():
+    rules = make_rules('*.log', '!latest.log')
+
+    assert rules.is_excluded('logs/debug.log')
+    assert not rules.is_excluded('logs/latest.log')
+    assert not rules.is_excluded('world/level.dat')
+
+
+def test_patterns_with_a_slash_are_anchored_to_the_root():
+    rules = make_rules('/server.properties', 'world/data/raids.dat', 'usercache.json')
+
+    assert rules.is_excluded('server.properties')
+    assert not rules.is_excluded('config/server.properties')
+    assert rules.is_excluded('world/data/raids.dat')
+    assert not rules.is_excluded('backups/world/data/raids.dat')
+    assert rules.is_excluded('usercache.json')
+    assert rules.is_excluded('plugins/usercache.json')
+
+
+def test_directory_patterns_only_match_directories():
+    rules = make_rules('cache/')
+
+    assert rules.is_excluded('cache', is_dir=True)
+    assert rules.is_excluded('plugins/dynmap/cache', is_dir=True)
+    assert not rules.is_excluded('cache')
+
+
+def test_excluded_directories_are_not_walked(tmp_path):
+    server_dir = tmp_path / 'server'
+    (server_dir / 'plugins' / 'dynmap' / 'web').mkdir(parents=True)
+    (server_dir / 'plugins' / 'dynmap' / 'web' / 'index.html').write_text('map')
+    (server_dir / 'plugins' / 'dynmap' / 'config.txt').write_text('config')
+    (server_dir / 'server.jar').write_bytes(b'jar')
+
+    # Like git, a file can't be brought back once its directory is excluded
+    (server_dir / '.backupignore').write_text('# Map tiles are rendered again\n\nplugins/dynmap/web/\n'
+                                              '!plugins/dynmap/web/index.html\n')
+
+    manager = BenchmarkManager(str(server_dir / 'server.jar'))
+    backup = BackupManager(manager.jar_path, str(tmp_path / 'backups'), manager=manager)
+    paths = [i[0] for i in backup.walk_server_files(str(server_dir))]
+
+    assert paths == ['plugins', '.backupignore', os.path.join('plugins', 'dynmap'),
+                     os.path.join('plugins', 'dynmap', 'config.txt')]
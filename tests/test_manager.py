@@ -0,0 +1,127 @@
+import asyncio
+import sys
+
+from src.manager import ManagerState, MinecraftManager
+
+# Stands in for Java, noting each start and stop: it crashes if there's a `broken` file, or says it's ready,
+# saves when asked to and takes a moment to exit on `stop`
+FAKE_SERVER = '''#!{python}
+import os
+import sys
+import time
+with open({runs!r}, 'a') as f:
+    f.write('start\\n')
+if os.path.exists('broken'):
+    with open({runs!r}, 'a') as f:
+        f.write('crash\\n')
+    sys.exit(1)
+print('[12:00:00] [Server thread/INFO]: Done (0.1s)! For help, type "help"', flush=True)
+for line in sys.stdin:
+    if line.strip() == 'save-all':
+        print('[12:00:00] [Server thread/INFO]: Saved the game', flush=True)
+    elif line.strip() == 'stop':
+        time.sleep(0.5)
+        break
+with open({runs!r}, 'a') as f:
+    f.write('stop\\n')
+'''
+
+
+def make_manager(tmp_path):
+    server_dir = tmp_path / 'server'
+    (server_dir / 'world').mkdir(parents=True)
+    (server_dir / 'server.jar').write_bytes(b'jar')
+    (server_dir / 'world' / 'level.dat').write_bytes(b'saved')
+
+    java_path = tmp_path / 'java'
+    java_path.write_text(FAKE_SERVER.format(python=sys.executable, runs=str(tmp_path / 'runs.log')))
+    java_path.chmod(0o755)
+
+    manager = MinecraftManager(str(server_dir / 'server.jar'), java_path=str(java_path),
+                               backup_dir=str(tmp_path / 'backups'), log_path=str(tmp_path / 'manager.log'),
+                               startup_timeout=10, stop_timeout=10)
+    return manager, server_dir
+
+
+def test_quit_waits_for_a_running_restore(tmp_path):
+    manager, server_dir = make_manager(tmp_path)
+    manager.get_backup_manager().take_snapshot()
+    (server_dir / 'world' / 'level.dat').write_bytes(b'changed')
+
+    async def run():
+        manager.create_loop_state()
+        await manager.start_server()
+        await manager.wait_until_ready()
+
+        restore = asyncio.create_task(manager.command_handler('restore'))
+        await asyncio.sleep(0.1)
+        await manager.command_handler('quit')
+        await restore
+
+    asyncio.run(run())
+
+    # The restore stopped the server before swapping the files, started it again, and quitting then stopped it
+    assert (server_dir / 'world' / 'level.dat').read_bytes() == b'saved'
+    assert (tmp_path / 'runs.log').read_text().split() == ['start', 'stop', 'start', 'stop']
+    assert manager.state == ManagerState.QUITING
+    assert manager.quit_event.is_set()
+
+
+def test_quit_drops_commands_queued_behind_a_running_one(tmp_path):
+    manager, server_dir = make_manager(tmp_path)
+
+    async def run():
+        manager.create_loop_state()
+        await manager.start_server()
+        await manager.wait_until_ready()
+
+        stop = asyncio.create_task(manager.command_handler('stop'))
+        start = asyncio.create_task(manager.command_handler('start'))
+        await asyncio.sleep(0.1)
+        await manager.command_handler('quit')
+        await stop
+        await asyncio.wait([start])
+        return start
+
+    start = asyncio.run(run())
+
+    # The stop in progress carried on into quitting, and the start waiting behind it never ran
+    assert start.cancelled()
+    assert (tmp_path / 'runs.log').read_text().split() == ['start', 'stop']
+    assert manager.state == ManagerState.QUITING
+
+
+def run_restore(manager):
+    async def run():
+        manager.create_loop_state()
+        await manager.start_server()
+        await manager.wait_until_ready()
+        await manager.command_handler('restore')
+        ready = manager.server_ready.is_set()
+        await manager.command_handler('quit')
+        return ready
+
+    return asyncio.run(run())
+
+
+def test_restore_drops_the_old_files_once_the_server_is_ready(tmp_path):
+    manager, server_dir = make_manager(tmp_path)
+    manager.get_backup_manager().take_snapshot()
+    (server_dir / 'world' / 'level.dat').write_bytes(b'changed')
+
+    assert run_restore(manager)
+    assert (server_dir / 'world' / 'level.dat').read_bytes() == b'saved'
+    assert not (tmp_path / 'server.old').exists()
+
+
+def test_restored_server_that_will_not_start_is_swapped_back(tmp_path):
+    manager, server_dir = make_manager(tmp_path)
+    (server_dir / 'broken').write_bytes(b'')
+    manager.get_backup_manager().take_snapshot()
+    (server_dir / 'broken').unlink()
+    (server_dir / 'world' / 'level.dat').write_bytes(b'changed')
+
+    assert run_restore(manager)
+    assert (server_dir / 'world' / 'level.dat').read_bytes() == b'changed'
+    assert (tmp_path / 'runs.log').read_text().split() == ['start', 'stop', 'start', 'crash', 'start', 'stop']
+    assert not (tmp_path / 'server.old').exists()
@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+from src.metrics import MetricsRegistry, render_registries
+
+
+sample_pattern = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_]\w*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+
+
+def make_registry(name, players):
+    registry = MetricsRegistry({'instance': name})
+    registry.gauge('minecraft_players_online', 'Players currently online').set(players)
+    registry.counter('minecraft_backups_total', 'Backups taken').inc(mode='full')
+    registry.histogram('minecraft_backup_seconds', 'Time spent taking backups').observe(3.5)
+    return registry
+
+
+def parse(text):
+    # Checks the exposition format by hand: each family is declared once and its samples follow it
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            name = line.split(' ')[2]
+            assert name not in families, 'duplicate HELP for {}'.format(name)
+            families[name] = {'type': None, 'samples': []}
+            current = name
+        elif line.startswith('# TYPE '):
+            _, _, name, type_name = line.split(' ')
+            assert name == current and families[name]['type'] is None
+            families[name]['type'] = type_name
+        else:
+            match = sample_pattern.match(line)
+            assert match, 'bad sample line {!r}'.format(line)
+            assert re.match(re.escape(current) + r'(_bucket|_sum|_count)?$', match.group(1)), line
+            families[current]['samples'].append(line)
+            float(match.group(3))
+
+    return families
+
+
+def test_merges_families_across_registries():
+    text = render_registries([make_registry('survival', 3), make_registry('creative', 1)])
+    families = parse(text)
+
+    assert sorted(families) == ['minecraft_backup_seconds', 'minecraft_backups_total', 'minecraft_players_online']
+    assert families['minecraft_players_online']['samples'] == [
+        'minecraft_players_online{instance="survival"} 3',
+        'minecraft_players_online{instance="creative"} 1'
+    ]
+    assert families['minecraft_backups_total']['type'] == 'counter'
+    assert any('instance="creative"' in i and '_bucket' in i for i in families['minecraft_backup_seconds']['samples'])
+
+
+def test_single_registry_renders_the_same():
+    registry = make_registry('survival', 2)
+    assert registry.render() == render_registries([registry])
+    parse(registry.render())
+
+
+def test_output_parses_with_prometheus_client():
+    parser = pytest.importorskip('prometheus_client.parser')
+
+    text = render_registries([make_registry('survival', 3), make_registry('creative', 1)])
+    families = {i.name: i for i in parser.text_string_to_metric_families(text)}
+
+    players = families['minecraft_players_online']
+    assert {i.labels['instance']: i.value for i in players.samples} == {'survival': 3, 'creative': 1}
+    assert families['minecraft_backup_seconds'].type == 'histogram'
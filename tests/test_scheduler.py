@@ -0,0 +1,74 @@
+import asyncio
+
+from src.scheduler import CommandScheduler, Priority
+
+
+def make_job(order, name, release=None):
+    async def run():
+        order.append(name)
+        if release:
+            await release.wait()
+        return name
+
+    return run
+
+
+def test_waiting_commands_run_most_urgent_first():
+    order = []
+
+    async def run():
+        scheduler = CommandScheduler()
+        release = asyncio.Event()
+        running = scheduler.submit('backup', make_job(order, 'backup', release), Priority.ROUTINE)
+        await asyncio.sleep(0)
+
+        waiting = [scheduler.submit('verify-backups', make_job(order, 'verify-backups'), Priority.ROUTINE),
+                   scheduler.submit('restore-file', make_job(order, 'restore-file'), Priority.NORMAL),
+                   scheduler.submit('stop', make_job(order, 'stop'), Priority.URGENT),
+                   scheduler.submit('start', make_job(order, 'start'), Priority.URGENT)]
+        release.set()
+        return await asyncio.gather(running, *waiting)
+
+    assert asyncio.run(run()) == ['backup', 'verify-backups', 'restore-file', 'stop', 'start']
+    assert order == ['backup', 'stop', 'start', 'restore-file', 'verify-backups']
+
+
+def test_waiting_commands_with_a_key_are_coalesced():
+    order = []
+
+    async def run():
+        scheduler = CommandScheduler()
+        release = asyncio.Event()
+        running = scheduler.submit('backup', make_job(order, 'backup', release), Priority.ROUTINE, key='backup')
+        await asyncio.sleep(0)
+
+        # The running backup doesn't count, but the two asked for while it runs share one
+        first = scheduler.submit('backup', make_job(order, 'second'), Priority.ROUTINE, key='backup')
+        second = scheduler.submit('backup', make_job(order, 'third'), Priority.ROUTINE, key='backup')
+        assert scheduler.describe() == 'running `backup` | 1 waiting (backup)'
+        release.set()
+        return await asyncio.gather(running, first, second)
+
+    assert asyncio.run(run()) == ['backup', 'second', 'second']
+    assert order == ['backup', 'second']
+
+
+def test_closing_drops_waiting_commands_but_finishes_the_running_one():
+    order = []
+
+    async def run():
+        scheduler = CommandScheduler()
+        release = asyncio.Event()
+        running = scheduler.submit('restore', make_job(order, 'restore', release), Priority.URGENT)
+        await asyncio.sleep(0)
+        waiting = scheduler.submit('backup', make_job(order, 'backup'), Priority.ROUTINE)
+
+        scheduler.close()
+        late = scheduler.submit('start', make_job(order, 'start'), Priority.URGENT)
+        release.set()
+
+        results = await asyncio.gather(running, waiting, late, return_exceptions=True)
+        return [i if isinstance(i, str) else type(i).__name__ for i in results]
+
+    assert asyncio.run(run()) == ['restore', 'CancelledError', 'CancelledError']
+    assert order == ['restore']
@@ -0,0 +1,219 @@
+import hashlib
+import hmac
+import os
+import re
+import threading
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.storage import LocalStorage, Replicator, S3Storage, StorageError
+
+ACCESS_KEY = 'test-access-key'
+SECRET_KEY = 'test-secret-key'
+PART_SIZE = 65536
+
+
+class FakeS3:
+    """
+    Just enough of S3's multipart upload API, checking every request's Signature Version 4 signature
+    the way S3 does, and recording the parts and completions it receives
+    """
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.parts = []
+        self.completions = []
+        self.on_part = None
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler())
+        self.endpoint = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def is_signed(self, method, path, query, headers, payload_hash):
+        match = re.match(r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([\w-]+)/s3/aws4_request, '
+                         r'SignedHeaders=([\w;-]+), Signature=([0-9a-f]{64})$', headers.get('Authorization', ''))
+        if not match or match.group(1) != ACCESS_KEY:
+            return False
+
+        _, date, region, signed_headers, signature = match.groups()
+        canonical_query = '&'.join(sorted(
+            '{}={}'.format(urllib.parse.quote(k, safe='~'), urllib.parse.quote(v, safe='~'))
+            for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True)))
+        canonical_headers = ''.join('{}:{}\n'.format(i, headers[i].strip()) for i in signed_headers.split(';'))
+        canonical_request = '\n'.join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', headers['x-amz-date'], '{}/{}/s3/aws4_request'.format(date, region),
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        key = 'AWS4{}'.format(SECRET_KEY).encode('utf-8')
+        for item in [date, region, 's3', 'aws4_request']:
+            key = hmac.new(key, item.encode('utf-8'), hashlib.sha256).digest()
+
+        expected = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return 'host' in signed_headers.split(';') and hmac.compare_digest(expected, signature)
+
+    def get_handler(self):
+        s3 = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def handle_request(self, method):
+                path, _, query = self.path.partition('?')
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                payload_hash = self.headers.get('x-amz-content-sha256', '')
+                if hashlib.sha256(body).hexdigest() != payload_hash or \
+                        not s3.is_signed(method, path, query, self.headers, payload_hash):
+                    return self.reply(403, b'<Error><Code>SignatureDoesNotMatch</Code></Error>')
+
+                params = dict(urllib.parse.parse_qsl(query, keep_blank_values=True))
+                key = urllib.parse.unquote(path)
+                if method == 'POST' and 'uploads' in params:
+                    upload_id = uuid.uuid4().hex
+                    s3.uploads[upload_id] = {}
+                    return self.reply(200, '<InitiateMultipartUploadResult><UploadId>{}</UploadId>'
+                                           '</InitiateMultipartUploadResult>'.format(upload_id).encode('utf-8'))
+
+                if params.get('uploadId') not in s3.uploads:
+                    return self.reply(404, b'<Error><Code>NoSuchUpload</Code></Error>')
+
+                if method == 'PUT':
+                    number = int(params['partNumber'])
+                    s3.parts.append((params['uploadId'], number))
+                    if s3.on_part and not s3.on_part(number):
+                        return self.reply(500, b'<Error><Code>InternalError</Code></Error>')
+
+                    etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                    s3.uploads[params['uploadId']][number] = (etag, body)
+                    return self.reply(200, headers={'ETag': etag})
+
+                s3.completions.append(body.decode('utf-8'))
+                parts = s3.uploads.pop(params['uploadId'])
+                listed = re.findall(
+                    r'<Part><PartNumber>(\d+)</PartNumber><ETag>(.*?)</ETag></Part>', body.decode('utf-8'))
+                if [(int(n), e) for n, e in listed] != [(n, parts[n][0]) for n in sorted(parts)]:
+                    return self.reply(200, b'<Error><Code>InvalidPart</Code></Error>')
+
+                s3.objects[key] = b''.join(parts[int(n)][1] for n, _ in listed)
+                self.reply(200, b'<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+
+        return Handler
+
+
+def make_backend(s3, secret_key=SECRET_KEY):
+    return S3Storage('s3://backups/minecraft', 'backups', 'minecraft', endpoint=s3.endpoint, region='eu-west-1',
+                     access_key=ACCESS_KEY, secret_key=secret_key)
+
+
+def make_backup(tmp_path, size):
+    backup_dir = tmp_path / 'backups'
+    backup_dir.mkdir()
+    data = os.urandom(size)
+    (backup_dir / 'minecraft-backup-1.tar.gz').write_bytes(data)
+    return str(backup_dir), data
+
+
+def test_uploads_signed_multipart(tmp_path):
+    backup_dir, data = make_backup(tmp_path, PART_SIZE * 3 + 100)
+
+    with FakeS3() as s3:
+        replicator = Replicator([make_backend(s3)], backup_dir, workers=2, part_size=PART_SIZE)
+        replicator.enqueue(['minecraft-backup-1.tar.gz']).result()
+        replicator.stop()
+
+    assert s3.objects['/backups/minecraft/minecraft-backup-1.tar.gz'] == data
+    assert sorted(i[1] for i in s3.parts) == [1, 2, 3, 4]
+    assert re.fullmatch(r'<CompleteMultipartUpload>(<Part><PartNumber>\d</PartNumber><ETag>"[0-9a-f]{32}"</ETag>'
+                        r'</Part>){4}</CompleteMultipartUpload>', s3.completions[0])
+    assert [int(i) for i in re.findall(r'<PartNumber>(\d+)</PartNumber>', s3.completions[0])] == [1, 2, 3, 4]
+
+
+def test_rejects_a_bad_signature(tmp_path):
+    with FakeS3() as s3:
+        with pytest.raises(StorageError) as error:
+            make_backend(s3, secret_key='wrong').begin_upload('minecraft-backup-1.tar.gz', 1)
+
+    assert error.value.code == 'SignatureDoesNotMatch'
+
+
+def test_resumes_an_interrupted_upload(tmp_path):
+    backup_dir, data = make_backup(tmp_path, PART_SIZE * 5)
+
+    with FakeS3() as s3:
+        # Stop replicating partway through, like the manager quitting mid-upload
+        backend = make_backend(s3)
+        replicator = Replicator([backend], backup_dir, workers=1, part_size=PART_SIZE)
+
+        def interrupt(number):
+            if number == 3:
+                replicator.cancelled.set()
+            return number < 3
+
+        s3.on_part = interrupt
+        replicator.enqueue(['minecraft-backup-1.tar.gz']).result()
+        replicator.stop()
+
+        assert not s3.objects
+        assert os.listdir(os.path.join(backup_dir, 'replication')) == [
+            '{}.minecraft-backup-1.tar.gz.json'.format(backend.name)]
+        upload_id = s3.parts[0][0]
+
+        s3.on_part = None
+        replicator = Replicator([make_backend(s3)], backup_dir, workers=1, part_size=PART_SIZE)
+        replicator.resume()
+        replicator.jobs.shutdown(wait=True)
+        replicator.stop()
+
+    # Parts 1 and 2 were saved, so only the rest were sent again, to the same upload
+    assert s3.parts == [(upload_id, 1), (upload_id, 2), (upload_id, 3), (upload_id, 3), (upload_id, 4),
+                        (upload_id, 5)]
+    assert s3.objects['/backups/minecraft/minecraft-backup-1.tar.gz'] == data
+    assert not [i for i in os.listdir(os.path.join(backup_dir, 'replication')) if i.endswith('.json')]
+
+
+def test_jars_are_uploaded_again_when_they_change(tmp_path):
+    backup_dir, _ = make_backup(tmp_path, 100)
+    jar_path = os.path.join(backup_dir, 'paper.jar')
+    with open(jar_path, 'wb') as f:
+        f.write(b'old jar')
+
+    backend = LocalStorage('file://remote', str(tmp_path / 'remote'))
+    replicator = Replicator([backend], backup_dir, part_size=PART_SIZE)
+    keys = ['paper.jar', 'minecraft-backup-1.tar.gz']
+    assert replicator.enqueue(keys).result() is None
+
+    # The archive never changes, so only the upgraded JAR goes up again
+    with open(jar_path, 'wb') as f:
+        f.write(b'new jar!')
+    replicator.enqueue(keys).result()
+    replicator.stop()
+
+    assert (tmp_path / 'remote' / 'paper.jar').read_bytes() == b'new jar!'
+    assert len(replicator.uploaded[backend.name]) == 3
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from src.supervisor import ServerSupervisor
+
+
+def make_config(tmp_path, **servers):
+    for name in servers:
+        (tmp_path / name).mkdir(exist_ok=True)
+        (tmp_path / name / 'server.jar').write_bytes(b'jar')
+
+    return {
+        'log_path': str(tmp_path / 'manager.log'),
+        'servers': {name: dict({'server_path': str(tmp_path / name / 'server.jar')}, **server)
+                    for name, server in servers.items()}
+    }
+
+
+def test_servers_get_their_own_backup_directory(tmp_path):
+    config = make_config(tmp_path, survival={}, creative={})
+    config['backup_dir'] = str(tmp_path / 'backups')
+
+    supervisor = ServerSupervisor(config)
+    assert supervisor.instances['survival'].backup_dir == os.path.join(str(tmp_path / 'backups'), 'survival')
+    assert supervisor.instances['creative'].backup_dir == os.path.join(str(tmp_path / 'backups'), 'creative')
+
+
+def test_rejects_a_shared_backup_directory(tmp_path):
+    config = make_config(tmp_path, survival={'backup_dir': str(tmp_path / 'backups')},
+                         creative={'backup_dir': str(tmp_path / 'backups') + '/'})
+
+    with pytest.raises(ValueError, match='backup_dir'):
+        ServerSupervisor(config)
+
+
+def test_rejects_a_shared_server_directory(tmp_path):
+    config = make_config(tmp_path, survival={}, creative={})
+    config['servers']['creative']['server_path'] = str(tmp_path / 'survival')
+
+    with pytest.raises(ValueError, match='server_path'):
+        ServerSupervisor(config)